@@ -0,0 +1,74 @@
+# Startup cost of the schema step: a fresh connection pool plus migrate(),
+# when the schema is already current (the normal start) and when every
+# migration step is checked again (what each start cost before versioning).
+#
+#   python -m bench.coldstart --runs 20
+#
+# Uses the database from the usual DB_* settings; run migrations.py first so
+# the schema is current. Nothing is changed by the runs themselves.
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from database import Database
+from migrations import migrate
+
+
+class StatementCounter:
+    # Stands in for Metrics: Database reports every statement through observe()
+    def __init__(self):
+        self.statements = 0
+
+    def observe(self, name, value, **labels):
+        if name == 'sql_seconds':
+            self.statements += 1
+
+
+def measure(since):
+    counter = StatementCounter()
+    started = time.perf_counter()
+    database = Database.from_env(metrics=counter)
+    try:
+        migrate(database, since=since)
+        elapsed = time.perf_counter() - started
+    finally:
+        database.close()
+    return elapsed, counter.statements
+
+
+def summarize(samples):
+    times = sorted(elapsed for elapsed, _ in samples)
+    return {
+        'runs': len(samples),
+        'p50_ms': round(statistics.median(times) * 1000, 2),
+        'p95_ms': round(times[min(len(times) - 1, int(len(times) * 0.95))] * 1000, 2),
+        'statements': samples[-1][1],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the schema step of a cold start.")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', metavar='PATH', help="also write the results as JSON")
+    options = parser.parse_args(argv)
+    load_dotenv()
+
+    summary = {
+        'current': summarize([measure(None) for _ in range(options.runs)]),
+        'recheck_all': summarize([measure(0) for _ in range(options.runs)]),
+    }
+    print(f"{'schema step':<14}{'runs':>6}{'p50 ms':>10}{'p95 ms':>10}{'statements':>12}")
+    for name, row in summary.items():
+        print(f"{name:<14}{row['runs']:>6}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['statements']:>12}")
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
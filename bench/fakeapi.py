@@ -0,0 +1,135 @@
+import asyncio
+import itertools
+import json
+import random
+import time
+from contextvars import ContextVar
+
+from telegram.request import BaseRequest
+
+BOT_ID = 100000001
+BOT_USERNAME = 'bench_bot'
+
+
+class UpdateStats:
+    # Everything one update caused: Bot API calls per method, database
+    # statements, and the handler that ended up processing it.
+    __slots__ = ('kind', 'handler', 'api_calls', 'db_queries', 'retry_after', 'started', 'finished')
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.handler = None
+        self.api_calls = {}
+        self.db_queries = 0
+        self.retry_after = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+
+# Stats of the update being processed by the current task. Work done by
+# background tasks (write-behind flushes, notifier digests, jobs) is not tied
+# to an update and is counted in `background` instead.
+current_update = ContextVar('current_update', default=None)
+background = UpdateStats('background')
+
+
+def current_stats():
+    return current_update.get() or background
+
+
+class FakeBotAPI(BaseRequest):
+    # Stands in for api.telegram.org: answers every method the bot uses with a
+    # plausible result after `latency` seconds (+/- jitter), and fails a
+    # fraction `rate_429` of the calls with 429 Too Many Requests.
+
+    def __init__(self, latency=0.05, jitter=0.0, rate_429=0.0, retry_after=1, members=(), seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.members = set(members)  # user ids that are in the whitelist group
+        self.calls = {}
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data is not None else {}
+        stats = current_stats()
+        stats.api_calls[api_method] = stats.api_calls.get(api_method, 0) + 1
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if api_method != 'getMe' and self.rate_429 and self._random.random() < self.rate_429:
+            self.throttled += 1
+            stats.retry_after += 1
+            return 429, _encode({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            })
+
+        handler = getattr(self, '_' + api_method, None)
+        result = handler(parameters) if handler is not None else True
+        return 200, _encode({'ok': True, 'result': result})
+
+    def _getMe(self, parameters):
+        return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': BOT_USERNAME,
+                'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+
+    def _getChatMember(self, parameters):
+        user_id = int(parameters['user_id'])
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User {user_id}"}
+        if user_id in self.members:
+            return {'status': 'member', 'user': user}
+        return {'status': 'left', 'user': user}
+
+    def _message(self, parameters, **fields):
+        chat_id = int(parameters['chat_id'])
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench'},
+        }
+        message.update(fields)
+        return message
+
+    def _sendMessage(self, parameters):
+        return self._message(parameters, text=parameters.get('text', ''))
+
+    def _editMessageText(self, parameters):
+        if 'inline_message_id' in parameters:
+            return True
+        message = self._message(parameters, text=parameters.get('text', ''))
+        message['message_id'] = int(parameters['message_id'])
+        return message
+
+    def _sendPhoto(self, parameters):
+        return self._message(parameters, photo=[{'file_id': 'bench', 'file_unique_id': 'bench', 'width': 1, 'height': 1}])
+
+    def _sendDocument(self, parameters):
+        return self._message(parameters, document={'file_id': 'bench', 'file_unique_id': 'bench'})
+
+    def _sendMediaGroup(self, parameters):
+        return [self._message(parameters) for _ in parameters.get('media', ())]
+
+
+def _encode(payload):
+    return json.dumps(payload).encode('utf-8')
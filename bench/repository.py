@@ -0,0 +1,158 @@
+# Throughput of the storage backends in repository.py; their behaviour is
+# covered by tests/test_repository.py.
+#
+#   python -m bench.repository --backend sqlite --ops 5000 --concurrency 64
+#   python -m bench.repository --backend mysql --ops 5000 --json results.json
+#
+# The sqlite backend uses a fresh file in a temporary directory unless --path
+# is given. The mysql backend uses the usual DB_* settings and must be a
+# scratch database: rows of the synthetic users (ids from USER_BASE up) and
+# the benchmark category are deleted afterwards.
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+from bench.scenarios import USER_BASE
+from database import Database
+from repository import MySQLRepository, SQLiteRepository
+
+BENCH_CATEGORY = 'Benchmark repository'
+CLEANUP_SQL = [
+    "DELETE FROM ticket WHERE user_id >= %s",
+    "DELETE FROM users WHERE user_id >= %s",
+]
+# Rows the measured operations work on; plain INSERTs, which both dialects accept
+INSERT_USER_SQL = "INSERT INTO users (user_id, status) VALUES (%s, 'member')"
+INSERT_CATEGORY_SQL = "INSERT INTO ticket_category (category_name, description) VALUES (%s, %s)"
+INSERT_TICKET_SQL = "INSERT INTO ticket (category_id, user_id, message) VALUES (%s, %s, %s)"
+
+
+async def seed(repository, user_ids):
+    # One user and one open ticket per id; returns the ticket ids
+    def write(cursor):
+        cursor.execute(repository._sql("SELECT id FROM ticket_category WHERE category_name = %s"), (BENCH_CATEGORY,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(repository._sql(INSERT_CATEGORY_SQL), (BENCH_CATEGORY, "Repository benchmark"))
+            category_id = cursor.lastrowid
+        else:
+            category_id = row[0]
+        ticket_ids = []
+        for user_id in user_ids:
+            cursor.execute(repository._sql(INSERT_USER_SQL), (user_id,))
+            cursor.execute(repository._sql(INSERT_TICKET_SQL), (category_id, user_id, "benchmark ticket"))
+            ticket_ids.append(cursor.lastrowid)
+        return ticket_ids
+    return await repository._write(write)
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def measure(name, operations, concurrency):
+    # Runs the coroutine factories `concurrency` at a time
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(operation):
+        async with semaphore:
+            started = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed(operation) for operation in operations))
+    elapsed = time.perf_counter() - started
+    return {
+        'operation': name,
+        'ops': len(operations),
+        'ops_per_second': round(len(operations) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+    }
+
+
+async def benchmark(repository, ops, concurrency):
+    user_ids = [USER_BASE + 10_000 + i for i in range(ops)]
+    ticket_ids = await seed(repository, user_ids)
+    results = [
+        await measure('get_user', [lambda user_id=user_id: repository.get_user(user_id) for user_id in user_ids],
+                      concurrency),
+        await measure('page_tickets', [
+            lambda user_id=user_id: repository.page_tickets({'status': 'open', 'user_id': user_id})
+            for user_id in user_ids
+        ], concurrency),
+        await measure('close_ticket', [
+            lambda ticket_id=ticket_id: repository.close_ticket(ticket_id, USER_BASE) for ticket_id in ticket_ids[::2]
+        ], concurrency),
+    ]
+    # Reads and writes interleaved, the way the /tickets inbox issues them
+    mixed = []
+    for user_id, ticket_id in zip(user_ids[1::2], ticket_ids[1::2]):
+        mixed.append(lambda user_id=user_id: repository.page_tickets({'status': 'open', 'user_id': user_id}))
+        mixed.append(lambda ticket_id=ticket_id: repository.close_ticket(ticket_id, USER_BASE))
+    results.append(await measure('mixed', mixed, concurrency))
+    return results
+
+
+def cleanup(database):
+    def delete(cursor):
+        for statement in CLEANUP_SQL:
+            cursor.execute(statement, (USER_BASE,))
+        cursor.execute("DELETE FROM ticket_category WHERE category_name = %s", (BENCH_CATEGORY,))
+    database.call(delete)
+
+
+async def run(repository, options):
+    summary = {'backend': options.backend, 'results': await benchmark(repository, options.ops, options.concurrency)}
+    print(f"{'operation':<16}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for row in summary['results']:
+        print(f"{row['operation']:<16}{row['ops']:>8}{row['ops_per_second']:>12}{row['p50_ms']:>10}{row['p95_ms']:>10}")
+    if isinstance(repository, SQLiteRepository):
+        summary['write_transactions'] = repository.groups
+        summary['writes'] = repository.writes
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the storage backends.")
+    parser.add_argument('--backend', choices=('sqlite', 'mysql'), default='sqlite')
+    parser.add_argument('--path', help="sqlite database file (default: a temporary one)")
+    parser.add_argument('--ops', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--json', metavar='PATH', help="also write the results as JSON")
+    options = parser.parse_args(argv)
+    load_dotenv()
+
+    database = None
+    with tempfile.TemporaryDirectory() as directory:
+        if options.backend == 'sqlite':
+            repository = SQLiteRepository(options.path or os.path.join(directory, 'bench.sqlite3'))
+        else:
+            database = Database.from_env()
+            cleanup(database)
+            repository = MySQLRepository(database)
+        try:
+            summary = asyncio.run(run(repository, options))
+        finally:
+            repository.close()
+            if database is not None:
+                cleanup(database)
+                database.close()
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+# Offline load test: runs the real Application and ConversationHandler from
+# bot4.py against a fake Bot API and replays synthetic update streams.
+#
+#   python -m bench.run --scenario ticket_flood --users 500 --latency-ms 40 --rate-429 0.01
+#
+# With --workers N the updates are split the way the supervisor routes them
+# and replayed by N processes at once, each bootstrapped as a worker.
+#
+# The database comes from the usual DB_* settings and must be a scratch MySQL
+# database: the schema is created if needed, and rows of the synthetic users
+# (ids from USER_BASE up) are deleted after the run.
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import queue
+import shutil
+import sys
+import tempfile
+import time
+import types
+import warnings
+
+os.environ.setdefault('TOKEN', '100000001:bench')
+os.environ.setdefault('WHITELIST_GROUP_ID', '-1000000000001')
+os.environ.setdefault('TARGET_GROUP_ID', '-1000000000002')
+os.environ.setdefault('METRICS_PORT', '0')
+# The bot's log lines go to stderr, and only with --verbose
+logging.basicConfig(level=logging.CRITICAL, format='%(levelname)s %(name)s: %(message)s')
+
+from telegram import Update
+
+import bot4
+from bench.fakeapi import FakeBotAPI, UpdateStats, background, current_stats, current_update
+from bench.scenarios import SCENARIOS, USER_BASE, UpdateFactory, interleave
+from database import Database
+from processing import iter_handlers
+from supervisor import routing_key, shard_of, worker_path
+
+CLEANUP_SQL = [
+    "DELETE FROM ticket WHERE user_id >= %s",
+    "DELETE FROM rate_limit_state WHERE user_id >= %s",
+    "DELETE FROM media_index WHERE user_id >= %s",
+    "DELETE FROM user_state WHERE user_id >= %s",
+    "DELETE FROM conversation_state WHERE owner_id >= %s",
+    "DELETE FROM users WHERE user_id >= %s",
+]
+BENCH_CATEGORY = 'Benchmark'
+
+
+class CountingCursor:
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def execute(self, sql, params=()):
+        self._stats.db_queries += 1
+        return self._cursor.execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        # The connector rewrites INSERT ... VALUES into one multi-row statement;
+        # anything else is sent once per parameter set.
+        seq_of_params = list(seq_of_params)
+        is_insert = sql.lstrip().upper().startswith('INSERT')
+        self._stats.db_queries += 1 if is_insert else len(seq_of_params)
+        return self._cursor.executemany(sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingDatabase(Database):
+    # Counts statements against the update whose handler issued them. The
+    # update is looked up on the event loop, before the query moves to a
+    # worker thread that does not share the caller's context.
+    async def run(self, fn, *args):
+        stats = current_stats()
+
+        def counted(cursor, *args):
+            return fn(CountingCursor(cursor, stats), *args)
+
+        return await super().run(counted, *args)
+
+
+def instrument_handlers(application):
+    # Records which callback handled each update
+    def wrap(handler):
+        callback = handler.callback
+        name = callback.__name__
+
+        async def timed(update, context):
+            stats = current_update.get()
+            if stats is not None:
+                stats.handler = name
+            return await callback(update, context)
+
+        handler.callback = timed
+
+    for handler in iter_handlers(application):
+        wrap(handler)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(results, elapsed):
+    latencies = sorted((stats.finished - stats.started) * 1000 for stats in results)
+    count = len(results)
+    return {
+        'updates': count,
+        'p50_ms': round(percentile(latencies, 0.50), 2),
+        'p95_ms': round(percentile(latencies, 0.95), 2),
+        'p99_ms': round(percentile(latencies, 0.99), 2),
+        'throughput': round(count / elapsed, 1) if elapsed else 0.0,
+        'db_per_update': round(sum(stats.db_queries for stats in results) / count, 2) if count else 0.0,
+        'api_per_update': round(sum(sum(stats.api_calls.values()) for stats in results) / count, 2) if count else 0.0,
+    }
+
+
+async def replay(application, steps, rate, errors):
+    results = []
+
+    async def process(kind, payload, stats):
+        current_update.set(stats)
+        update = Update.de_json(payload, application.bot)
+        await application.update_processor.process_update(update, application.process_update(update))
+        stats.finished = time.perf_counter()
+        results.append(stats)
+
+    async def count_error(update, context):
+        name = type(context.error).__name__
+        errors[name] = errors.get(name, 0) + 1
+
+    application.add_error_handler(count_error)
+
+    tasks = []
+    started = time.perf_counter()
+    for number, (kind, payload) in enumerate(steps):
+        if rate:
+            # Open loop: updates arrive on schedule whether or not earlier ones are done
+            delay = started + number / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(kind, payload, UpdateStats(kind))))
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - started
+
+
+async def run(options, steps, api):
+    application = bot4.build_application(request=api)
+    instrument_handlers(application)
+    errors = {}
+    # Same lifecycle as run_polling, minus fetching updates
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        results, elapsed = await replay(application, steps, options.rate, errors)
+        await application.stop()
+        await application.post_stop(application)
+    await application.post_shutdown(application)
+    return results, elapsed, errors
+
+
+def route(options, sequences):
+    # Splits the stream by worker exactly as Supervisor.route does, and times
+    # the supervisor's share of the work: parse, route, serialize
+    shards = [[] for _ in range(options.workers)]
+    started = time.perf_counter()
+    for kind, payload in interleave(sequences):
+        update = Update.de_json(payload, None)
+        index = shard_of(routing_key(update), options.workers)
+        pickle.dumps(update.to_dict())
+        shards[index].append((kind, payload))
+    return shards, time.perf_counter() - started
+
+
+def run_shard(index, options, steps, members, journal_dir, ready, go, results):
+    # Runs in a worker process, started with WORKER_INDEX set like the
+    # supervisor's workers
+    warnings.simplefilter('ignore')
+    output = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(io.StringIO())
+    bot4.WRITE_BEHIND_JOURNAL = worker_path(os.path.join(journal_dir, 'write_behind.journal'), index)
+    with output:
+        bot4.bootstrap(CountingDatabase.from_env())
+        api = FakeBotAPI(
+            latency=options.latency_ms / 1000,
+            jitter=options.jitter_ms / 1000,
+            rate_429=options.rate_429,
+            retry_after=options.retry_after,
+            members=members,
+            seed=options.seed + index,
+        )
+        ready.put(index)
+        go.wait()
+        # Each worker gets its share of the offered rate
+        options.rate = options.rate / options.workers
+        shard_results, elapsed, errors = asyncio.run(run(options, steps, api))
+    results.put((shard_results, elapsed, errors, api.calls, api.throttled, background))
+
+
+def collect(channel, processes, count):
+    items = []
+    while len(items) < count:
+        try:
+            items.append(channel.get(timeout=1))
+        except queue.Empty:
+            if not any(process.is_alive() for process in processes):
+                raise RuntimeError("bench workers exited early, rerun with --verbose for their output")
+    return items
+
+
+def run_workers(options, sequences, members, journal_dir):
+    shards, routing = route(options, sequences)
+    context = multiprocessing.get_context('spawn')
+    ready, results, go = context.Queue(), context.Queue(), context.Event()
+    processes = []
+    for index, steps in enumerate(shards):
+        os.environ['WORKER_INDEX'] = str(index)
+        try:
+            process = context.Process(target=run_shard, args=(index, options, steps, members, journal_dir, ready, go, results))
+            process.start()
+        finally:
+            del os.environ['WORKER_INDEX']
+        processes.append(process)
+    # The clock starts once every worker has bootstrapped
+    collect(ready, processes, len(processes))
+    go.set()
+    collected = collect(results, processes, len(processes))
+    for process in processes:
+        process.join()
+
+    merged, errors, api = [], {}, types.SimpleNamespace(calls={}, throttled=0)
+    for shard_results, elapsed, shard_errors, calls, throttled, shard_background in collected:
+        merged.extend(shard_results)
+        for name, count in shard_errors.items():
+            errors[name] = errors.get(name, 0) + count
+        for method, count in calls.items():
+            api.calls[method] = api.calls.get(method, 0) + count
+        api.throttled += throttled
+        background.db_queries += shard_background.db_queries
+        for method, count in shard_background.api_calls.items():
+            background.api_calls[method] = background.api_calls.get(method, 0) + count
+    # Workers run side by side; the slowest one decides
+    elapsed = max(item[1] for item in collected)
+    return merged, elapsed, errors, api, routing
+
+
+def ensure_bench_category(database):
+    # ticket rows need an existing category; a throwaway one is added if there is none
+    def insert(cursor):
+        cursor.execute("INSERT IGNORE INTO ticket_category (category_name, description) VALUES (%s, %s)", (BENCH_CATEGORY, "Load test"))
+        cursor.execute("SELECT id FROM ticket_category WHERE category_name = %s", (BENCH_CATEGORY,))
+        return cursor.fetchone()[0]
+    return database.call(insert)
+
+
+def cleanup(database, created_category):
+    def delete(cursor):
+        for statement in CLEANUP_SQL:
+            cursor.execute(statement, (USER_BASE,))
+        if created_category:
+            cursor.execute("DELETE FROM ticket_category WHERE category_name = %s", (BENCH_CATEGORY,))
+    database.call(delete)
+
+
+def report(options, results, elapsed, errors, api, routing=None):
+    by_handler = {}
+    for stats in results:
+        by_handler.setdefault(stats.handler or '(unhandled)', []).append(stats)
+    return {
+        'scenario': options.scenario,
+        'config': {
+            'users': options.users,
+            'latency_ms': options.latency_ms,
+            'jitter_ms': options.jitter_ms,
+            'rate_429': options.rate_429,
+            'rate': options.rate,
+            'max_concurrent_updates': bot4.MAX_CONCURRENT_UPDATES,
+            'workers': options.workers,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'total': summarize(results, elapsed),
+        'handlers': {name: summarize(group, elapsed) for name, group in sorted(by_handler.items())},
+        'background': {'db_queries': background.db_queries, 'api_calls': sum(background.api_calls.values())},
+        'api_calls': dict(sorted(api.calls.items())),
+        'throttled': api.throttled,
+        'errors': errors,
+        # Supervisor cost per update; its ceiling is 1e6 / this many updates per second
+        'routing_us_per_update': round(routing * 1e6 / len(results), 1) if routing is not None and results else None,
+    }
+
+
+def print_report(summary):
+    print(f"{summary['scenario']}: {summary['total']['updates']} updates in {summary['elapsed_s']}s, "
+          f"{summary['throttled']} injected 429s, errors: {summary['errors'] or 'none'}")
+    print(f"{'handler':<28}{'updates':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'upd/s':>9}{'db/upd':>8}{'api/upd':>9}")
+    rows = list(summary['handlers'].items()) + [('all', summary['total'])]
+    for name, row in rows:
+        print(f"{name:<28}{row['updates']:>9}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}"
+              f"{row['throughput']:>9}{row['db_per_update']:>8}{row['api_per_update']:>9}")
+    print(f"background work: {summary['background']['db_queries']} db statements, {summary['background']['api_calls']} api calls")
+    print(f"api calls: {summary['api_calls']}")
+    if summary['routing_us_per_update'] is not None:
+        print(f"{summary['config']['workers']} workers, supervisor routing: {summary['routing_us_per_update']} us/update")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replay synthetic updates through bot4 against a fake Bot API.")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='start_storm')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=0, help="updates per second; 0 sends everything at once")
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--rate-429', type=float, default=0, help="share of Bot API calls answered with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help="start_storm: /start commands per user")
+    parser.add_argument('--member-ratio', type=float, default=0.8, help="start_storm: share of whitelist members")
+    parser.add_argument('--toggles', type=int, default=6, help="group_toggle_storm: toggles per user")
+    parser.add_argument('--tickets', type=int, default=3, help="ticket_flood, duplicate_flood: tickets per user")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=1, help="worker processes, routed by user id as in supervisor mode")
+    parser.add_argument('--json', metavar='PATH', help="also write the results as JSON, for comparing runs")
+    parser.add_argument('--verbose', action='store_true', help="show the bot's own output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    warnings.simplefilter('ignore')  # ConversationHandler per_* advice
+
+    output = contextlib.nullcontext() if options.verbose else contextlib.redirect_stdout(io.StringIO())
+    if options.verbose:
+        logging.getLogger().setLevel(logging.INFO)
+
+    # Keep the journal of this run away from the bot's own
+    journal_dir = tempfile.mkdtemp(prefix='bench-')
+    bot4.WRITE_BEHIND_JOURNAL = os.path.join(journal_dir, 'write_behind.journal')
+    database = CountingDatabase.from_env()
+    with output:
+        bot4.bootstrap(database)
+
+    created_category = False
+    options.group_ids = [str(group[0]) for group in bot4.catalog.groups]
+    options.category_ids = [category[0] for category in bot4.catalog.categories]
+    if options.scenario in ('ticket_flood', 'duplicate_flood') and not options.category_ids:
+        options.category_ids = [ensure_bench_category(database)]
+        created_category = True
+        bot4.catalog.load()
+
+    user_ids = list(range(USER_BASE, USER_BASE + options.users))
+    sequences, members = SCENARIOS[options.scenario](UpdateFactory(), user_ids, options)
+    api = FakeBotAPI(
+        latency=options.latency_ms / 1000,
+        jitter=options.jitter_ms / 1000,
+        rate_429=options.rate_429,
+        retry_after=options.retry_after,
+        members=members,
+        seed=options.seed,
+    )
+
+    routing = None
+    try:
+        if options.workers > 1:
+            results, elapsed, errors, api, routing = run_workers(options, sequences, members, journal_dir)
+        else:
+            with output:
+                results, elapsed, errors = asyncio.run(run(options, interleave(sequences), api))
+    finally:
+        cleanup(database, created_category)
+        shutil.rmtree(journal_dir, ignore_errors=True)
+
+    summary = report(options, results, elapsed, errors, api, routing)
+    print_report(summary)
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
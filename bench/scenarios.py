@@ -0,0 +1,160 @@
+import itertools
+import random
+import string
+import time
+
+from bench.fakeapi import BOT_ID
+
+# Synthetic users get ids far above anything Telegram hands out, so their rows
+# can be told apart from real ones and removed after the run.
+USER_BASE = 8_000_000_000_000
+
+
+class UpdateFactory:
+    # Builds raw Bot API update payloads, as getUpdates or a webhook would deliver them
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'last_name': str(user_id), 'username': f"bench{user_id}"}
+
+    def _message(self, user_id, text):
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self.user(user_id),
+            'text': text,
+        }
+
+    def command(self, user_id, command):
+        message = self._message(user_id, f"/{command}")
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}]
+        return f"/{command}", {'update_id': next(self._update_ids), 'message': message}
+
+    def text(self, user_id, text):
+        return 'text', {'update_id': next(self._update_ids), 'message': self._message(user_id, text)}
+
+    def callback(self, user_id, data):
+        # The button sits on a message the bot sent earlier
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench'},
+            'text': 'Hi! Please choose an option:',
+        }
+        label = data.split('_')[0] + '_' if data.startswith(('group_', 'category_')) else data
+        return f"callback:{label}", {
+            'update_id': next(self._update_ids),
+            'callback_query': {
+                'id': str(next(self._callback_ids)),
+                'from': self.user(user_id),
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': message,
+            },
+        }
+
+
+# Each scenario returns one list of (kind, payload) steps per user, and the
+# set of users the fake API reports as whitelist group members. Steps of one
+# user are replayed in order; users are interleaved.
+
+def start_storm(factory, user_ids, options):
+    # Everyone sends /start at once; a share of them are whitelist members
+    members = set(user_ids[:int(len(user_ids) * options.member_ratio)])
+    sequences = [[factory.command(user_id, 'start') for _ in range(options.repeat)] for user_id in user_ids]
+    return sequences, members
+
+
+def group_toggle_storm(factory, user_ids, options):
+    # Members open the group picker and flip groups on and off before submitting
+    group_ids = options.group_ids or ['1', '2', '3']
+    sequences = []
+    for user_id in user_ids:
+        steps = [factory.command(user_id, 'start'), factory.callback(user_id, 'groups_join')]
+        for toggle in range(options.toggles):
+            steps.append(factory.callback(user_id, f"group_{group_ids[toggle % len(group_ids)]}"))
+        steps.append(factory.callback(user_id, 'submit'))
+        sequences.append(steps)
+    return sequences, set(user_ids)
+
+
+# A complaint many users paste, with their own greeting in front; the variants
+# stay within the deduplicator's distance of each other
+DUPLICATE_GREETINGS = ('Hi', 'Hello', 'Hey there', 'Good morning', 'Hi admins')
+DUPLICATE_COMPLAINT = (
+    "the bot stopped answering in the group after the last update, my messages are not delivered "
+    "and the join button does nothing. Please have a look."
+)
+
+
+def ticket_body(user_id, number, seed):
+    # Sixteen random letter words: bodies share almost no 4-grams, so their
+    # SimHash signatures are about 32 bits apart and the deduplicator keeps
+    # them apart
+    rng = random.Random(f"{seed}:{user_id}:{number}")
+    words = (''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))) for _ in range(16))
+    return ' '.join(words)
+
+
+def _ticket_steps(factory, user_id, category_id, bodies):
+    steps = [
+        factory.command(user_id, 'start'),
+        factory.callback(user_id, 'ticket'),
+        factory.callback(user_id, f"category_{category_id}"),
+    ]
+    steps.extend(factory.text(user_id, body) for body in bodies)
+    return steps
+
+
+def ticket_flood(factory, user_ids, options):
+    # Members pick a category and send several distinct tickets each
+    category_id = options.category_ids[0]
+    sequences = [
+        _ticket_steps(factory, user_id, category_id,
+                      [ticket_body(user_id, number, options.seed) for number in range(options.tickets)])
+        for user_id in user_ids
+    ]
+    return sequences, set(user_ids)
+
+
+def duplicate_flood(factory, user_ids, options):
+    # Members all send the same complaint, which exercises the deduplicator's
+    # match path: one ticket is created and the rest are counted against it
+    category_id = options.category_ids[0]
+    sequences = []
+    for user_id in user_ids:
+        bodies = [
+            f"{DUPLICATE_GREETINGS[(user_id + number) % len(DUPLICATE_GREETINGS)]}, {DUPLICATE_COMPLAINT}"
+            for number in range(options.tickets)
+        ]
+        sequences.append(_ticket_steps(factory, user_id, category_id, bodies))
+    return sequences, set(user_ids)
+
+
+def join_wave(factory, user_ids, options):
+    # Non-members arrive and request to join
+    sequences = [[factory.command(user_id, 'start'), factory.callback(user_id, 'joinbtn')] for user_id in user_ids]
+    return sequences, set()
+
+
+SCENARIOS = {
+    'start_storm': start_storm,
+    'group_toggle_storm': group_toggle_storm,
+    'ticket_flood': ticket_flood,
+    'duplicate_flood': duplicate_flood,
+    'join_wave': join_wave,
+}
+
+
+def interleave(sequences):
+    # Step 1 of every user, then step 2 of every user, ...
+    for steps in itertools.zip_longest(*sequences):
+        for step in steps:
+            if step is not None:
+                yield step
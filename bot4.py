@@ -1,27 +1,81 @@
 import os
+import asyncio
+import gzip
 import logging
+import shutil
+import signal
+import tempfile
 from datetime import datetime, timedelta
 import time
 import threading
-import mysql.connector
 from exceptiongroup import catch
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaDocument, ForceReply
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto, InputMediaDocument, ForceReply
+from telegram.request import HTTPXRequest
+from telegram.error import TelegramError
 from telegram.ext import (
     Application,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    ChatMemberHandler,
     MessageHandler,
+    Updater,
     filters,
 )
 from dotenv import load_dotenv
+from logqueue import correlate_handlers, setup_logging
+from database import Database, DatabaseError
+from dedup import TicketDeduplicator, simhash
+from cache import TTLCache
+from broadcast import Broadcaster
+from catalog import Catalog
+from media import PERCEPTUAL_HASHING, MediaForwarder, MediaIndex, MediaItem, document_hash_source, perceptual_hash
+from moderation import EXPORT_FORMATS, EXPORTS, apply_bulk, chunks, export_rows, parse_user_ids
+from migrations import migrate
+from metrics import InstrumentedRequest, Metrics, MetricsServer, conversation_states, instrument_handlers
+from notifier import ModNotifier
+from outbound import OutboundScheduler
+from persistence import LazyPersistence
+from processing import PerUserUpdateProcessor
+from search import FulltextSearch, InvertedIndex, PAGE_SIZE as SEARCH_PAGE_SIZE, fetch_results, render_results
+from sharedstore import DatabaseStore, LocalStore
+from supervisor import Supervisor, serve_worker, worker_path
+from tickets import (
+    COPIES_COUNT_SQL, COPIES_PAGE_SIZE, COPIES_SQL, FilterError, page_cursor, parse_filters, render_copies, render_page,
+)
+from writebehind import (
+    WriteBehind, AddMember, InsertTicket, RequestJoin, SetUserCooldown, SetUserStatus, SetUserVerified, TicketDuplicate,
+)
+from reconcile import Reconciler
+from repository import MySQLRepository, from_env as repository_from_env
+from retention import Archiver
+from ratelimit import RateLimiter, Rule, SlidingWindow, TokenBucket, ALLOW, BAN
 
 load_dotenv()
 database = None
-
-# Configure logging
-logging.basicConfig(filename='logs/bot_activity.log', level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+catalog = None
+broadcaster = None
+media_index = None
+write_behind = None
+shared_store = None
+reconciler = None
+ticket_search = None
+ticket_dedup = None
+archiver = None
+repository = None
+
+logger = logging.getLogger('bot')
+
+# Logging goes through a queue to a writer thread: JSON lines, rotated by size and age, gzipped
+LOG_FILE = os.environ.get('LOG_FILE', 'logs/bot_activity.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('LOG_BACKUPS', 10))
+LOG_ROTATE_INTERVAL = int(os.environ.get('LOG_ROTATE_INTERVAL', 86400))
+# Repeats of one INFO message allowed per second once its burst is used up
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 5))
+LOG_CONSOLE = os.environ.get('LOG_CONSOLE', '1') == '1'
 
 # Telegram bot token (replace 'YOUR_TOKEN' with your actual bot token)
 TOKEN = os.environ.get('TOKEN')
@@ -30,10 +84,148 @@ WHITELIST_GROUP_ID = os.environ.get('WHITELIST_GROUP_ID')  # Replace with your w
 # Group ID where the images will be reposted
 TARGET_GROUP_ID = os.environ.get('TARGET_GROUP_ID')  # Replace with your target group ID
 
-DEFAULT_STATE, IMAGE_PROCESSING, JOIN_PROCESSING, SUBMITTING_TICKET, ANNOUNCEMENT, BAN_ZONE = range(6)
+# Serving mode: 'polling' (default) or 'webhook' behind a local HTTP server
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Public URL Telegram should post updates to
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+# How many updates may be processed at once, and how long shutdown waits for them
+MAX_CONCURRENT_UPDATES = int(os.environ.get('MAX_CONCURRENT_UPDATES', 32))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get('SHUTDOWN_DRAIN_TIMEOUT', 30))
+# Seconds between batched writes of conversation states and user_data
+PERSISTENCE_INTERVAL = float(os.environ.get('PERSISTENCE_INTERVAL', 30))
+# Local HTTP endpoint serving /metrics; METRICS_PORT=0 turns it off
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 9464))
+
+# With WORKERS > 1 a supervisor process fetches updates and hands each user's
+# updates to the same one of WORKERS worker processes
+WORKERS = int(os.environ.get('WORKERS', 1))
+# Set by the supervisor in the worker processes it starts
+WORKER_INDEX = int(os.environ['WORKER_INDEX']) if os.environ.get('WORKER_INDEX') else None
+# Seconds between reads of the changes other workers published
+SHARED_POLL_INTERVAL = float(os.environ.get('SHARED_POLL_INTERVAL', 1))
+
+# Forum topics in TARGET_GROUP_ID that moderator notifications are posted to
+JOIN_REQUESTS_TOPIC_ID = int(os.environ.get('JOIN_REQUESTS_TOPIC_ID', 121))
+GROUP_SELECTIONS_TOPIC_ID = int(os.environ.get('GROUP_SELECTIONS_TOPIC_ID', 124))
+TICKETS_TOPIC_ID = int(os.environ.get('TICKETS_TOPIC_ID', 146))
+BANS_TOPIC_ID = int(os.environ.get('BANS_TOPIC_ID', 149))
+# Seconds a topic collects notifications before they are posted as one digest
+MOD_NOTIFY_FLUSH_WINDOW = float(os.environ.get('MOD_NOTIFY_FLUSH_WINDOW', 3))
+
+# Forum topic in TARGET_GROUP_ID for reposted images and files (unset: main thread)
+MEDIA_TOPIC_ID = int(os.environ['MEDIA_TOPIC_ID']) if os.environ.get('MEDIA_TOPIC_ID') else None
+# Seconds an album must be quiet before it is reposted as one media group
+MEDIA_ALBUM_WAIT = float(os.environ.get('MEDIA_ALBUM_WAIT', 1.5))
+# Perceptual hashes this many bits apart or closer count as the same image
+MEDIA_HASH_DISTANCE = int(os.environ.get('MEDIA_HASH_DISTANCE', 4))
+
+# Write-behind for user status and ticket writes: journal location, batch size and max delay (seconds)
+WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL', 'data/write_behind.journal')
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 500))
+WRITE_BEHIND_MAX_LATENCY = float(os.environ.get('WRITE_BEHIND_MAX_LATENCY', 0.2))
+
+# Announcement DMs: messages per second across all recipients (Bot API allows ~30) and sends in flight
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 20))
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', 8))
+
+# Outbound Bot API calls: messages per second overall and per chat (private
+# chats, groups), the burst a chat may send at once, and how often a call
+# answered with RetryAfter is queued again
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', 30))
+OUTBOUND_PRIVATE_RATE = float(os.environ.get('OUTBOUND_PRIVATE_RATE', 1))
+OUTBOUND_GROUP_RATE = float(os.environ.get('OUTBOUND_GROUP_RATE', 20 / 60))
+OUTBOUND_BURST = int(os.environ.get('OUTBOUND_BURST', 3))
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', 3))
+
+# Near-duplicate tickets: signatures at most this many bits apart (of 64) are
+# folded into the open ticket sent first within the window (seconds; 0 disables)
+TICKET_DUPLICATE_DISTANCE = int(os.environ.get('TICKET_DUPLICATE_DISTANCE', 10))
+TICKET_DUPLICATE_WINDOW = int(os.environ.get('TICKET_DUPLICATE_WINDOW', 24 * 3600))
+# Moderators hear about a ticket again when its duplicate count reaches one of these
+TICKET_DUPLICATE_ALERTS = (10, 100, 1000)
+
+# Retention: closed tickets move to ticket_archive this many days after closing
+# or this many days after they were sent, whichever comes first; open tickets
+# stay. Pending users who never became members and have no tickets are deleted
+# after ARCHIVE_PENDING_USER_DAYS. One worker runs it every ARCHIVE_INTERVAL
+# seconds, in transactions of ARCHIVE_BATCH rows.
+ARCHIVE_CLOSED_DAYS = int(os.environ.get('ARCHIVE_CLOSED_DAYS', 30))
+ARCHIVE_MAX_AGE_DAYS = int(os.environ.get('ARCHIVE_MAX_AGE_DAYS', 180))
+ARCHIVE_PENDING_USER_DAYS = int(os.environ.get('ARCHIVE_PENDING_USER_DAYS', 90))
+ARCHIVE_INTERVAL = int(os.environ.get('ARCHIVE_INTERVAL', 3600))
+ARCHIVE_BATCH = int(os.environ.get('ARCHIVE_BATCH', 1000))
+
+# /searchtickets backend: 'fulltext' uses the FULLTEXT index on ticket.message,
+# 'memory' an inverted index kept in each process
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'fulltext')
+
+# Seconds between checks of catalog_version for edits made outside the bot
+CATALOG_REFRESH_INTERVAL = int(os.environ.get('CATALOG_REFRESH_INTERVAL', 60))
+
+if WORKER_INDEX is not None:
+    # Each worker writes its own log and journal and serves metrics on its own
+    # port; the supervisor keeps METRICS_PORT
+    LOG_FILE = worker_path(LOG_FILE, WORKER_INDEX)
+    WRITE_BEHIND_JOURNAL = worker_path(WRITE_BEHIND_JOURNAL, WORKER_INDEX)
+    METRICS_PORT = METRICS_PORT + 1 + WORKER_INDEX if METRICS_PORT else 0
 
-# Cache structure: {user_id: {'count': X, 'last_access': datetime}}
-start_command_usage = {}
+DEFAULT_STATE, IMAGE_PROCESSING, JOIN_PROCESSING, SUBMITTING_TICKET, ANNOUNCEMENT, BAN_ZONE = range(6)
+STATE_NAMES = {
+    DEFAULT_STATE: 'default',
+    IMAGE_PROCESSING: 'image_processing',
+    JOIN_PROCESSING: 'join_processing',
+    SUBMITTING_TICKET: 'submitting_ticket',
+    ANNOUNCEMENT: 'announcement',
+    BAN_ZONE: 'ban_zone',
+}
+
+# Handler, SQL and Bot API instrumentation, exported on the metrics endpoint and by /stats
+metrics = Metrics()
+metrics_server = MetricsServer(metrics, METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+
+# Moderator notifications are queued and posted in the background
+mod_notifier = ModNotifier(TARGET_GROUP_ID, flush_window=MOD_NOTIFY_FLUSH_WINDOW)
+
+# Media submissions are reposted here; albums are batched into one send_media_group
+media_forwarder = MediaForwarder(TARGET_GROUP_ID, topic_message_id=MEDIA_TOPIC_ID, album_wait=MEDIA_ALBUM_WAIT)
+
+# Abuse limits per action type. More than 5 /start in an hour while pending gets the user banned;
+# the other actions are only throttled.
+rate_limiter = RateLimiter({
+    'start': Rule(SlidingWindow(limit=5, window=3600), on_exceed=BAN),
+    'callback': Rule(TokenBucket(capacity=30, refill_rate=1.0)),
+    'ticket': Rule(SlidingWindow(limit=5, window=3600)),
+    'media': Rule(TokenBucket(capacity=20, refill_rate=0.2)),
+}, max_entries=int(os.environ.get('RATE_LIMIT_MAX_ENTRIES', 100000)))
+# Seconds between checkpoints of the rate limiter state to the database
+RATE_LIMIT_CHECKPOINT_INTERVAL = int(os.environ.get('RATE_LIMIT_CHECKPOINT_INTERVAL', 30))
+
+# Membership is re-verified in the background: pending users when their cooldown
+# ends, members every MEMBERSHIP_FRESHNESS seconds. /start trusts a stored status
+# verified within that window and skips the Bot API call.
+MEMBERSHIP_FRESHNESS = int(os.environ.get('MEMBERSHIP_FRESHNESS', 6 * 3600))
+RECONCILE_INTERVAL = int(os.environ.get('RECONCILE_INTERVAL', 30))
+RECONCILE_BATCH = int(os.environ.get('RECONCILE_BATCH', 100))
+# getChatMember calls per second spent on re-verification
+RECONCILE_RATE = float(os.environ.get('RECONCILE_RATE', 5))
+
+# Bulk /ban, /unban and /approve commit this many users per transaction
+MODERATION_CHUNK_SIZE = int(os.environ.get('MODERATION_CHUNK_SIZE', 1000))
+# /export sends files up to this size as they are and gzips larger ones
+EXPORT_UPLOAD_LIMIT = int(os.environ.get('EXPORT_UPLOAD_LIMIT', 45 * 1024 * 1024))
+
+# Admin rights in the whitelist group: {user_id: bool}
+admin_cache = TTLCache(maxsize=1000, ttl=int(os.environ.get('ADMIN_CACHE_TTL', 300)))
+
+# Whitelist membership cache: {user_id: "member" | "not_member"}, kept fresh by chat_member updates
+membership_cache = TTLCache(
+    maxsize=int(os.environ.get('MEMBERSHIP_CACHE_SIZE', 50000)),
+    ttl=int(os.environ.get('MEMBERSHIP_CACHE_TTL', 600)),
+)
 
 # Buttons and Rows
 cancelbtn = [[InlineKeyboardButton("Cancel", callback_data='cancel')]]
@@ -47,25 +239,31 @@ row1 = [[InlineKeyboardButton("Open Ticket", callback_data='ticket'),
 # Functions
 async def log_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    logging.info(f"User {user.id} ({user.username}): {update.message.text}")
+    logger.info("User %s (%s): %s", user.id, user.username, update.message.text)
+
+async def handle_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Messages outside of any flow are only logged
+    await log_message(update, context)
 
 
 async def check_user_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     if update.message.chat.type == "private":
         user_id = update.effective_user.id
-        db_connection = connect_to_database()
-        if not db_connection:
-            print("Failed to connect to the database")
+        try:
+            user = await repository.get_user(user_id)
+        except DatabaseError as e:
+            logger.error("Failed to read user %s from the database: %s", user_id, e)
             return "error"
-
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT status, cooldown_until FROM users WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
+        # Queued status changes that are not committed yet still count
+        result = write_behind.apply_pending(user_id, (user.status, user.cooldown_until, user.verified_at) if user else None)
 
         now = datetime.now()
 
         if result:
-            user_status, cooldown_until = result
+            user_status, cooldown_until, verified_at = result
+            # A status verified recently is trusted without a Bot API call; a join
+            # or leave seen through chat_member since then still wins
+            fresh = verified_at is not None and (now - verified_at).total_seconds() < MEMBERSHIP_FRESHNESS
             if user_status == 'ban':
                 return 'ban'
             elif user_status == 'pending':
@@ -73,77 +271,85 @@ async def check_user_membership(update: Update, context: ContextTypes.DEFAULT_TY
                     remaining_seconds = int((cooldown_until - now).total_seconds())
                     return f"cooldown_{remaining_seconds}"
                 else:
-                    member_status = await get_whitelist_membership_status(context, user_id)
+                    if fresh and (cooldown_until is None or verified_at >= cooldown_until) and membership_cache.get(user_id) != "member":
+                        # Checked by the reconciler after the cooldown ended: still not a member
+                        member_status = "not_member"
+                    else:
+                        member_status = await get_whitelist_membership_status(context, user_id)
                     if member_status == "member":
-                        cursor.execute("UPDATE users SET status = %s WHERE user_id = %s", ('member', user_id))
-                        db_connection.commit()
+                        write_behind.enqueue(SetUserStatus(user_id, 'member'))
+                        write_behind.enqueue(SetUserVerified(user_id, now))
                         return "member"
                     else:
                         cooldown_until = now + timedelta(hours=6)
-                        cursor.execute("UPDATE users SET cooldown_until = %s WHERE user_id = %s", (cooldown_until, user_id))
-                        db_connection.commit()
+                        write_behind.enqueue(SetUserCooldown(user_id, cooldown_until))
+                        reconciler.schedule(user_id, cooldown_until)
                         return "pending_not_member"
             elif user_status == 'member':
+                if fresh and membership_cache.get(user_id) != "not_member":
+                    return 'member'
                 member_status = await get_whitelist_membership_status(context, user_id)
                 if member_status != "member":
-                    cursor.execute("UPDATE users SET status = %s WHERE user_id = %s", ('pending', user_id))
-                    db_connection.commit()
+                    write_behind.enqueue(SetUserStatus(user_id, 'pending'))
                     return "removed_member"
+                write_behind.enqueue(SetUserVerified(user_id, now))
                 return 'member'
         else:
             # User not found in the database, check if they are a member of the whitelist group
             member_status = await get_whitelist_membership_status(context, user_id)
             if member_status == "member":
-                try:
-                    cursor.execute("INSERT INTO users (user_id, status) VALUES (%s, 'member')", (user_id,))
-                    db_connection.commit()
-                    print(f"Added user {user_id} as 'member'.")
-                    return "member"
-                except mysql.connector.Error as e:
-                    print(f"Failed to insert user {user_id} into database: {e}")
-                    return "error"
+                write_behind.enqueue(AddMember(user_id))
+                write_behind.enqueue(SetUserVerified(user_id, now))
+                logger.info("Added user %s as 'member'.", user_id)
+                return "member"
             else:
                 # User is not a member of the whitelist group, return as "new_user"
                 return "new_user"
 
-        cursor.close()
-        db_connection.close()
         return "error"
 
 
+async def fetch_whitelist_membership_status(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str:
+    member = await context.bot.get_chat_member(WHITELIST_GROUP_ID, user_id)
+    if member.status in ['member', 'administrator', 'creator']:
+        return "member"
+    return "not_member"
+
 async def get_whitelist_membership_status(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> str:
     try:
-        member = await context.bot.get_chat_member(WHITELIST_GROUP_ID, user_id)
-        if member.status in ['member', 'administrator', 'creator']:
-            return "member"
+        return await membership_cache.get_or_load(user_id, lambda: fetch_whitelist_membership_status(context, user_id))
     except Exception as e:
-        print(f"Error checking whitelist membership: {e}")
+        logger.warning("Error checking whitelist membership: %s", e)
     return "not_member"
 
+async def track_whitelist_membership(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Joins and leaves in the whitelist group refresh the cache immediately
+    chat_member = update.chat_member
+    if str(chat_member.chat.id) != str(WHITELIST_GROUP_ID):
+        return
+    user_id = chat_member.new_chat_member.user.id
+    membership_cache.invalidate(user_id)
+    # Promotions and demotions arrive here too
+    admin_cache.invalidate(user_id)
+    if chat_member.new_chat_member.status in ['member', 'administrator', 'creator']:
+        membership_cache.set(user_id, "member")
+    else:
+        membership_cache.set(user_id, "not_member")
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.message.chat.type == "private":
         user_id = update.effective_user.id
         username = update.effective_user.username or "No username"
-        now = datetime.now()
-        topic_message_id = 149  # Replace with the actual ID of the topic message
         current_status = await check_user_membership(update, context)
 
         if current_status.startswith("pending") or current_status.startswith("cooldown_"):
         # Apply rate-limiting logic if user status starts with "pending"
-            user_data = start_command_usage.get(user_id, {'count': 0, 'last_usage': now - timedelta(hours=1)})
-            if now - user_data['last_usage'] < timedelta(hours=1):
-                user_data['count'] += 1
-                if user_data['count'] > 5:
-                    # Update the user's status to "ban" in the database
-                    await ban_user(user_id)
-                    notification_message = f"User @{username} (ID: {user_id}) has been banned for excessive usage."
-                    await context.bot.send_message(chat_id=TARGET_GROUP_ID, text=notification_message, reply_to_message_id=topic_message_id)
-                    return ConversationHandler.END
-            else:
-                user_data['count'] = 1  # Reset count if last usage was more than an hour ago
-            
-            user_data['last_usage'] = now
-            start_command_usage[user_id] = user_data
+            if rate_limiter.hit('start', user_id) == BAN:
+                # Update the user's status to "ban" in the database
+                await ban_user(user_id)
+                notification_message = f"User @{username} (ID: {user_id}) has been banned for excessive usage."
+                mod_notifier.notify(BANS_TOPIC_ID, notification_message)
+                return ConversationHandler.END
 
         status = await check_user_membership(update, context)
         if status in ["new_user", "removed_member"]:
@@ -176,48 +382,183 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             return ConversationHandler.END
 
 async def ban_user(user_id: int):
-        db_connection = connect_to_database()
-        if db_connection:
-            cursor = db_connection.cursor()
-            cursor.execute("UPDATE users SET status = 'ban' WHERE user_id = %s", (user_id,))
-            db_connection.commit()
-            cursor.close()
-            db_connection.close()
-
-async def unban_user(user_id: str, context: ContextTypes.DEFAULT_TYPE):
-    db_connection = connect_to_database()
-    if db_connection:
-        cursor = db_connection.cursor()
-        cursor.execute("UPDATE users SET status = 'pending' WHERE user_id = %s", (user_id,))
-        db_connection.commit()
-        cursor.close()
-        db_connection.close()
-
-async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.chat.type == "private":
-        # Assuming there's a predefined list or a specific chat where admin status is checked
-        admin_chat_id = WHITELIST_GROUP_ID  # The chat ID of your admin group
-        
-        user_id = update.effective_user.id
-        target_user_id = context.args[0] if context.args else None
+    write_behind.enqueue(SetUserStatus(user_id, 'ban'))
 
-        if not target_user_id:
-            await update.message.reply_text("Usage: /unban <user_id>")
-            return
+def reset_rate_limit(key: str) -> None:
+    action, user_id = key.split(':')
+    rate_limiter.reset(action, int(user_id))
+
+async def apply_catalog_version(version: str) -> None:
+    if int(version) != catalog.version:
+        await catalog.reload()
 
+def remember_ticket(key: str) -> None:
+    ticket_id, signature = key.split(':')
+    ticket_dedup.remember(int(signature), int(ticket_id))
+
+async def announce_tickets(batch) -> None:
+    # Write-behind commit listener: other workers learn the ids of new tickets
+    # so near-duplicates sent to them are counted on these too
+    keys = [f"{ticket.ticket_id}:{simhash(ticket.message)}" for ticket in batch if isinstance(ticket, InsertTicket)]
+    if keys:
+        await shared_store.publish_many('ticket', keys)
+
+async def announce_archived(ticket_ids) -> None:
+    # Archiver listener: every worker's in-memory search index drops the
+    # tickets, this one's included
+    await shared_store.publish_many('ticket_archived', ticket_ids)
+
+def forget_archived(key: str) -> None:
+    ticket_search.remove(int(key))
+
+def remember_media(key: str) -> None:
+    file_unique_id, phash = key.rsplit(':', 1)
+    media_index.remember(file_unique_id, int(phash) if phash else None)
+
+async def record_media(item: MediaItem) -> None:
+    # Only forwarded media counts as submitted: a failed repost can be sent again
+    try:
+        await media_index.add(item.file_unique_id, item.phash, item.user_id)
+        # Other workers check for duplicates too
+        await shared_store.publish('media', f"{item.file_unique_id}:{'' if item.phash is None else item.phash}")
+    except DatabaseError as e:
+        logger.error("Failed to record media %s: %s", item.file_unique_id, e)
+
+async def record_album(items, submitted: bool) -> None:
+    # Media forwarder listener: persists the items of an album that went out,
+    # releases those of one that did not
+    for item in items:
+        if submitted:
+            await record_media(item)
+        else:
+            media_index.forget(item.file_unique_id, item.phash)
+
+MODERATION_VERBS = {'ban': 'Banned', 'unban': 'Unbanned', 'approve': 'Approved'}
+
+async def read_user_ids(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # IDs come from the command arguments, or from the message the command
+    # replies to: its text, or an uploaded CSV or text file
+    text = " ".join(context.args or [])
+    csv_rows = False
+    replied = update.message.reply_to_message
+    if not text and replied is not None:
+        if replied.document is not None:
+            document = replied.document
+            telegram_file = await document.get_file()
+            text = bytes(await telegram_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+            csv_rows = (document.file_name or '').lower().endswith('.csv') or document.mime_type == 'text/csv'
+        else:
+            text = replied.text or ""
+    # Files can hold hundreds of thousands of lines; parse them off the event loop
+    return await asyncio.to_thread(parse_user_ids, text, csv_rows)
+
+async def moderation_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /ban, /unban and /approve with one or many user IDs
+    if update.message.chat.type != "private":
+        return
+    action = update.message.text.split()[0].lstrip('/').split('@')[0].lower()
+    if not await is_admin(context, update.effective_user.id):
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    try:
+        user_ids, invalid = await read_user_ids(update, context)
+    except TelegramError as e:
+        logger.error("Failed to download the ID list: %s", e)
+        await update.message.reply_text("Could not download that file.")
+        return
+    if not user_ids:
+        await update.message.reply_text(
+            f"Usage: /{action} <user_id> [<user_id> ...]\n"
+            f"Or reply with /{action} to a message or a CSV/text file listing the IDs."
+        )
+        return
+
+    status = await update.message.reply_text(f"{MODERATION_VERBS[action]} 0/{len(user_ids)} users…")
+    last_report = time.monotonic()
+
+    async def progress(done, total, changed):
+        # Edited at most every few seconds to stay clear of flood limits
+        nonlocal last_report
+        if done < total and time.monotonic() - last_report < 3:
+            return
+        last_report = time.monotonic()
         try:
-            # Check if the issuing user is an admin or creator in the admin group
-            admin_status = await context.bot.get_chat_member(admin_chat_id, user_id)
-            if admin_status.status not in ['administrator', 'creator']:
-                await update.message.reply_text("You do not have permission to use this command.")
-                return
-
-            # Proceed to unban the target user by setting their status to 'pending'
-            await unban_user(target_user_id, context)
-            await update.message.reply_text(f"User {target_user_id} has been unbanned and set to pending status.")
-        except Exception as e:
-            await update.message.reply_text("An error occurred while processing the unban command.")
-            print(f"Error in unban_command: {e}")
+            await status.edit_text(f"{MODERATION_VERBS[action]} {done}/{total} users… ({changed} changed)")
+        except TelegramError as e:
+            logger.debug("Progress update failed: %s", e)
+
+    # Written directly rather than through write_behind: a single batch would
+    # be far larger than max_batch and the progress could not be reported.
+    # Writes still queued for these users are committed first, or they would
+    # overwrite the bulk change. With WORKERS > 1 that covers the users whose
+    # updates this worker handles; the other workers' queues are not waited for.
+    await write_behind.settle(user_ids)
+    try:
+        changed = await apply_bulk(database, action, user_ids, progress, chunk_size=MODERATION_CHUNK_SIZE)
+    except DatabaseError as e:
+        logger.error("Bulk %s failed: %s", action, e)
+        await update.message.reply_text(f"An error occurred; users up to the last reported progress were {MODERATION_VERBS[action].lower()}.")
+        return
+    if action == 'unban':
+        # Start from a clean slate, otherwise the next /start bans them again.
+        # The limiters live in the users' workers, which need not be this one.
+        for chunk in chunks(user_ids, MODERATION_CHUNK_SIZE):
+            await shared_store.publish_many('rate_limit_reset', [f"start:{user_id}" for user_id in chunk])
+
+    summary = f"{MODERATION_VERBS[action]} {changed} of {len(user_ids)} users; the others were already in that state"
+    if action == 'approve':
+        summary += " or are banned"
+    summary += "."
+    if invalid:
+        summary += f"\nSkipped {len(invalid)} entries that are not user IDs: {', '.join(invalid[:10])}{'…' if len(invalid) > 10 else ''}"
+    await update.message.reply_text(summary)
+    admin = update.effective_user
+    mod_notifier.notify(BANS_TOPIC_ID, f"@{admin.username or admin.id} {action} x{changed} (of {len(user_ids)} listed)")
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /export users|tickets [csv|jsonl]
+    if update.message.chat.type != "private":
+        return
+    if not await is_admin(context, update.effective_user.id):
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    args = context.args or []
+    name = args[0].lower() if args else None
+    output_format = args[1].lower() if len(args) > 1 else 'csv'
+    if name not in EXPORTS or output_format not in EXPORT_FORMATS:
+        await update.message.reply_text(f"Usage: /export {'|'.join(EXPORTS)} [{'|'.join(EXPORT_FORMATS)}]")
+        return
+
+    await update.message.reply_text(f"Exporting {name}…")
+    filename = f"{name}-{datetime.now():%Y%m%d-%H%M%S}.{output_format}"
+    # Rows go straight to a temporary file; nothing but the current batch is held in memory
+    descriptor, path = tempfile.mkstemp(suffix='.' + output_format)
+    paths = [path]
+    try:
+        with open(descriptor, 'w', encoding='utf-8', newline='') as out:
+            count = await export_rows(database, name, output_format, out)
+        if os.path.getsize(path) > EXPORT_UPLOAD_LIMIT:
+            paths.append(path + '.gz')
+            await asyncio.to_thread(gzip_file, path, paths[-1])
+            filename += '.gz'
+        with open(paths[-1], 'rb') as document:
+            await update.message.reply_document(document, filename=filename, caption=f"{count} rows", read_timeout=300, write_timeout=300)
+    except DatabaseError as e:
+        logger.error("Export of %s failed: %s", name, e)
+        await update.message.reply_text("An error occurred while exporting.")
+    except TelegramError as e:
+        logger.error("Sending the %s export failed: %s", name, e)
+        await update.message.reply_text("The export could not be sent; it may be too large.")
+    finally:
+        for leftover in paths:
+            try:
+                os.remove(leftover)
+            except OSError:
+                pass
+
+def gzip_file(source, destination):
+    with open(source, 'rb') as plain, gzip.open(destination, 'wb') as compressed:
+        shutil.copyfileobj(plain, compressed)
 
 def build_group_selection_markup(groups, selected_groups):
     group_buttons = [InlineKeyboardButton(f"{'✓' if str(group[0]) in selected_groups else ''} {group[1]}", callback_data=f'group_{group[0]}') for group in groups]
@@ -230,11 +571,216 @@ def build_group_selection_markup(groups, selected_groups):
 
     return InlineKeyboardMarkup(keyboard)
 
+def build_selected_groups_text(groups, selected_groups):
+    if not selected_groups:
+        return "No groups selected."
+    return "You selected:\n" + "\n".join([group[1] for group in groups if str(group[0]) in selected_groups])
+
+def build_category_text(categories):
+    # Preparing a message with categories and their descriptions
+    categories_text = "Select a ticket category based on the descriptions below:\n\n"
+    for id, name, description in categories:
+        categories_text += f"*{name}*:\n{description}\n\n"
+    return categories_text
+
+def build_category_markup(categories):
+    # Prepare the keyboard for category selection
+    keyboard_buttons = [InlineKeyboardButton(category[1], callback_data=f"category_{category[0]}") for category in categories]
+    # Organizing two buttons per row
+    keyboard_rows = [keyboard_buttons[i:i+2] for i in range(0, len(keyboard_buttons), 2)]
+    # Adding the Cancel button in the last row
+    keyboard_rows.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
+    return InlineKeyboardMarkup(keyboard_rows)
+
+def render_group_selection(selected_groups):
+    # Keyboards and texts are cached per catalog version and selection bitmask
+    mask = catalog.selection_mask(selected_groups)
+    reply_markup = catalog.render('group_markup', lambda: build_group_selection_markup(catalog.groups, selected_groups), mask)
+    text = catalog.render('group_text', lambda: build_selected_groups_text(catalog.groups, selected_groups), mask)
+    return text, reply_markup
+
+async def fetch_admin_status(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    member = await context.bot.get_chat_member(WHITELIST_GROUP_ID, user_id)
+    return member.status in ['administrator', 'creator']
+
+async def is_admin(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> bool:
+    # Cached for ADMIN_CACHE_TTL; promotions and demotions seen through
+    # chat_member updates invalidate the entry right away
+    try:
+        return await admin_cache.get_or_load(user_id, lambda: fetch_admin_status(context, user_id))
+    except TelegramError as e:
+        # Failed lookups are not cached; the next command asks Telegram again
+        logger.warning("Failed to check admin status of %s: %s", user_id, e)
+        return False
+
+async def reload_catalog_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.chat.type == "private":
+        if not await is_admin(context, update.effective_user.id):
+            await update.message.reply_text("You do not have permission to use this command.")
+            return
+        try:
+            await catalog.bump_version()
+            await shared_store.publish('catalog', catalog.version)
+        except DatabaseError as e:
+            logger.error("Error reloading catalog: %s", e)
+            await update.message.reply_text("An error occurred while reloading the catalog.")
+            return
+        await update.message.reply_text(f"Catalog reloaded (version {catalog.version}): {len(catalog.groups)} groups, {len(catalog.categories)} categories.")
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.chat.type == "private":
+        if not await is_admin(context, update.effective_user.id):
+            await update.message.reply_text("You do not have permission to use this command.")
+            return
+        await update.message.reply_text(metrics.summary())
+
+async def show_ticket_page(context: ContextTypes.DEFAULT_TYPE, inbox: dict):
+    rows, has_next = await repository.page_tickets(inbox['filters'], inbox['cursors'][inbox['page']])
+    # Remember where the next page starts; only the cursor stack is kept, never an offset
+    inbox['next_cursor'] = page_cursor(rows) if rows else None
+    category_names = {category[0]: category[1] for category in catalog.categories}
+    return render_page(rows, inbox['page'], has_next, category_names, archived=inbox['filters'].get('archived', False))
+
+async def tickets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.chat.type == "private":
+        if not await is_admin(context, update.effective_user.id):
+            await update.message.reply_text("You do not have permission to use this command.")
+            return
+        try:
+            filters = parse_filters(context.args or [])
+        except FilterError as e:
+            await update.message.reply_text(f"{e}\nUsage: /tickets [category=<id>] [user=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [status=open|closed|all] [archived=yes|no]")
+            return
+
+        inbox = {'filters': filters, 'cursors': [None], 'page': 0}
+        try:
+            text, reply_markup = await show_ticket_page(context, inbox)
+        except DatabaseError as e:
+            logger.error("Error loading tickets: %s", e)
+            await update.message.reply_text("An error occurred while loading tickets.")
+            return
+        context.user_data['ticket_inbox'] = inbox
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def tickets_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not await is_admin(context, query.from_user.id):
+        await query.answer("You do not have permission to do this.")
+        return
+    inbox = context.user_data.get('ticket_inbox')
+    if inbox is None:
+        await query.answer("This list has expired. Run /tickets again.")
+        return
+
+    try:
+        if query.data == 'tickets_next' and inbox.get('next_cursor'):
+            inbox['cursors'].append(inbox['next_cursor'])
+            inbox['page'] += 1
+            await query.answer()
+        elif query.data == 'tickets_prev' and inbox['page'] > 0:
+            inbox['cursors'].pop()
+            inbox['page'] -= 1
+            await query.answer()
+        elif query.data.startswith('ticket_close_'):
+            ticket_id = int(query.data.split('_')[2])
+            closed = await repository.close_ticket(ticket_id, query.from_user.id)
+            ticket_dedup.forget(ticket_id)
+            await query.answer(f"Ticket #{ticket_id} closed." if closed else f"Ticket #{ticket_id} was already closed.")
+        else:
+            await query.answer()
+            return
+        text, reply_markup = await show_ticket_page(context, inbox)
+    except DatabaseError as e:
+        logger.error("Error loading tickets: %s", e)
+        await query.answer("An error occurred while loading tickets.")
+        return
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def similar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /similar <ticket id>: the near-duplicates folded into a ticket
+    if update.message.chat.type == "private":
+        if not await is_admin(context, update.effective_user.id):
+            await update.message.reply_text("You do not have permission to use this command.")
+            return
+        args = context.args or []
+        if len(args) != 1 or not args[0].lstrip('#').isdigit():
+            await update.message.reply_text("Usage: /similar <ticket id>")
+            return
+        ticket_id = int(args[0].lstrip('#'))
+        try:
+            rows = await database.fetch_all(COPIES_SQL, (ticket_id, COPIES_PAGE_SIZE))
+            (total,) = await database.fetch_one(COPIES_COUNT_SQL, (ticket_id,))
+        except DatabaseError as e:
+            logger.error("Error loading copies of ticket %s: %s", ticket_id, e)
+            await update.message.reply_text("An error occurred while loading the copies.")
+            return
+        await update.message.reply_text(render_copies(ticket_id, rows, total))
+
+async def show_search_page(context: ContextTypes.DEFAULT_TYPE, search: dict):
+    start = search['page'] * SEARCH_PAGE_SIZE
+    rows = await fetch_results(database, search['ids'][start:start + SEARCH_PAGE_SIZE])
+    category_names = {category[0]: category[1] for category in catalog.categories}
+    return render_results(search['query'], rows, search['page'], len(search['ids']), category_names)
+
+async def search_tickets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /searchtickets <words>: tickets ranked by relevance, matches highlighted
+    if update.message.chat.type == "private":
+        if not await is_admin(context, update.effective_user.id):
+            await update.message.reply_text("You do not have permission to use this command.")
+            return
+        query = " ".join(context.args or []).strip()
+        if not query:
+            await update.message.reply_text("Usage: /searchtickets <words>")
+            return
+
+        try:
+            # Only the ranked ids are kept; each page reads its rows by primary key
+            ranked = await ticket_search.search(query)
+            search = {'query': query, 'ids': [ticket_id for ticket_id, _ in ranked], 'page': 0}
+            text, reply_markup = await show_search_page(context, search)
+        except DatabaseError as e:
+            logger.error("Error searching tickets: %s", e)
+            await update.message.reply_text("An error occurred while searching tickets.")
+            return
+        context.user_data['ticket_search'] = search
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
+async def search_tickets_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not await is_admin(context, query.from_user.id):
+        await query.answer("You do not have permission to do this.")
+        return
+    search = context.user_data.get('ticket_search')
+    if search is None:
+        await query.answer("These results have expired. Run /searchtickets again.")
+        return
+
+    if query.data == 'search_next' and (search['page'] + 1) * SEARCH_PAGE_SIZE < len(search['ids']):
+        search['page'] += 1
+    elif query.data == 'search_prev' and search['page'] > 0:
+        search['page'] -= 1
+    else:
+        await query.answer()
+        return
+    try:
+        text, reply_markup = await show_search_page(context, search)
+    except DatabaseError as e:
+        logger.error("Error loading search results: %s", e)
+        await query.answer("An error occurred while loading the results.")
+        return
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='HTML')
+
+async def refresh_catalog(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Periodic job: one single-row query picks up edits made directly in the database
+    try:
+        await catalog.refresh_if_changed()
+    except DatabaseError as e:
+        logger.error("Error checking catalog version: %s", e)
+
 async def announcement_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.chat.type == "private":
-        user_id = update.effective_user.id
-        member = await context.bot.get_chat_member(WHITELIST_GROUP_ID, user_id)
-        if member.status in ['administrator', 'creator']:
+        if await is_admin(context, update.effective_user.id):
             await update.message.reply_text("Please send the announcement text.")
             return ANNOUNCEMENT  # Transition to the ANNOUNCEMENT state awaiting the text
         else:
@@ -246,37 +792,97 @@ async def capture_announcement_text(update: Update, context: ContextTypes.DEFAUL
     context.user_data['announcement'] = update.message.text
     
     # Show how the announcement will appear and ask for confirmation
-    confirmation_keyboard = [[InlineKeyboardButton("Send", callback_data='send_announcement'), InlineKeyboardButton("Cancel", callback_data='cancel')]]
+    confirmation_keyboard = [[InlineKeyboardButton("Send", callback_data='send_announcement'), InlineKeyboardButton("Cancel", callback_data='cancel')],
+                             [InlineKeyboardButton("Send + DM all members", callback_data='broadcast_announcement')]]
     reply_markup = InlineKeyboardMarkup(confirmation_keyboard)
     await update.message.reply_text (f"Preview:\n{update.message.text}", reply_markup=reply_markup)
     return DEFAULT_STATE  # Assuming you handle the confirmation in another state or reset/end the conversation
 
 async def submit_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    topic_message_id = 146
     category_id = context.user_data['selected_category_id']  # Set this when the user selects a category
     message = update.message.text  # The content of the ticket
 
-    db_connection = connect_to_database()
-    if not db_connection:
-        await update.message.reply_text("Failed to connect to the database. Please try again later.")
+    if rate_limiter.hit('ticket', user_id) != ALLOW:
+        await update.message.reply_text("You have submitted too many tickets. Please try again later.")
+        return
+
+    # The same complaint pasted again, by this user or others, is counted on the
+    # ticket already open instead of becoming another row and notification
+    signature = simhash(message) if ticket_dedup.enabled else None
+    match = ticket_dedup.find(signature) if signature is not None else None
+    if match is not None:
+        original, duplicates = match
+        # The copy is kept with the ticket so moderators can read it (/similar)
+        write_behind.enqueue(TicketDuplicate.of(original, user_id, message))
+        if duplicates in TICKET_DUPLICATE_ALERTS:
+            ticket_id = TicketDeduplicator.ticket_id(original)
+            mod_notifier.notify(
+                TICKETS_TOPIC_ID,
+                f"Ticket {f'#{ticket_id}' if ticket_id else 'just submitted'} has been sent again {duplicates} times; latest copy from @{update.effective_user.username}",
+            )
+        await update.message.reply_text("A similar ticket is already open; yours has been added to it.")
         return
-    
-    cursor = db_connection.cursor()
-    cursor.execute(
-        "INSERT INTO ticket (category_id, user_id, message) VALUES (%s, %s, %s)",
-        (category_id, user_id, message)
-    )
-    db_connection.commit()
-    cursor.close()
-    db_connection.close()
+
+    ticket = write_behind.enqueue(InsertTicket(category_id, user_id, message))
+    if signature is not None:
+        ticket_dedup.remember(signature, ticket)
 
     # Forward the ticket to the target group
     ticket_message = f"New ticket from @{update.effective_user.username} in category {category_id}: {message}"
-    await context.bot.send_message(chat_id=TARGET_GROUP_ID, text=ticket_message, reply_to_message_id=topic_message_id)
+    mod_notifier.notify(TICKETS_TOPIC_ID, ticket_message)
 
     await update.message.reply_text("Your ticket has been submitted.")
 
+async def receive_media(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    message = update.message
+    user = update.effective_user
+
+    if rate_limiter.hit('media', user.id) != ALLOW:
+        await message.reply_text("You are sending files too quickly. Please slow down.")
+        return IMAGE_PROCESSING
+
+    if message.photo:
+        photo = message.photo[-1]  # Largest size is reposted
+        kind, file_id, file_unique_id = 'photo', photo.file_id, photo.file_unique_id
+        hash_source = message.photo[0]  # Smallest size is enough to hash
+    else:
+        document = message.document
+        kind, file_id, file_unique_id = 'document', document.file_id, document.file_unique_id
+        hash_source = document_hash_source(document)
+
+    # Duplicates are rejected before anything is reposted
+    phash = None if media_index.find_duplicate(file_unique_id) else await perceptual_hash(hash_source)
+    duplicate = media_index.find_duplicate(file_unique_id, phash)
+    header = f"Submission from @{user.username} (ID: {user.id})" if user.username else f"Submission from {user.full_name} (ID: {user.id})"
+
+    if duplicate:
+        if message.media_group_id:
+            media_forwarder.add_to_album(context.bot, message.media_group_id, None, header, message.chat_id)
+        else:
+            await message.reply_text("This file has already been submitted.")
+        return IMAGE_PROCESSING
+
+    item = MediaItem(kind, file_id, message.caption, file_unique_id=file_unique_id, phash=phash, user_id=user.id)
+    # Held in memory while it is being forwarded, so a copy sent meanwhile is
+    # still caught; persisted only once it went out (see record_album)
+    media_index.remember(file_unique_id, phash)
+    if message.media_group_id:
+        # The album is confirmed once, after all its parts have arrived
+        media_forwarder.add_to_album(context.bot, message.media_group_id, item, header, message.chat_id)
+        return IMAGE_PROCESSING
+
+    try:
+        await media_forwarder.forward_single(context.bot, item, header)
+    except TelegramError as e:
+        logger.error("Failed to forward media %s: %s", file_unique_id, e)
+        media_index.forget(file_unique_id, phash)
+        await message.reply_text("Your file could not be submitted. Please try again later.")
+        return IMAGE_PROCESSING
+    await record_media(item)
+    await message.reply_text("Your file has been submitted. You can send more or press Cancel.")
+    return IMAGE_PROCESSING
+
 async def category_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -289,8 +895,11 @@ async def category_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
+    if rate_limiter.hit('callback', query.from_user.id) != ALLOW:
+        await query.answer("Too many requests. Please slow down.")
+        return None
     await query.answer()
-    print(f"Received callback data: {query.data}")  # Add logging or print statement
+    logger.info("Received callback data: %s", query.data)  # Sampled under load
 
     if query.data == 'cancel':
         context.user_data.clear()  # Optionally clear user data
@@ -304,20 +913,14 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         return IMAGE_PROCESSING
     
     elif query.data == 'groups_join':
-
-        db_connection = connect_to_database()
-        if not db_connection:
+        try:
+            await catalog.ensure_loaded()
+        except DatabaseError:
             await query.edit_message_text(text="Failed to connect to the database. Please try again later.")
             return JOIN_PROCESSING
 
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT group_id, group_name FROM groups_list")
-        groups = cursor.fetchall()
-        cursor.close()
-        db_connection.close()
-
         selected_groups = context.user_data.get('selected_groups', [])
-        reply_markup = build_group_selection_markup(groups, selected_groups)
+        _, reply_markup = render_group_selection(selected_groups)
         await query.edit_message_text(text="Select the groups you want to join:", reply_markup=reply_markup)
         return JOIN_PROCESSING
     
@@ -332,33 +935,27 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
         context.user_data['selected_groups'] = selected_groups
 
-        # Fetch groups again from the database for the updated markup
-        db_connection = connect_to_database()
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT group_id, group_name FROM groups_list")
-        groups = cursor.fetchall()
-        cursor.close()
-        db_connection.close()
+        # Groups come from the in-memory catalog; no database round trip per toggle
+        try:
+            await catalog.ensure_loaded()
+        except DatabaseError:
+            await query.edit_message_text(text="Failed to connect to the database. Please try again later.")
+            return JOIN_PROCESSING
 
-        groups_list_text = "You selected:\n" + "\n".join([group[1] for group in groups if str(group[0]) in selected_groups]) if selected_groups else "No groups selected."
-        reply_markup = build_group_selection_markup(groups, selected_groups)
+        groups_list_text, reply_markup = render_group_selection(selected_groups)
         await query.edit_message_text(text=groups_list_text, reply_markup=reply_markup)
         return JOIN_PROCESSING
     
     elif query.data == 'joinbtn':
         user_id = query.from_user.id
-        topic_message_id = 121
-
-        db_connection = connect_to_database()
 
-        if not db_connection:
-            print("Failed to connect to the database")
+        try:
+            user = await repository.get_user(user_id)
+        except DatabaseError as e:
+            logger.error("Failed to read user %s from the database: %s", user_id, e)
             await query.edit_message_text(text="An error occurred. Please try again later.")
             return ConversationHandler.END
-
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT cooldown_until FROM users WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
+        result = write_behind.apply_pending(user_id, (user.cooldown_until,) if user else None, ('cooldown_until',))
         
         now = datetime.now()
         if result and result[0] and now < result[0]:
@@ -375,9 +972,8 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             await query.edit_message_text(text=cooldown_message)
         else:
             cooldown_until = now + timedelta(hours=6)  # Adjust the cooldown duration as needed
-            cursor.execute("INSERT INTO users (user_id, status, cooldown_until) VALUES (%s, 'pending', %s) ON DUPLICATE KEY UPDATE status = 'pending', cooldown_until = %s", 
-                        (user_id, cooldown_until, cooldown_until))
-            db_connection.commit()
+            write_behind.enqueue(RequestJoin(user_id, cooldown_until))
+            reconciler.schedule(user_id, cooldown_until)
 
             if not query.from_user.username:
                 full_name = query.from_user.first_name + (" " + query.from_user.last_name if query.from_user.last_name else "")
@@ -385,16 +981,13 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             else:
                 mod_message = f"User ID: {user_id}, Username: @{query.from_user.username}, The user does not have a username. Please review their request"
 
-            await context.bot.send_message(chat_id=TARGET_GROUP_ID, text=mod_message, reply_to_message_id=topic_message_id)
+            mod_notifier.notify(JOIN_REQUESTS_TOPIC_ID, mod_message)
             await query.edit_message_text(text="Your request to join has been registered. Please wait for approval.")
 
-        cursor.close()
-        db_connection.close()
         return ConversationHandler.END
 
 
     elif query.data == 'submit':
-        topic_message_id = 124  # Ensure correct ID
         selected_groups = context.user_data.get('selected_groups', [])
         
         if not selected_groups:
@@ -402,153 +995,243 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             return JOIN_PROCESSING
 
         message_text = f"Username: @{query.from_user.username} selected the following groups: {' ,'.join(selected_groups)}"
-        await context.bot.send_message(chat_id=TARGET_GROUP_ID, text=message_text, reply_to_message_id=topic_message_id)
+        mod_notifier.notify(GROUP_SELECTIONS_TOPIC_ID, message_text)
         
         await query.edit_message_text(text="Your selections have been submitted.")
         context.user_data.clear()
         return DEFAULT_STATE
     
-    elif query.data == 'send_announcement':
+    elif query.data in ('send_announcement', 'broadcast_announcement'):
         announcement = context.user_data.get('announcement')
         if announcement:
             sent_message = await context.bot.send_message(chat_id=WHITELIST_GROUP_ID, text=announcement)
             # Pin the sent announcement message in the group
             await context.bot.pin_chat_message(chat_id=WHITELIST_GROUP_ID, message_id=sent_message.message_id, disable_notification=False)
-            await query.edit_message_text("Your announcement has been sent.")
+            if query.data == 'broadcast_announcement':
+                # DM every member in the background; progress is reported in this chat
+                try:
+                    job = await broadcaster.start(context.bot, query.message.chat_id, announcement)
+                except DatabaseError as e:
+                    logger.error("Failed to start broadcast: %s", e)
+                    await query.edit_message_text("Your announcement has been sent, but the DM broadcast could not be started.")
+                else:
+                    await query.edit_message_text(f"Your announcement has been sent. Broadcast #{job.id} to all members has started.")
+            else:
+                await query.edit_message_text("Your announcement has been sent.")
             context.user_data.clear()
             # Ensure the conversation state is reset or ended appropriately
             return DEFAULT_STATE  # Or return to DEFAULT_STATE if you have specific handling for it
         
     elif query.data == 'ticket':
-        db_connection = connect_to_database()
-        if not db_connection:
+        try:
+            await catalog.ensure_loaded()
+        except DatabaseError:
             await query.edit_message_text(text="Failed to connect to the database. Please try again later.")
             return DEFAULT_STATE  # Make sure this return is inside the if block
-        
-        cursor = db_connection.cursor()
-        cursor.execute("SELECT id, category_name, description FROM ticket_category")
-        categories = cursor.fetchall()
-        cursor.close()
-        db_connection.close()
-
-        # Preparing a message with categories and their descriptions
-        categories_text = "Select a ticket category based on the descriptions below:\n\n"
-        for id, name, description in categories:
-            categories_text += f"*{name}*:\n{description}\n\n"
+
+        categories_text = catalog.render('category_text', lambda: build_category_text(catalog.categories))
         
         # Edit the current message to show category names and descriptions
         await query.edit_message_text(text=categories_text, parse_mode='Markdown')
 
-        # Prepare the keyboard for category selection
-        keyboard_buttons = [InlineKeyboardButton(category[1], callback_data=f"category_{category[0]}") for category in categories]
-        # Organizing two buttons per row
-        keyboard_rows = [keyboard_buttons[i:i+2] for i in range(0, len(keyboard_buttons), 2)]
-        # Adding the Cancel button in the last row
-        keyboard_rows.append([InlineKeyboardButton("Cancel", callback_data='cancel')])
-
-        reply_markup = InlineKeyboardMarkup(keyboard_rows)
+        reply_markup = catalog.render('category_markup', lambda: build_category_markup(catalog.categories))
 
     # Sending a new message for category selection
     await query.message.reply_text("Please choose a category:", reply_markup=reply_markup)
 
 async def error(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    logging.error(f"Update {update} caused error {context.error}")
+    update_id = update.update_id if isinstance(update, Update) else None
+    logger.error("Update %s caused error %s", update_id, context.error, exc_info=context.error)
 
-def connect_to_database():
+def db_initialize():
+    # Applies pending schema migrations; when the schema is current this is a
+    # single-row read of schema_version
     try:
-        # Replace the placeholder values with your database connection details
-        connection = mysql.connector.connect(
-            host=os.environ.get('DB_CONNECTION'),
-            database=os.environ.get('DB_NAME'),
-            user=os.environ.get('DB_USER'),
-            password=os.environ.get('DB_PASSWORD')
-        )
-        if connection.is_connected():
-            return connection
-    except mysql.connector.Error as e:
-        print(f"Error connecting to MySQL: {e}")
-
-def execute_query(connection, query):
-    cursor = connection.cursor()
-    cursor.execute(query)
-    # For retrieval queries
-    records = cursor.fetchall()
-    for row in records:
-        print(row)
-    # Remember to close the cursor and connection if you're done using them
-    cursor.close()
+        version, applied = migrate(database)
+        if applied:
+            logger.info("Database schema migrated from version %d to %d.", version, applied[-1][0].version)
+    except DatabaseError as e:
+        logger.error("Error migrating the database schema: %s", e)
 
-def db_initialize():
-    # SQL statements to create tables
-    sql_statements = [
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT UNSIGNED NOT NULL PRIMARY KEY,
-            member_status VARCHAR(50) NOT NULL DEFAULT 'pending',
-            status VARCHAR(50) NOT NULL DEFAULT 'pending',  -- 'member', 'pending', or 'ban'
-            cooldown_until DATETIME NULL,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        );
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS groups_list (
-            group_id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
-            group_name VARCHAR(255) NOT NULL,
-            UNIQUE KEY unique_group_name (group_name)
-        );
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS ticket_category (
-            id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
-            category_name VARCHAR(255) NOT NULL,
-            UNIQUE KEY unique_category_name (category_name)
-        );
-        """,
-        """
-        CREATE TABLE IF NOT EXISTS ticket (
-            id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
-            category_id INT UNSIGNED NOT NULL,
-            user_id BIGINT UNSIGNED NOT NULL,
-            message TEXT NOT NULL,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (category_id) REFERENCES ticket_category(id) ON DELETE CASCADE,
-            FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
-        );
-        """
+
+async def reconcile_memberships(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # Unlike get_whitelist_membership_status, a failed lookup raises instead of
+    # counting as "not_member", so errors never demote anyone
+    async def check(user_id):
+        return await membership_cache.get_or_load(user_id, lambda: fetch_whitelist_membership_status(context, user_id))
+
+    try:
+        await reconciler.run(check)
+    except DatabaseError as e:
+        logger.error("Error reconciling memberships: %s", e)
+
+async def archive_old_rows(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await archiver.run()
+    except DatabaseError as e:
+        logger.error("Error archiving old rows: %s", e)
+
+async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # /archive shows retention progress; /archive run starts a pass right away
+    if update.message.chat.type != "private":
+        return
+    if not await is_admin(context, update.effective_user.id):
+        await update.message.reply_text("You do not have permission to use this command.")
+        return
+    try:
+        if context.args and context.args[0].lower() == 'run':
+            await update.message.reply_text("Archiving…")
+            tickets, users = await archiver.run()
+            await update.message.reply_text(f"Archived {tickets} tickets and deleted {users} stale pending users.")
+        sizes = await archiver.table_sizes()
+        await archiver.measure_lag()
+    except DatabaseError as e:
+        logger.error("Error in archive command: %s", e)
+        await update.message.reply_text("An error occurred while reading the archive status.")
+        return
+
+    lines = [
+        f"Policy: closed tickets {ARCHIVE_CLOSED_DAYS} days after closing or {ARCHIVE_MAX_AGE_DAYS} days after they were sent, "
+        f"pending users after {ARCHIVE_PENDING_USER_DAYS} days.",
+        f"Lag: {archiver.lag_seconds / 3600:.1f} h behind the policy.",
     ]
+    if archiver.last_run is not None:
+        run = archiver.last_run
+        lines.append(
+            f"Last run {run['finished_at']}: {run['tickets']} tickets, {run['users']} users "
+            f"in {run['seconds']}s ({run['rows_per_second']} rows/s)."
+        )
+    for table, rows, size in sizes:
+        lines.append(f"{table}: ~{rows or 0} rows, {(size or 0) / 1048576:.1f} MB")
+    lines.append("Archived tickets: /tickets archived=yes, /export archive")
+    await update.message.reply_text("\n".join(lines))
 
-    # Establish a database connection
-    connection = connect_to_database()
-    if connection is not None:
-        try:
-            for statement in sql_statements:
-                # Execute each SQL statement
-                execute_query(connection, statement)
-            print("Database initialized successfully.")
-        except mysql.connector.Error as e:
-            print(f"Error initializing the database: {e}")
-        finally:
-            # Ensure that the connection is closed
-            if connection.is_connected():
-                connection.close()
-                print("MySQL connection is closed")
-    else:
-        print("Failed to connect to the database.")
+async def checkpoint_rate_limits(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await rate_limiter.checkpoint(database)
+    except DatabaseError as e:
+        logger.error("Error checkpointing rate limits: %s", e)
 
+async def prune_shared_events(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await shared_store.prune()
+    except DatabaseError as e:
+        logger.error("Error pruning shared events: %s", e)
 
-def main():
+async def start_background_workers(application: Application) -> None:
+    if metrics_server is not None:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            logger.error("Failed to start the metrics endpoint: %s", e)
+    write_behind.start()
+    mod_notifier.start(application.bot)
+    try:
+        await shared_store.start()
+    except DatabaseError as e:
+        logger.error("Failed to start reading shared events: %s", e)
+    # The in-memory search index loads in the background; a search before it
+    # is done waits for it
+    application.create_task(start_ticket_search())
+    # Interrupted broadcasts are picked up by one process only
+    if WORKER_INDEX in (None, 0):
+        try:
+            await broadcaster.resume_all(application.bot)
+        except DatabaseError as e:
+            logger.error("Failed to resume broadcasts: %s", e)
 
-    # Initialize Application with your bot's token
-    application = Application.builder().token(TOKEN).build()
+async def start_ticket_search() -> None:
+    try:
+        await ticket_search.start()
+    except DatabaseError as e:
+        logger.error("Failed to load the ticket search index: %s", e)
+
+async def stop_background_workers(application: Application) -> None:
+    # Runs while the bot can still send, so queued notifications are not lost
+    await mod_notifier.stop()
+    await media_forwarder.stop(application.bot)
+    await broadcaster.stop()
+    await shared_store.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+async def shutdown_database(application: Application) -> None:
+    try:
+        await rate_limiter.checkpoint(database)
+    except DatabaseError as e:
+        logger.error("Error checkpointing rate limits: %s", e)
+    # Commit queued writes; whatever cannot be committed stays in the journal
+    await write_behind.close()
+    # Let queued queries finish and release the pooled connections
+    database.close()
+
+def register_gauges(application: Application, conversation_handler: ConversationHandler) -> None:
+    # Read when metrics are exported, never on the update path
+    metrics.gauge('conversations', conversation_states(conversation_handler, STATE_NAMES), label='state')
+    metrics.gauge('updates_in_flight', lambda: application.update_processor.in_flight)
+    metrics.gauge('users_waiting', lambda: application.update_processor.waiting_users)
+    metrics.gauge('db_pending_queries', lambda: database.pending)
+    metrics.gauge('persistence_pending_writes', lambda: application.persistence.pending_writes)
+    metrics.gauge('persistence_loaded_users', lambda: application.persistence.loaded)
+    metrics.gauge('write_behind_queue', lambda: len(write_behind))
+    metrics.gauge('write_behind_dead_letters', lambda: write_behind.dead_letters)
+    metrics.gauge('mod_notifications_pending', lambda: mod_notifier.pending)
+    metrics.gauge('media_albums_pending', lambda: media_forwarder.pending_albums)
+    metrics.gauge('broadcasts_running', lambda: len(broadcaster.jobs))
+    metrics.gauge('outbound_queue', application.bot.rate_limiter.queued, label='priority')
+    metrics.gauge('outbound', application.bot.rate_limiter.stats, label='stat')
+    metrics.gauge('rate_limit_entries', lambda: len(rate_limiter))
+    metrics.gauge('admin_cache', lambda: {key: value for key, value in admin_cache.stats().items() if key != 'maxsize'}, label='stat')
+    metrics.gauge('membership_cache', lambda: {key: value for key, value in membership_cache.stats().items() if key != 'maxsize'}, label='stat')
+    metrics.gauge('ticket_duplicates', lambda: {'tracked': len(ticket_dedup), 'matched': ticket_dedup.matched}, label='stat')
+    metrics.gauge('archive', archiver.stats, label='stat')
+    metrics.gauge('shared_events_received', lambda: shared_store.received)
+    metrics.gauge('membership_reconciler', reconciler.stats, label='stat')
+    if isinstance(ticket_search, InvertedIndex):
+        metrics.gauge('ticket_search_indexed', lambda: len(ticket_search))
+    metrics.gauge('catalog_render_cache', lambda: {key: value for key, value in catalog.stats().items() if key in ('size', 'hits', 'misses')}, label='stat')
+
+def build_application(request=None) -> Application:
+
+    # Initialize Application with your bot's token. Updates are processed concurrently,
+    # but each user's updates still run one after another.
+    # Conversation states and user_data survive restarts; each user's are loaded
+    # just before their first update instead of all at startup
+    persistence = LazyPersistence(database, update_interval=PERSISTENCE_INTERVAL)
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .persistence(persistence)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES, drain_timeout=SHUTDOWN_DRAIN_TIMEOUT, loader=persistence.load))
+        .post_init(start_background_workers)
+        .post_stop(stop_background_workers)
+        .post_shutdown(shutdown_database)
+    )
+    if request is not None:
+        # Alternative transport for the Bot API, e.g. the benchmark's fake server
+        builder = builder.get_updates_request(request)
+    else:
+        request = HTTPXRequest(connection_pool_size=256)
+    # Every outbound call is scheduled by priority within the flood limits;
+    # replies to users go before moderator and broadcast traffic
+    outbound = OutboundScheduler(
+        global_rate=OUTBOUND_GLOBAL_RATE, private_rate=OUTBOUND_PRIVATE_RATE, group_rate=OUTBOUND_GROUP_RATE,
+        burst=OUTBOUND_BURST, max_retries=OUTBOUND_MAX_RETRIES, metrics=metrics,
+    )
+    builder = builder.rate_limiter(outbound)
+    # Bot API calls are counted per method, with errors and RetryAfter responses
+    application = builder.request(InstrumentedRequest(request, metrics)).build()
     # Define the ConversationHandler
     conversation_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
+        entry_points=[CommandHandler('start', start), CommandHandler('announcement', announcement_command)],
         states={
             DEFAULT_STATE: [
+                CallbackQueryHandler(button_click, pattern='^imagebutton$'),
+                CallbackQueryHandler(category_selected, pattern='^category_'),
                 MessageHandler(filters.ALL & ~filters.COMMAND, handle_all,),
                 ],
             IMAGE_PROCESSING: [
-
+                MessageHandler(filters.PHOTO | filters.Document.ALL, receive_media),
                                ],
             JOIN_PROCESSING:[
                 CallbackQueryHandler(button_click, pattern='joinbtn'),
@@ -564,21 +1247,221 @@ def main():
                 
                 ],
         },
-        fallbacks=[CallbackQueryHandler(button_click, pattern='cancel')]
+        fallbacks=[CallbackQueryHandler(button_click, pattern='cancel')],
+        name='main',
+        persistent=True,
     )
 
     # Add ConversationHandler to the application
     application.add_handler(conversation_handler)
 
+    # Admin ticket inbox navigation; registered before the catch-all button handler
+    application.add_handler(CallbackQueryHandler(tickets_callback, pattern='^(tickets_|ticket_close_)'))
+    application.add_handler(CallbackQueryHandler(search_tickets_callback, pattern='^search_'))
+
     # Add CallbackQueryHandler for button interactions
     application.add_handler(CallbackQueryHandler(button_click,))
 
     # Set up error handling
     application.add_error_handler(error)
-    application.add_handler(CommandHandler("unban", unban_command))
+    application.add_handler(CommandHandler(["ban", "unban", "approve"], moderation_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(ChatMemberHandler(track_whitelist_membership, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(CommandHandler("reloadcatalog", reload_catalog_command))
+    application.add_handler(CommandHandler("tickets", tickets_command))
+    application.add_handler(CommandHandler("searchtickets", search_tickets_command))
+    application.add_handler(CommandHandler("similar", similar_command))
+    application.add_handler(CommandHandler("archive", archive_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    persistence.attach(application)
+
+    # Latency of every handler, per callback-data branch for button presses
+    instrument_handlers(application, metrics)
+    # Log lines written by a handler carry its update id, user id and name
+    correlate_handlers(application)
+    register_gauges(application, conversation_handler)
+
+    # Pick up catalog edits made outside the bot
+    application.job_queue.run_repeating(refresh_catalog, interval=CATALOG_REFRESH_INTERVAL, first=CATALOG_REFRESH_INTERVAL)
+    application.job_queue.run_repeating(checkpoint_rate_limits, interval=RATE_LIMIT_CHECKPOINT_INTERVAL, first=RATE_LIMIT_CHECKPOINT_INTERVAL)
+    application.job_queue.run_repeating(reconcile_memberships, interval=RECONCILE_INTERVAL, first=RECONCILE_INTERVAL)
+    if WORKER_INDEX == 0:
+        application.job_queue.run_repeating(prune_shared_events, interval=3600, first=3600)
+    if WORKER_INDEX in (None, 0):
+        application.job_queue.run_repeating(archive_old_rows, interval=ARCHIVE_INTERVAL, first=ARCHIVE_INTERVAL)
+
+    return application
 
-    application.run_polling()
+def main():
+    application = build_application()
+
+    # chat_member updates are only delivered when requested explicitly
+    if BOT_MODE == 'webhook':
+        # Telegram posts updates to WEBHOOK_URL, which the reverse proxy forwards to the local server
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
-if __name__ == "__main__":
+def supervise():
+    # Runs in the supervisor process: creates the schema once, then fetches
+    # updates and routes them to the worker processes
+    global database
+    database = Database.from_env()
+    db_initialize()
+    database.close()
+
+    supervisor = Supervisor(worker_main, WORKERS, metrics=metrics)
+    metrics.gauge('worker_queue', supervisor.queued, label='worker')
+    updater = Updater(Bot(TOKEN), asyncio.Queue())
+
+    async def start_ingress(updater):
+        # chat_member updates are only delivered when requested explicitly
+        if BOT_MODE == 'webhook':
+            await updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+            )
+        else:
+            await updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+    async def run():
+        if metrics_server is not None:
+            try:
+                await metrics_server.start()
+            except OSError as e:
+                logger.error("Failed to start the metrics endpoint: %s", e)
+        try:
+            await supervisor.serve(updater, start_ingress)
+        finally:
+            if metrics_server is not None:
+                await metrics_server.stop()
+
+    logger.info("Supervising %d workers", WORKERS)
+    asyncio.run(run())
+
+def worker_main(updates, parent_pid):
+    # Entry point of a worker process. Signals are left to the supervisor,
+    # which tells the workers to stop once it no longer fetches updates.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    log_pipeline = start_logging()
+    try:
+        bootstrap(Database.from_env(metrics=metrics))
+        asyncio.run(serve_worker(build_application(), updates, parent_pid))
+    finally:
+        log_pipeline.stop()
+
+def bootstrap(db: Database) -> None:
+    # Creates the shared state every handler relies on. Runs before the event loop starts.
+    global database, write_behind, catalog, broadcaster, media_index, shared_store, reconciler, ticket_search, ticket_dedup, archiver, repository
+
+    # One shared, bounded connection pool for every handler
+    database = db
+    repository = repository_from_env(database)
+    if not isinstance(repository, MySQLRepository):
+        # The rest of the bot still needs MySQL; see repository.py
+        logger.critical("STORAGE_BACKEND=%s is not supported by the bot yet, only by the repository tests", os.environ.get('STORAGE_BACKEND'))
+        raise SystemExit(1)
     db_initialize()
-    main()
+    # Replay writes that were queued but not committed before the last shutdown
+    write_behind = WriteBehind(
+        database, WRITE_BEHIND_JOURNAL, max_batch=WRITE_BEHIND_MAX_BATCH, max_latency=WRITE_BEHIND_MAX_LATENCY,
+        checkpoint_id=1 + (WORKER_INDEX or 0),
+    )
+    try:
+        write_behind.recover()
+    except DatabaseError as e:
+        # Without the checkpoint, replaying the journal could double-apply writes
+        logger.critical("Failed to read the write-behind checkpoint, not starting: %s", e)
+        raise SystemExit(1)
+    # Groups and ticket categories are served from memory from here on
+    catalog = Catalog(database)
+    try:
+        catalog.load()
+    except DatabaseError as e:
+        logger.warning("Failed to load the catalog, it will be loaded on first use: %s", e)
+    # Rate limits survive restarts; a worker only needs those of its own users
+    try:
+        rate_limiter.load(database, shard=(WORKER_INDEX, WORKERS) if WORKER_INDEX is not None else None)
+    except DatabaseError as e:
+        logger.warning("Failed to restore rate limits: %s", e)
+    broadcaster = Broadcaster(database, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY)
+    # Membership re-verification for this process's users
+    reconciler = Reconciler(
+        database, freshness=MEMBERSHIP_FRESHNESS, batch=RECONCILE_BATCH, rate=RECONCILE_RATE,
+        shard=(WORKER_INDEX, WORKERS) if WORKER_INDEX is not None else None, overlay=write_behind.apply_pending,
+    )
+    # Duplicate detection for media submissions
+    media_index = MediaIndex(database, max_distance=MEDIA_HASH_DISTANCE)
+    if not PERCEPTUAL_HASHING:
+        logger.warning("Pillow is not installed: only exact duplicate media are detected, not re-encoded copies")
+    try:
+        media_index.load()
+    except DatabaseError as e:
+        logger.warning("Failed to load the media index: %s", e)
+    media_forwarder.listeners.append(record_album)
+    archiver = Archiver(
+        database, closed_days=ARCHIVE_CLOSED_DAYS, max_age_days=ARCHIVE_MAX_AGE_DAYS,
+        pending_user_days=ARCHIVE_PENDING_USER_DAYS, batch=ARCHIVE_BATCH, metrics=metrics,
+    )
+    # Near-duplicate detection for tickets
+    ticket_dedup = TicketDeduplicator(database, max_distance=TICKET_DUPLICATE_DISTANCE, window=TICKET_DUPLICATE_WINDOW)
+    try:
+        ticket_dedup.load()
+    except DatabaseError as e:
+        logger.warning("Failed to load recent tickets for duplicate detection: %s", e)
+    ticket_search = InvertedIndex(database) if SEARCH_BACKEND == 'memory' else FulltextSearch(database)
+    # Changes to in-memory copies of global state reach the other workers;
+    # a single process needs no more than the local stand-in
+    if WORKER_INDEX is None:
+        shared_store = LocalStore()
+    else:
+        shared_store = DatabaseStore(database, origin=WORKER_INDEX, poll_interval=SHARED_POLL_INTERVAL)
+    shared_store.subscribe('catalog', apply_catalog_version)
+    shared_store.subscribe('rate_limit_reset', reset_rate_limit)
+    shared_store.subscribe('media', remember_media)
+    if isinstance(ticket_search, InvertedIndex):
+        shared_store.subscribe('ticket_archived', forget_archived)
+        archiver.listeners.append(announce_archived)
+    if WORKER_INDEX is not None and ticket_dedup.enabled:
+        shared_store.subscribe('ticket', remember_ticket)
+        write_behind.listeners.append(announce_tickets)
+
+def start_logging():
+    log_pipeline = setup_logging(
+        LOG_FILE,
+        level=LOG_LEVEL,
+        max_bytes=LOG_MAX_BYTES,
+        backup_count=LOG_BACKUPS,
+        interval=LOG_ROTATE_INTERVAL,
+        sample_rate=LOG_SAMPLE_RATE,
+        console=LOG_CONSOLE,
+    )
+    metrics.gauge('log_queue', lambda: log_pipeline.queued)
+    metrics.gauge('log_records_dropped', lambda: log_pipeline.dropped)
+    metrics.gauge('log_records_suppressed', lambda: log_pipeline.sampler.suppressed)
+    return log_pipeline
+
+if __name__ == "__main__":
+    log_pipeline = start_logging()
+    try:
+        if WORKERS > 1:
+            # The workers bootstrap themselves
+            supervise()
+        else:
+            bootstrap(Database.from_env(metrics=metrics))
+            main()
+    finally:
+        # Write out whatever is still queued
+        log_pipeline.stop()
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from database import DatabaseError
+from outbound import BULK
+
+logger = logging.getLogger(__name__)
+
+CREATE_SQL = "INSERT INTO broadcast (admin_chat_id, message) VALUES (%s, %s)"
+RUNNING_SQL = "SELECT id, admin_chat_id, message, last_user_id, sent, failed FROM broadcast WHERE status = 'running'"
+REMAINING_SQL = "SELECT COUNT(*) FROM users WHERE status = 'member' AND user_id > %s"
+RECIPIENTS_SQL = "SELECT user_id FROM users WHERE status = 'member' AND user_id > %s ORDER BY user_id"
+CHECKPOINT_SQL = "UPDATE broadcast SET last_user_id = %s, sent = %s, failed = %s WHERE id = %s"
+FINISH_SQL = "UPDATE broadcast SET status = 'done', sent = %s, failed = %s, finished_at = NOW() WHERE id = %s"
+FAILURE_SQL = "INSERT IGNORE INTO broadcast_failure (broadcast_id, user_id, reason) VALUES (%s, %s, %s)"
+
+
+class BroadcastJob:
+    def __init__(self, broadcast_id, admin_chat_id, message, last_user_id=0, sent=0, failed=0):
+        self.id = broadcast_id
+        self.admin_chat_id = admin_chat_id
+        self.message = message
+        self.last_user_id = last_user_id
+        self.sent = sent
+        self.failed = failed
+        self.remaining = None
+        self.started_at = time.monotonic()
+        self.sent_at_start = sent + failed
+        self.status_message_id = None
+        self.paused_until = 0.0
+
+    def progress_text(self):
+        done = self.sent + self.failed - self.sent_at_start
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        rate = done / elapsed
+        text = f"Broadcast #{self.id}: {self.sent} sent, {self.failed} failed"
+        if self.remaining is not None:
+            left = max(self.remaining - done, 0)
+            text += f", {left} remaining"
+            if rate > 0 and left:
+                eta = int(left / rate)
+                text += f", {rate:.1f} msg/s, ETA {eta // 3600}h {eta % 3600 // 60}m {eta % 60}s"
+        return text
+
+
+class Broadcaster:
+    # DMs an announcement to every member, paced below the Bot API's global
+    # limit. Each recipient is checkpointed *before* the message goes out, so a
+    # resumed broadcast never sends twice; at worst a message that was in flight
+    # during a crash is skipped.
+
+    def __init__(self, database, rate=20.0, concurrency=8, batch_size=500, report_interval=10.0, retry_delay=1.0):
+        self.database = database
+        self.rate = rate
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self.retry_delay = retry_delay
+        self.jobs = {}  # broadcast id -> BroadcastJob
+        self._tasks = {}
+        self._bot = None
+        self._send_args = {}
+
+    async def start(self, bot, admin_chat_id, message):
+        broadcast_id = await self.database.run(_insert_broadcast, admin_chat_id, message)
+        job = BroadcastJob(broadcast_id, admin_chat_id, message)
+        self._launch(bot, job)
+        return job
+
+    async def resume_all(self, bot):
+        # Picks up broadcasts interrupted by a restart
+        for row in await self.database.fetch_all(RUNNING_SQL):
+            job = BroadcastJob(*row)
+            logger.info("Resuming broadcast #%s after user %s", job.id, job.last_user_id)
+            self._launch(bot, job)
+
+    def _launch(self, bot, job):
+        self._bot = bot
+        # With the outbound scheduler, broadcast traffic yields to everything else
+        self._send_args = {'rate_limit_args': {'priority': BULK}} if getattr(bot, 'rate_limiter', None) else {}
+        self.jobs[job.id] = job
+        self._tasks[job.id] = asyncio.get_running_loop().create_task(self._run(job))
+
+    async def stop(self):
+        # Interrupted broadcasts stay 'running' in the database and resume on the next start
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    async def _run(self, job):
+        try:
+            row = await self.database.fetch_one(REMAINING_SQL, (job.last_user_id,))
+            job.remaining = row[0] if row else None
+            await self._report(job)
+            await self._deliver(job)
+            await self.database.execute(FINISH_SQL, (job.sent, job.failed, job.id))
+            await self._report(job, finished=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Broadcast #%s stopped: %s", job.id, e)
+            await self._notify_admin(job, f"Broadcast #{job.id} stopped with an error and will resume on restart: {e}")
+        finally:
+            self.jobs.pop(job.id, None)
+            self._tasks.pop(job.id, None)
+
+    async def _deliver(self, job):
+        slots = asyncio.Semaphore(self.concurrency)
+        interval = 1.0 / self.rate
+        next_send = time.monotonic()
+        last_report = time.monotonic()
+        pending = set()
+        while True:
+            try:
+                async for batch in self.database.stream(RECIPIENTS_SQL, (job.last_user_id,), self.batch_size):
+                    for (user_id,) in batch:
+                        # Global pacing: one send every `interval` seconds, and
+                        # nothing at all while Telegram has asked us to back off
+                        delay = max(next_send, job.paused_until) - time.monotonic()
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                        next_send = max(next_send + interval, time.monotonic())
+
+                        await self._checkpoint(job, user_id)
+                        await slots.acquire()
+                        task = asyncio.get_running_loop().create_task(self._send(job, user_id, slots))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+
+                        if time.monotonic() - last_report >= self.report_interval:
+                            last_report = time.monotonic()
+                            await self._report(job)
+                break
+            except DatabaseError as e:
+                # A dropped stream restarts from the checkpoint
+                logger.warning("Broadcast #%s recipient stream failed, reopening: %s", job.id, e)
+                await asyncio.sleep(self.retry_delay)
+        if pending:
+            await asyncio.gather(*pending)
+
+    async def _checkpoint(self, job, user_id):
+        # Retried until it sticks: nobody is sent to without a checkpoint, and
+        # the open recipient stream can simply wait
+        while True:
+            try:
+                await self.database.execute(CHECKPOINT_SQL, (user_id, job.sent, job.failed, job.id))
+                job.last_user_id = user_id
+                return
+            except DatabaseError as e:
+                logger.warning("Broadcast #%s checkpoint failed, retrying: %s", job.id, e)
+                await asyncio.sleep(self.retry_delay)
+
+    async def _send(self, job, user_id, slots):
+        try:
+            while True:
+                try:
+                    await self._bot.send_message(chat_id=user_id, text=job.message, **self._send_args)
+                    job.sent += 1
+                    return
+                except RetryAfter as e:
+                    retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                    job.paused_until = max(job.paused_until, time.monotonic() + retry_after)
+                    await asyncio.sleep(retry_after)
+                except Forbidden as e:
+                    # "bot was blocked by the user" or "user is deactivated"
+                    reason = 'deactivated' if 'deactivated' in e.message.lower() else 'blocked'
+                    await self._record_failure(job, user_id, reason)
+                    return
+                except BadRequest as e:
+                    reason = 'not_found' if 'not found' in e.message.lower() else 'bad_request'
+                    await self._record_failure(job, user_id, reason)
+                    return
+                except TelegramError as e:
+                    logger.warning("Broadcast #%s to %s failed: %s", job.id, user_id, e)
+                    await self._record_failure(job, user_id, 'error')
+                    return
+        finally:
+            slots.release()
+
+    async def _record_failure(self, job, user_id, reason):
+        job.failed += 1
+        try:
+            await self.database.execute(FAILURE_SQL, (job.id, user_id, reason))
+        except DatabaseError as e:
+            logger.error("Failed to record broadcast failure for %s: %s", user_id, e)
+
+    async def _report(self, job, finished=False):
+        text = job.progress_text()
+        if finished:
+            text = f"Finished. {text}"
+        try:
+            if job.status_message_id is None:
+                message = await self._bot.send_message(chat_id=job.admin_chat_id, text=text, **self._send_args)
+                job.status_message_id = message.message_id
+            else:
+                await self._bot.edit_message_text(
+                    chat_id=job.admin_chat_id, message_id=job.status_message_id, text=text, **self._send_args
+                )
+        except TelegramError as e:
+            # Progress reports are best effort ("message is not modified" etc.)
+            logger.debug("Broadcast #%s progress report failed: %s", job.id, e)
+
+    async def _notify_admin(self, job, text):
+        try:
+            await self._bot.send_message(chat_id=job.admin_chat_id, text=text)
+        except TelegramError:
+            pass
+
+
+def _insert_broadcast(cursor, admin_chat_id, message):
+    cursor.execute(CREATE_SQL, (admin_chat_id, message))
+    return cursor.lastrowid
@@ -0,0 +1,98 @@
+import logging
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+GROUPS_SQL = "SELECT group_id, group_name FROM groups_list ORDER BY group_id"
+CATEGORIES_SQL = "SELECT id, category_name, description FROM ticket_category ORDER BY id"
+VERSION_SQL = "SELECT version FROM catalog_version WHERE id = 1"
+BUMP_VERSION_SQL = "UPDATE catalog_version SET version = version + 1 WHERE id = 1"
+
+
+class Catalog:
+    # Read-through copy of groups_list and ticket_category. Both tables are
+    # loaded whole and only reloaded when catalog_version.version changes, so
+    # menu rendering never touches the database on the hot path.
+
+    def __init__(self, database, render_cache_size=4096):
+        self.database = database
+        self.version = None
+        self.groups = []
+        self.categories = []
+        self._group_bits = {}
+        # Rendered keyboards/texts keyed by (version, name, selection bitmask)
+        self._rendered = TTLCache(maxsize=render_cache_size, ttl=float('inf'))
+
+    @property
+    def loaded(self):
+        return self.version is not None
+
+    def _read(self, cursor):
+        # The version is read first: a concurrent edit then at worst causes one
+        # extra reload on the next check, never a stale catalog under a new version.
+        cursor.execute(VERSION_SQL)
+        row = cursor.fetchone()
+        version = row[0] if row else 0
+        cursor.execute(GROUPS_SQL)
+        groups = cursor.fetchall()
+        cursor.execute(CATEGORIES_SQL)
+        categories = cursor.fetchall()
+        return version, groups, categories
+
+    def _install(self, version, groups, categories):
+        self.groups = [tuple(group) for group in groups]
+        self.categories = [tuple(category) for category in categories]
+        self._group_bits = {str(group[0]): bit for bit, group in enumerate(self.groups)}
+        self._rendered.clear()
+        self.version = version
+        logger.info("Catalog version %s loaded: %d groups, %d categories", version, len(self.groups), len(self.categories))
+
+    def load(self):
+        # Synchronous load used at startup, before the event loop runs
+        self._install(*self.database.call(self._read))
+
+    async def reload(self):
+        self._install(*await self.database.run(self._read))
+
+    async def ensure_loaded(self):
+        if not self.loaded:
+            await self.reload()
+
+    async def refresh_if_changed(self):
+        row = await self.database.fetch_one(VERSION_SQL)
+        version = row[0] if row else 0
+        if version != self.version:
+            await self.reload()
+            return True
+        return False
+
+    async def bump_version(self):
+        await self.database.execute(BUMP_VERSION_SQL)
+        await self.reload()
+
+    def selection_mask(self, selected_groups):
+        mask = 0
+        for group_id in selected_groups:
+            bit = self._group_bits.get(str(group_id))
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def render(self, name, builder, mask=0):
+        # Returns builder() for this catalog version, building it at most once
+        key = (self.version, name, mask)
+        missing = object()
+        rendered = self._rendered.get(key, missing)
+        if rendered is missing:
+            self._rendered.misses += 1
+            rendered = builder()
+            self._rendered.set(key, rendered)
+        else:
+            self._rendered.hits += 1
+        return rendered
+
+    def stats(self):
+        stats = self._rendered.stats()
+        stats['version'] = self.version
+        return stats
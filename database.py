@@ -0,0 +1,253 @@
+import os
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+
+import mysql.connector
+from mysql.connector import pooling
+
+logger = logging.getLogger(__name__)
+
+# Pool settings; the executor gets exactly one thread per pooled connection so
+# a query never has to wait for a connection once it is running on a thread.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_PING_ATTEMPTS = int(os.environ.get('DB_PING_ATTEMPTS', 2))
+# Streams may be read slowly (e.g. paced broadcasts), so the server is told to
+# wait this long for the client before aborting an unbuffered result.
+DB_STREAM_WRITE_TIMEOUT = int(os.environ.get('DB_STREAM_WRITE_TIMEOUT', 3600))
+
+
+class DatabaseError(Exception):
+    pass
+
+
+# Server errors that go away when the same statements are simply tried again:
+# too many connections, server shutting down, lock wait timeout, deadlock,
+# query interrupted, connection killed. Client-side errors (2000-2999) are
+# lost or refused connections and count as transient too.
+TRANSIENT_ERRNOS = {1040, 1053, 1205, 1213, 1317, 1927}
+
+
+def is_transient(error):
+    # False only for errors the server will raise again for the same input
+    # (constraint violations, bad values, SQL errors); anything without a
+    # server error number behind it is assumed to be a connection problem
+    errno = getattr(error.__cause__, 'errno', None)
+    if errno is None or errno < 0:
+        return True
+    return errno in TRANSIENT_ERRNOS or 2000 <= errno < 3000
+
+
+_labels = {}
+_LABEL_CACHE_SIZE = 1024
+
+
+def statement_label(sql):
+    # Low-cardinality metric label for a statement: verb and first table,
+    # e.g. 'select users' or 'insert ticket'
+    label = _labels.get(sql)
+    if label is None:
+        words = [word for word in sql.split() if word.upper() not in ('IF', 'NOT', 'EXISTS')]
+        verb = words[0].lower() if words else ''
+        table = ''
+        for keyword, name in zip(words, words[1:]):
+            if keyword.upper() in ('FROM', 'INTO', 'UPDATE', 'TABLE'):
+                table = name.strip('`(').lower()
+                break
+        label = f"{verb} {table}".strip()
+        if len(_labels) < _LABEL_CACHE_SIZE:
+            _labels[sql] = label
+    return label
+
+
+class TimedCursor:
+    # Cursor wrapper recording the duration of every statement
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(sql, params)
+        finally:
+            self._metrics.observe('sql_seconds', time.perf_counter() - started, statement=statement_label(sql))
+
+    def executemany(self, sql, seq_of_params):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(sql, seq_of_params)
+        finally:
+            self._metrics.observe('sql_seconds', time.perf_counter() - started, statement=statement_label(sql))
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class Database:
+    def __init__(self, pool_size=DB_POOL_SIZE, metrics=None, **connect_kwargs):
+        self.pool_size = pool_size
+        self.metrics = metrics
+        self.pending = 0  # queries queued or running on the executor
+        self._connect_kwargs = connect_kwargs
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+
+    @classmethod
+    def from_env(cls, metrics=None):
+        return cls(
+            metrics=metrics,
+            host=os.environ.get('DB_CONNECTION'),
+            database=os.environ.get('DB_NAME'),
+            user=os.environ.get('DB_USER'),
+            password=os.environ.get('DB_PASSWORD'),
+        )
+
+    def _get_pool(self):
+        # The pool is created lazily so a database outage at import time does
+        # not take the bot down; the first query retries instead.
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = pooling.MySQLConnectionPool(
+                        pool_name='bot_pool',
+                        pool_size=self.pool_size,
+                        pool_reset_session=True,
+                        **self._connect_kwargs
+                    )
+        return self._pool
+
+    def _acquire(self):
+        try:
+            connection = self._get_pool().get_connection()
+        except mysql.connector.Error as e:
+            raise DatabaseError(f"Could not get a pooled connection: {e}") from e
+        # Health check: pooled connections can be dropped by the server while idle.
+        try:
+            connection.ping(reconnect=True, attempts=DB_PING_ATTEMPTS, delay=0.2)
+        except mysql.connector.Error as e:
+            connection.close()
+            raise DatabaseError(f"Pooled connection failed health check: {e}") from e
+        return connection
+
+    def call(self, fn, *args):
+        # Runs fn(cursor, *args) inside one transaction on a pooled connection.
+        # The connection always goes back to the pool, whatever happens in fn.
+        started = time.perf_counter()
+        connection = self._acquire()
+        if self.metrics is not None:
+            self.metrics.observe('db_acquire_seconds', time.perf_counter() - started)
+        try:
+            cursor = connection.cursor()
+            if self.metrics is not None:
+                cursor = TimedCursor(cursor, self.metrics)
+            try:
+                result = fn(cursor, *args)
+                connection.commit()
+                return result
+            except mysql.connector.Error as e:
+                connection.rollback()
+                raise DatabaseError(str(e)) from e
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+        finally:
+            connection.close()
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self._executor, self.call, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def fetch_one(self, sql, params=()):
+        def query(cursor):
+            cursor.execute(sql, params)
+            return cursor.fetchone()
+        return await self.run(query)
+
+    async def fetch_all(self, sql, params=()):
+        def query(cursor):
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        return await self.run(query)
+
+    async def execute(self, sql, params=()):
+        def query(cursor):
+            cursor.execute(sql, params)
+            return cursor.rowcount
+        return await self.run(query)
+
+    async def execute_many(self, sql, seq_of_params):
+        def query(cursor):
+            cursor.executemany(sql, seq_of_params)
+            return cursor.rowcount
+        return await self.run(query)
+
+    async def stream(self, sql, params=(), batch_size=1000):
+        # Yields lists of rows from a server-side (unbuffered) cursor, so large
+        # results are never held in memory at once. Streams can stay open for a
+        # long time, so they use their own connection instead of a pooled one.
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def put(item):
+            try:
+                asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()
+            except (CancelledError, RuntimeError):
+                # The consumer's loop was shut down (or closed) under a waiting
+                # batch after an early stop; there is nobody left to read it
+                stop.set()
+
+        def produce():
+            try:
+                connection = mysql.connector.connect(**self._connect_kwargs)
+            except mysql.connector.Error as e:
+                put(DatabaseError(str(e)))
+                return
+            try:
+                cursor = connection.cursor()
+                cursor.execute("SET SESSION net_write_timeout = %s", (DB_STREAM_WRITE_TIMEOUT,))
+                cursor.close()
+                cursor = connection.cursor(buffered=False)
+                cursor.execute(sql, params)
+                while not stop.is_set():
+                    rows = cursor.fetchmany(batch_size)
+                    put(rows)
+                    if not rows:
+                        break
+            except mysql.connector.Error as e:
+                put(DatabaseError(str(e)))
+            finally:
+                try:
+                    connection.close()
+                except mysql.connector.Error:
+                    # Closing with unread rows after an early stop is expected to complain
+                    pass
+
+        threading.Thread(target=produce, name='db-stream', daemon=True).start()
+        try:
+            while True:
+                rows = await batches.get()
+                if isinstance(rows, DatabaseError):
+                    raise rows
+                if not rows:
+                    return
+                yield rows
+        finally:
+            # Unblock the producer if the consumer stopped early
+            stop.set()
+            while not batches.empty():
+                batches.get_nowait()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        logger.info("Database executor shut down")
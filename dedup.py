@@ -0,0 +1,160 @@
+import hashlib
+import itertools
+import logging
+import re
+import time
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+RECENT_SQL = "SELECT id, message, timestamp FROM ticket WHERE status = 'open' AND timestamp >= %s ORDER BY timestamp"
+
+SHINGLE_SIZE = 4  # characters
+MAX_SIGNED_LENGTH = 4000  # longer messages are signed on their start
+_NOISE_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def simhash(text):
+    # 64-bit SimHash over character 4-grams of the normalised text (lower
+    # case, runs of punctuation and spaces collapsed). Texts that share most
+    # of their shingles end up a few bits apart, so a pasted complaint with a
+    # changed greeting or typo still matches.
+    normalised = _NOISE_PATTERN.sub(' ', text[:MAX_SIGNED_LENGTH].lower()).strip()
+    if len(normalised) < SHINGLE_SIZE:
+        shingles = {normalised}
+    else:
+        shingles = {normalised[i:i + SHINGLE_SIZE] for i in range(len(normalised) - SHINGLE_SIZE + 1)}
+    weights = [0] * 64
+    for shingle in shingles:
+        # Stable across processes, unlike hash()
+        value = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), 'little')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    signature = 0
+    for bit, weight in enumerate(weights):
+        if weight > 0:
+            signature |= 1 << bit
+    return signature
+
+
+class TicketDeduplicator:
+    # Recent open tickets by SimHash, for collapsing floods of the same
+    # complaint. Two tickets are near-duplicates when their signatures are at
+    # most max_distance bits apart. Lookup is by blocks: the signature is cut
+    # into max_distance + key_blocks blocks, and two signatures within
+    # max_distance bits of each other must agree exactly on at least
+    # key_blocks of them (pigeonhole). Every combination of key_blocks blocks
+    # is a table keyed on those blocks, so only tickets sharing a key are
+    # compared. With the default 10 bits and 2 key blocks that is 66 tables on
+    # 10-12 bit keys, where single-block bands would be 5 bits wide and match
+    # a third of all tickets.
+    # Entries older than `window` seconds are dropped.
+    #
+    # An entry's ticket is either a committed ticket id or the InsertTicket
+    # mutation still waiting in the write-behind queue.
+
+    def __init__(self, database, max_distance=10, window=24 * 3600, key_blocks=2):
+        self.database = database
+        self.max_distance = max_distance
+        self.window = window
+        self.matched = 0
+        self._entries = {}  # entry id -> [signature, added_at, ticket, duplicates]
+        self._expiry = deque()  # (added_at, entry id), oldest first
+        self._next_id = 0
+        blocks = max(max_distance, 0) + key_blocks
+        bounds = [64 * i // blocks for i in range(blocks + 1)]
+        self._blocks = [(bounds[i], bounds[i + 1]) for i in range(blocks)]
+        self._tables = list(itertools.combinations(range(blocks), key_blocks))
+        self._bands = [{} for _ in self._tables]
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_distance >= 0
+
+    def _band_keys(self, signature):
+        values = [(signature >> start) & ((1 << (end - start)) - 1) for start, end in self._blocks]
+        for index, table in enumerate(self._tables):
+            yield index, tuple(values[block] for block in table)
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now - self.window:
+            _, entry_id = self._expiry.popleft()
+            self._drop(entry_id)
+
+    def _drop(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for index, key in self._band_keys(entry[0]):
+            bucket = self._bands[index].get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._bands[index][key]
+
+    def _candidates(self, signature):
+        seen = set()
+        for index, key in self._band_keys(signature):
+            for entry_id in self._bands[index].get(key, ()):
+                if entry_id not in seen:
+                    seen.add(entry_id)
+                    yield entry_id
+
+    @staticmethod
+    def ticket_id(ticket):
+        # Committed id of an entry's ticket, None while it is still queued
+        return ticket if isinstance(ticket, int) else ticket.ticket_id
+
+    def remember(self, signature, ticket, added_at=None):
+        added_at = time.time() if added_at is None else added_at
+        if isinstance(ticket, int):
+            # Committed tickets announced by other workers may already be here
+            for entry_id in self._candidates(signature):
+                if self.ticket_id(self._entries[entry_id][2]) == ticket:
+                    return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = [signature, added_at, ticket, 0]
+        self._expiry.append((added_at, entry_id))
+        for index, key in self._band_keys(signature):
+            self._bands[index].setdefault(key, set()).add(entry_id)
+
+    def find(self, signature, now=None):
+        # Returns the closest recent ticket within max_distance as
+        # (ticket, duplicates so far including this one), or None
+        self._expire(time.time() if now is None else now)
+        best = None
+        for entry_id in self._candidates(signature):
+            entry = self._entries[entry_id]
+            distance = (entry[0] ^ signature).bit_count()
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, entry)
+        if best is None:
+            return None
+        entry = best[1]
+        entry[3] += 1
+        self.matched += 1
+        return entry[2], entry[3]
+
+    def forget(self, ticket_id):
+        # A closed ticket no longer absorbs new reports
+        for entry_id, entry in list(self._entries.items()):
+            if self.ticket_id(entry[2]) == ticket_id:
+                self._drop(entry_id)
+
+    def load(self):
+        # Synchronous startup step: open tickets from the last `window` seconds
+        if not self.enabled:
+            return
+
+        def read(cursor):
+            cursor.execute(RECENT_SQL, (datetime.fromtimestamp(time.time() - self.window),))
+            return cursor.fetchall()
+
+        for ticket_id, message, timestamp in self.database.call(read):
+            self.remember(simhash(message), ticket_id, timestamp.timestamp())
+        logger.info("Loaded %d recent tickets for duplicate detection", len(self._entries))
@@ -0,0 +1,227 @@
+import copy
+import functools
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from telegram import Update
+
+from processing import iter_handlers
+from ratelimit import TokenBucket
+
+# Correlation fields of the update being handled by the current task
+log_context = ContextVar('log_context', default=None)
+
+CORRELATION_FIELDS = ('update_id', 'user_id', 'handler')
+# Attributes every LogRecord has; anything else was passed through `extra`
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'suppressed'} | set(CORRELATION_FIELDS)
+
+
+class CorrelationFilter(logging.Filter):
+    # Copies the correlation fields onto the record. Runs in the thread that
+    # logs, before the record is handed to the writer thread, which would not
+    # see the context.
+    def filter(self, record):
+        context = log_context.get()
+        if context is not None:
+            for field, value in context.items():
+                setattr(record, field, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps a flood of one message from saturating disk I/O: below WARNING, each
+    # message template gets `burst` records and then `rate` per second. The
+    # next record that passes carries how many were suppressed. Unlocked
+    # updates from worker threads can only make the limit slightly loose.
+
+    def __init__(self, rate=5.0, burst=20, max_templates=10000):
+        super().__init__()
+        self.policy = TokenBucket(capacity=burst, refill_rate=rate)
+        self.max_templates = max_templates
+        self.suppressed = 0
+        self._templates = {}  # (logger, template) -> [bucket state, suppressed since last pass]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.policy.refill_rate <= 0:
+            return True
+        key = (record.name, record.msg if isinstance(record.msg, str) else type(record.msg).__name__)
+        now = time.time()
+        entry = self._templates.get(key)
+        if entry is None:
+            if len(self._templates) >= self.max_templates:
+                self._templates.clear()
+            entry = self._templates[key] = [self.policy.new_state(now), 0]
+        if not self.policy.hit(entry[0], now):
+            entry[1] += 1
+            self.suppressed += 1
+            return False
+        if entry[1]:
+            record.suppressed = entry[1]
+            entry[1] = 0
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line
+    def format(self, record):
+        line = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in CORRELATION_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                line[field] = value
+        if getattr(record, 'suppressed', 0):
+            line['suppressed'] = record.suppressed
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                line[key] = value
+        if record.exc_info:
+            line['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            line['exc'] = record.exc_text
+        return json.dumps(line, default=str, ensure_ascii=False)
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    # Rotates when the file reaches max_bytes or every `interval` seconds,
+    # whichever comes first, and gzips rotated files: bot.log.1.gz, ...
+
+    def __init__(self, filename, max_bytes=0, backup_count=10, interval=0, encoding='utf-8'):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+        self.namer = lambda name: name + '.gz'
+        self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+def _gzip_rotator(source, destination):
+    with open(source, 'rb') as plain, gzip.open(destination, 'wb') as compressed:
+        shutil.copyfileobj(plain, compressed)
+    os.remove(source)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller: when the writer falls behind and the queue is
+    # full, records are dropped and counted.
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue stays in this process, so nothing has to be pickled: only
+        # msg and args are merged now, while the args still hold the values
+        # they had when logged. Tracebacks are formatted by the writer thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    # Handlers log through a queue; a listener thread formats and writes the
+    # records, rotates and compresses the files.
+
+    def __init__(self, queue_handler, listener, sampler):
+        self.queue_handler = queue_handler
+        self.listener = listener
+        self.sampler = sampler
+
+    @property
+    def queued(self):
+        return self.queue_handler.queue.qsize()
+
+    @property
+    def dropped(self):
+        return self.queue_handler.dropped
+
+    def stop(self):
+        # Writes out everything still queued
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=50 * 1024 * 1024, backup_count=10, interval=86400,
+                  queue_size=10000, sample_rate=5.0, sample_burst=20, console=True):
+    file_handler = CompressingRotatingFileHandler(path, max_bytes=max_bytes, backup_count=backup_count, interval=interval)
+    file_handler.setFormatter(JsonFormatter())
+    handlers = [file_handler]
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        handlers.append(console_handler)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    sampler = SamplingFilter(rate=sample_rate, burst=sample_burst)
+    queue_handler.addFilter(sampler)
+    queue_handler.addFilter(CorrelationFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    # httpx logs every Bot API request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return LogPipeline(queue_handler, listener, sampler)
+
+
+def correlate_handlers(application):
+    # Tags every log record written while a handler runs with the update id,
+    # user id and handler name
+    def wrap(handler):
+        callback = handler.callback
+
+        @functools.wraps(callback)
+        async def correlated(update, context):
+            fields = {'handler': callback.__name__}
+            if isinstance(update, Update):
+                fields['update_id'] = update.update_id
+                if update.effective_user is not None:
+                    fields['user_id'] = update.effective_user.id
+            token = log_context.set(fields)
+            try:
+                return await callback(update, context)
+            finally:
+                log_context.reset(token)
+
+        handler.callback = correlated
+
+    for handler in iter_handlers(application):
+        wrap(handler)
@@ -0,0 +1,253 @@
+import asyncio
+import io
+import logging
+
+from telegram import InputMediaDocument, InputMediaPhoto
+from telegram.error import RetryAfter, TelegramError
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it only exact duplicates are caught
+    Image = None
+
+PERCEPTUAL_HASHING = Image is not None
+# Documents whose thumbnail shows their content; other files get generic
+# icons that would all look alike
+HASHED_DOCUMENT_TYPES = ('image/', 'video/')
+
+logger = logging.getLogger(__name__)
+
+LOAD_SQL = "SELECT file_unique_id, phash FROM media_index"
+INSERT_SQL = "INSERT IGNORE INTO media_index (file_unique_id, phash, user_id) VALUES (%s, %s, %s)"
+
+MEDIA_GROUP_LIMIT = 10  # send_media_group accepts 2-10 items
+MAX_RETRY_AFTER = 3  # Flood-control waits honoured per send before giving up
+HASH_SIZE = 8  # 8x8 difference hash -> 64 bits
+
+
+def difference_hash(image_bytes):
+    # 64-bit dHash: shrink to 9x8 greyscale and compare neighbouring pixels.
+    # Survives re-encoding, resizing and small edits, unlike file hashes.
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE)).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def document_hash_source(document):
+    # The thumbnail to hash for a document, or None when it says nothing about the content
+    if document.mime_type and document.mime_type.startswith(HASHED_DOCUMENT_TYPES):
+        return document.thumbnail
+    return None
+
+
+async def perceptual_hash(file_source):
+    # file_source is a PhotoSize or a document thumbnail; a small rendition is
+    # enough for a 64-bit hash and keeps the download tiny.
+    if Image is None or file_source is None:
+        return None
+    try:
+        telegram_file = await file_source.get_file()
+        data = await telegram_file.download_as_bytearray()
+        # Decoding is CPU work; keep it off the event loop
+        return await asyncio.to_thread(difference_hash, bytes(data))
+    except (TelegramError, OSError) as e:
+        logger.warning("Could not hash media %s: %s", file_source.file_unique_id, e)
+        return None
+
+
+class MediaIndex:
+    # In-memory index of every file_unique_id and perceptual hash seen so far,
+    # backed by the media_index table. Near-duplicate lookup splits the 64-bit
+    # hash into max_distance + 1 bands: two hashes within max_distance bits of
+    # each other must agree exactly on at least one band (pigeonhole), so only
+    # hashes sharing a band are compared.
+
+    def __init__(self, database, max_distance=4):
+        self.database = database
+        self.max_distance = max_distance
+        self._unique_ids = set()
+        self._bands = [{} for _ in range(max_distance + 1)]
+        bits = 64 // (max_distance + 1)
+        self._band_ranges = [
+            (i * bits, 64 if i == max_distance else (i + 1) * bits) for i in range(max_distance + 1)
+        ]
+
+    def __len__(self):
+        return len(self._unique_ids)
+
+    def _band_keys(self, phash):
+        for index, (start, end) in enumerate(self._band_ranges):
+            yield index, (phash >> start) & ((1 << (end - start)) - 1)
+
+    def remember(self, file_unique_id, phash):
+        self._unique_ids.add(file_unique_id)
+        if phash is not None:
+            for index, key in self._band_keys(phash):
+                self._bands[index].setdefault(key, set()).add(phash)
+
+    def load(self):
+        def read(cursor):
+            cursor.execute(LOAD_SQL)
+            return cursor.fetchall()
+
+        for file_unique_id, phash in self.database.call(read):
+            self.remember(file_unique_id, phash)
+        logger.info("Loaded %d media index entries", len(self._unique_ids))
+
+    def find_duplicate(self, file_unique_id, phash=None):
+        if file_unique_id in self._unique_ids:
+            return 'exact'
+        if phash is not None:
+            for index, key in self._band_keys(phash):
+                for candidate in self._bands[index].get(key, ()):
+                    if (candidate ^ phash).bit_count() <= self.max_distance:
+                        return 'similar'
+        return None
+
+    def forget(self, file_unique_id, phash):
+        # Undoes remember() for media that was never forwarded after all
+        self._unique_ids.discard(file_unique_id)
+        if phash is not None:
+            for index, key in self._band_keys(phash):
+                band = self._bands[index].get(key)
+                if band is not None:
+                    band.discard(phash)
+                    if not band:
+                        del self._bands[index][key]
+
+    async def add(self, file_unique_id, phash, user_id):
+        self.remember(file_unique_id, phash)
+        await self.database.execute(INSERT_SQL, (file_unique_id, phash, user_id))
+
+
+class MediaItem:
+    def __init__(self, kind, file_id, caption=None, file_unique_id=None, phash=None, user_id=None):
+        self.kind = kind  # 'photo' or 'document'
+        self.file_id = file_id
+        self.caption = caption
+        # What goes into the media index once the item has been forwarded
+        self.file_unique_id = file_unique_id
+        self.phash = phash
+        self.user_id = user_id
+
+    def as_input_media(self, caption=None):
+        if self.kind == 'photo':
+            return InputMediaPhoto(self.file_id, caption=caption)
+        return InputMediaDocument(self.file_id, caption=caption)
+
+
+class MediaForwarder:
+    # Reposts submissions to the target chat. Items of one album arrive as
+    # separate updates; they are buffered per media_group_id until the album
+    # has been quiet for album_wait seconds and then sent with one
+    # send_media_group call per kind (Telegram does not mix photos and
+    # documents in one group).
+
+    def __init__(self, chat_id, topic_message_id=None, album_wait=1.5):
+        self.chat_id = chat_id
+        self.topic_message_id = topic_message_id
+        self.album_wait = album_wait
+        self._albums = {}  # media_group_id -> {'items': [...], 'header': str, 'reply_chat_id': int, 'rejected': int}
+        self._timers = {}
+        self._flushing = set()
+        # Coroutine functions awaited with each flushed album as
+        # listener(items, submitted)
+        self.listeners = []
+
+    @property
+    def pending_albums(self):
+        return len(self._albums)
+
+    async def forward_single(self, bot, item, header):
+        caption = f"{header}\n{item.caption}" if item.caption else header
+        if item.kind == 'photo':
+            await _retry(bot.send_photo, chat_id=self.chat_id, photo=item.file_id, caption=caption, reply_to_message_id=self.topic_message_id)
+        else:
+            await _retry(bot.send_document, chat_id=self.chat_id, document=item.file_id, caption=caption, reply_to_message_id=self.topic_message_id)
+
+    def add_to_album(self, bot, media_group_id, item, header, reply_chat_id):
+        album = self._albums.setdefault(media_group_id, {'items': [], 'header': header, 'reply_chat_id': reply_chat_id, 'rejected': 0})
+        if item is None:
+            album['rejected'] += 1
+        else:
+            album['items'].append(item)
+        # Every new item pushes the flush back so late parts of the album are not split off
+        timer = self._timers.get(media_group_id)
+        if timer is not None:
+            timer.cancel()
+        self._timers[media_group_id] = asyncio.get_running_loop().call_later(
+            self.album_wait, self._start_flush, bot, media_group_id
+        )
+
+    def _start_flush(self, bot, media_group_id):
+        task = asyncio.get_running_loop().create_task(self._flush_album(bot, media_group_id))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush_album(self, bot, media_group_id):
+        self._timers.pop(media_group_id, None)
+        album = self._albums.pop(media_group_id, None)
+        if album is None:
+            return
+        items = album['items']
+        submitted = False
+        try:
+            for kind in ('photo', 'document'):
+                group = [item for item in items if item.kind == kind]
+                for start in range(0, len(group), MEDIA_GROUP_LIMIT):
+                    chunk = group[start:start + MEDIA_GROUP_LIMIT]
+                    if len(chunk) == 1:
+                        await self.forward_single(bot, chunk[0], album['header'])
+                        continue
+                    # The album caption goes on the first item, as Telegram displays it
+                    media = [
+                        item.as_input_media(caption=_join_caption(album['header'], item.caption) if index == 0 else item.caption)
+                        for index, item in enumerate(chunk)
+                    ]
+                    await _retry(bot.send_media_group, chat_id=self.chat_id, media=media, reply_to_message_id=self.topic_message_id)
+            submitted = True
+            text = f"{len(items)} file(s) submitted."
+            if album['rejected']:
+                text += f" {album['rejected']} duplicate(s) were rejected."
+        except TelegramError as e:
+            logger.error("Failed to forward album %s: %s", media_group_id, e)
+            text = "Your files could not be submitted. Please try again later."
+        for listener in self.listeners:
+            try:
+                await listener(items, submitted)
+            except Exception as e:
+                logger.error("Album listener failed for %s: %s", media_group_id, e)
+        try:
+            await bot.send_message(chat_id=album['reply_chat_id'], text=text)
+        except TelegramError as e:
+            logger.warning("Failed to confirm album %s: %s", media_group_id, e)
+
+    async def stop(self, bot):
+        # Flush albums still waiting for their quiet period
+        for timer in self._timers.values():
+            timer.cancel()
+        await asyncio.gather(*self._flushing, return_exceptions=True)
+        for media_group_id in list(self._albums):
+            await self._flush_album(bot, media_group_id)
+
+
+def _join_caption(header, caption):
+    return f"{header}\n{caption}" if caption else header
+
+
+async def _retry(method, **kwargs):
+    for attempt in range(MAX_RETRY_AFTER + 1):
+        try:
+            return await method(**kwargs)
+        except RetryAfter as e:
+            # Past the last wait the caller gets the error instead of stalling
+            # its user indefinitely under sustained flood control
+            if attempt == MAX_RETRY_AFTER:
+                raise
+            await asyncio.sleep(e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after)
@@ -0,0 +1,315 @@
+import asyncio
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+from processing import iter_handlers
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds, 0.5 ms to 30 s. Observing is one
+# bisect and three additions, cheap enough to leave on in production.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Callback data is chosen by the client, so distinct branch labels are capped
+MAX_BRANCHES = 64
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count', '_lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        # SQL timings are recorded from the database worker threads
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(BUCKETS, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        # Estimated by linear interpolation inside the bucket holding the rank
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return BUCKETS[-1]
+
+
+class Metrics:
+    # Counters and histograms are keyed by name plus a tuple of label pairs.
+    # Gauges are callbacks read only when metrics are exported, so queue and
+    # cache depths cost nothing on the hot path.
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = []  # (name, label, callback)
+        self._lock = threading.Lock()
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, name, value, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, callback, label=None):
+        # callback() returns a number, or with a label, a {label value: number} dict
+        self._gauges.append((name, label, callback))
+
+    def counters(self, name):
+        return {labels: value for (counter_name, labels), value in list(self._counters.items()) if counter_name == name}
+
+    def histograms(self, name):
+        return {labels: histogram for (histogram_name, labels), histogram in list(self._histograms.items()) if histogram_name == name}
+
+    def read_gauges(self):
+        values = []
+        for name, label, callback in self._gauges:
+            try:
+                value = callback()
+            except Exception as e:
+                logger.debug("Gauge %s failed: %s", name, e)
+                continue
+            if label is not None:
+                for label_value, number in value.items():
+                    values.append((name, ((label, str(label_value)),), number))
+            else:
+                values.append((name, (), value))
+        return values
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = ["# TYPE bot_uptime_seconds gauge", f"bot_uptime_seconds {time.time() - self.started:.0f}"]
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(list(self._counters.items())):
+            declare(name, 'counter')
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(list(self._histograms.items()), key=lambda item: item[0]):
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        for name, labels, value in self.read_gauges():
+            declare(name, 'gauge')
+            lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top=8):
+        # Plain-text digest for the /stats command
+        uptime = int(time.time() - self.started)
+        lines = [f"Uptime: {uptime // 86400}d {uptime % 86400 // 3600}h {uptime % 3600 // 60}m"]
+
+        handlers = sorted(self.histograms('handler_seconds').items(), key=lambda item: -item[1].count)
+        if handlers:
+            lines.append("\nHandlers (count, p50/p95/p99 ms):")
+            for labels, histogram in handlers[:top]:
+                labels = dict(labels)
+                name = f"{labels['handler']} {labels['branch']}".strip()
+                lines.append(f"{name}: {histogram.count}, {_percentiles(histogram)}")
+
+        statements = sorted(self.histograms('sql_seconds').items(), key=lambda item: -item[1].sum)
+        if statements:
+            lines.append("\nSQL by total time (count, p50/p95/p99 ms):")
+            for labels, histogram in statements[:top]:
+                lines.append(f"{dict(labels)['statement']}: {histogram.count}, {_percentiles(histogram)}")
+
+        calls = self.counters('bot_api_calls_total')
+        if calls:
+            errors = sum(self.counters('bot_api_errors_total').values())
+            retry_after = sum(self.counters('bot_api_retry_after_total').values())
+            busiest = sorted(calls.items(), key=lambda item: -item[1])[:top]
+            lines.append(f"\nBot API: {sum(calls.values())} calls, {errors} errors, {retry_after} RetryAfter")
+            lines.append(", ".join(f"{dict(labels)['method']} {count}" for labels, count in busiest))
+
+        gauges = self.read_gauges()
+        if gauges:
+            lines.append("\nQueues and caches:")
+            for name, labels, value in gauges:
+                # Gauges should be numbers, but one that isn't must not break the whole summary
+                value = f"{value:g}" if isinstance(value, (int, float)) else str(value)
+                lines.append(f"{name}{'[' + labels[0][1] + ']' if labels else ''}: {value}")
+        return "\n".join(lines)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _percentiles(histogram):
+    return "/".join(f"{histogram.quantile(q) * 1000:.1f}" for q in (0.5, 0.95, 0.99))
+
+
+def callback_branch(data):
+    # 'group_12' -> 'group_', 'ticket_close_7' -> 'ticket_close_'
+    return re.sub(r'-?\d+$', '', data or '')
+
+
+def instrument_handlers(application, metrics):
+    # Wraps every handler callback, including those inside conversations, with
+    # a latency histogram labelled by callback name and callback-data branch.
+    def wrap(handler):
+        callback = handler.callback
+        name = callback.__name__
+        histograms = {}
+
+        @functools.wraps(callback)
+        async def timed(update, context):
+            branch = ''
+            if isinstance(update, Update) and update.callback_query is not None:
+                branch = callback_branch(update.callback_query.data)
+            histogram = histograms.get(branch)
+            if histogram is None:
+                if len(histograms) >= MAX_BRANCHES:
+                    branch = 'other'
+                histogram = histograms.setdefault(branch, metrics.histogram('handler_seconds', handler=name, branch=branch))
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                metrics.inc('handler_errors_total', handler=name)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started)
+
+        handler.callback = timed
+
+    for handler in iter_handlers(application):
+        wrap(handler)
+
+
+def conversation_states(conversation_handler, state_names):
+    # Number of conversations in each state. ConversationHandler keeps its
+    # state table private; this only reads it at export time.
+    def count():
+        counts = dict.fromkeys(state_names.values(), 0)
+        for state in list(conversation_handler._conversations.values()):
+            name = state_names.get(state, 'pending')
+            counts[name] = counts.get(name, 0) + 1
+        return counts
+    return count
+
+
+class InstrumentedRequest(BaseRequest):
+    # Wraps the request object the bot sends Bot API calls through and counts
+    # calls, errors and RetryAfter responses per method.
+
+    def __init__(self, request, metrics):
+        self.request = request
+        self.metrics = metrics
+
+    @property
+    def read_timeout(self):
+        return self.request.read_timeout
+
+    async def initialize(self):
+        await self.request.initialize()
+
+    async def shutdown(self):
+        await self.request.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, payload = await self.request.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        except Exception as e:
+            self.metrics.inc('bot_api_calls_total', method=api_method)
+            self.metrics.inc('bot_api_errors_total', method=api_method, error=type(e).__name__)
+            raise
+        self.metrics.observe('bot_api_seconds', time.perf_counter() - started, method=api_method)
+        self.metrics.inc('bot_api_calls_total', method=api_method)
+        if status == 429:
+            self.metrics.inc('bot_api_retry_after_total', method=api_method)
+        elif status >= 300:
+            self.metrics.inc('bot_api_errors_total', method=api_method, error=str(status))
+        return status, payload
+
+
+class MetricsServer:
+    # Minimal HTTP endpoint serving GET /metrics; meant to listen on localhost
+    # for a local scraper, not to be exposed.
+
+    def __init__(self, metrics, host='127.0.0.1', port=9464):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("Metrics endpoint listening on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Headers are read and ignored
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = "200 OK", self.metrics.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug("Metrics request failed: %s", e)
+        finally:
+            writer.close()
@@ -0,0 +1,358 @@
+import argparse
+import logging
+import re
+import time
+
+from database import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema migrations. schema_version holds the version the database
+# is at; when it is current, startup costs one single-row read. Otherwise the
+# pending migrations run in order, each recording its version when done.
+#
+# A step is either a statement, or (table, 'column' | 'index', name,
+# statement) for a column or index that is only added when missing. MySQL
+# commits DDL implicitly, so a migration that fails halfway is simply run
+# again, and steps are written to be safe to repeat.
+
+ER_NO_SUCH_TABLE = 1146
+_CREATE_PATTERN = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)')
+# Serialises concurrent starts (the supervisor and several workers)
+LOCK_NAME = 'bot_schema_migration'
+LOCK_TIMEOUT = 300
+
+VERSION_SQL = "SELECT version FROM schema_version WHERE id = 1"
+RECORD_VERSION_SQL = (
+    "INSERT INTO schema_version (id, version) VALUES (1, %s) "
+    "ON DUPLICATE KEY UPDATE version = VALUES(version), applied_at = CURRENT_TIMESTAMP"
+)
+COLUMN_EXISTS_SQL = (
+    "SELECT COUNT(*) FROM information_schema.columns "
+    "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s"
+)
+TABLE_EXISTS_SQL = (
+    "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+)
+INDEX_EXISTS_SQL = (
+    "SELECT COUNT(*) FROM information_schema.statistics "
+    "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s"
+)
+
+
+class Migration:
+    def __init__(self, version, description, steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+# Every table as it was when versioning was introduced
+INITIAL_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
+        version INT UNSIGNED NOT NULL,
+        applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+        member_status VARCHAR(50) NOT NULL DEFAULT 'pending',
+        status VARCHAR(50) NOT NULL DEFAULT 'pending',  -- 'member', 'pending', or 'ban'
+        cooldown_until DATETIME NULL,
+        verified_at DATETIME NULL,  -- status last confirmed against the whitelist group
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_users_status_cooldown (status, cooldown_until),
+        KEY idx_users_status_verified (status, verified_at)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS groups_list (
+        group_id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+        group_name VARCHAR(255) NOT NULL,
+        UNIQUE KEY unique_group_name (group_name)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ticket_category (
+        id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+        category_name VARCHAR(255) NOT NULL,
+        description TEXT NULL,
+        UNIQUE KEY unique_category_name (category_name)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
+        version INT UNSIGNED NOT NULL DEFAULT 1  -- bump after editing groups_list or ticket_category
+    );
+    """,
+    """
+    INSERT IGNORE INTO catalog_version (id, version) VALUES (1, 1);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rate_limit_state (
+        user_id BIGINT UNSIGNED NOT NULL,
+        action VARCHAR(32) NOT NULL,
+        a DOUBLE NOT NULL,
+        b DOUBLE NOT NULL,
+        c DOUBLE NOT NULL,
+        updated_at DATETIME NOT NULL,
+        PRIMARY KEY (user_id, action),
+        KEY idx_rate_limit_updated_at (updated_at)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast (
+        id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+        admin_chat_id BIGINT NOT NULL,
+        message TEXT NOT NULL,
+        status VARCHAR(16) NOT NULL DEFAULT 'running',  -- 'running' or 'done'
+        last_user_id BIGINT UNSIGNED NOT NULL DEFAULT 0,  -- checkpoint: every user up to here was handled
+        sent INT UNSIGNED NOT NULL DEFAULT 0,
+        failed INT UNSIGNED NOT NULL DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_failure (
+        broadcast_id INT UNSIGNED NOT NULL,
+        user_id BIGINT UNSIGNED NOT NULL,
+        reason VARCHAR(32) NOT NULL,  -- 'blocked', 'deactivated', 'not_found', ...
+        PRIMARY KEY (broadcast_id, user_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS write_behind_state (
+        id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
+        last_seq BIGINT UNSIGNED NOT NULL  -- last journal entry committed
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS shared_event (
+        id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+        kind VARCHAR(32) NOT NULL,  -- 'catalog', 'rate_limit_reset', 'media', 'ticket'
+        event_key VARCHAR(255) NOT NULL,
+        origin SMALLINT UNSIGNED NOT NULL,  -- worker that published it
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_shared_event_created_at (created_at)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS media_index (
+        file_unique_id VARCHAR(64) NOT NULL PRIMARY KEY,
+        phash BIGINT UNSIGNED NULL,  -- 64-bit perceptual hash, NULL when it could not be computed
+        user_id BIGINT UNSIGNED NOT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_state (
+        user_id BIGINT NOT NULL PRIMARY KEY,
+        data TEXT NOT NULL,  -- context.user_data as compact JSON
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS conversation_state (
+        name VARCHAR(64) NOT NULL,
+        conversation_key VARCHAR(128) NOT NULL,  -- JSON list, e.g. [chat_id, user_id]
+        owner_id BIGINT NOT NULL,  -- user (or chat) the state is loaded for
+        state INT NOT NULL,
+        PRIMARY KEY (name, conversation_key),
+        KEY idx_conversation_owner (owner_id)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ticket (
+        id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+        category_id INT UNSIGNED NOT NULL,
+        user_id BIGINT UNSIGNED NOT NULL,
+        message TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        status VARCHAR(16) NOT NULL DEFAULT 'open',  -- 'open' or 'closed'
+        closed_at DATETIME NULL,
+        closed_by BIGINT UNSIGNED NULL,
+        duplicates INT UNSIGNED NOT NULL DEFAULT 0,  -- near-duplicates folded into this ticket
+        last_duplicate_at DATETIME NULL,
+        KEY idx_ticket_category_time (category_id, timestamp),
+        KEY idx_ticket_user_time (user_id, timestamp),
+        KEY idx_ticket_status_time (status, timestamp),
+        FULLTEXT KEY ft_ticket_message (message),
+        FOREIGN KEY (category_id) REFERENCES ticket_category(id) ON DELETE CASCADE,
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    );
+    """
+]
+
+# Columns and indexes added to those tables before versioning; CREATE TABLE IF
+# NOT EXISTS leaves existing tables alone, so older deployments get them here
+INITIAL_UPGRADES = [
+    ('users', 'column', 'verified_at', "ALTER TABLE users ADD COLUMN verified_at DATETIME NULL"),
+    ('users', 'index', 'idx_users_status_cooldown', "ALTER TABLE users ADD INDEX idx_users_status_cooldown (status, cooldown_until)"),
+    ('users', 'index', 'idx_users_status_verified', "ALTER TABLE users ADD INDEX idx_users_status_verified (status, verified_at)"),
+    ('ticket_category', 'column', 'description', "ALTER TABLE ticket_category ADD COLUMN description TEXT NULL"),
+    ('ticket', 'column', 'status', "ALTER TABLE ticket ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT 'open'"),
+    ('ticket', 'column', 'closed_at', "ALTER TABLE ticket ADD COLUMN closed_at DATETIME NULL"),
+    ('ticket', 'column', 'closed_by', "ALTER TABLE ticket ADD COLUMN closed_by BIGINT UNSIGNED NULL"),
+    ('ticket', 'column', 'duplicates', "ALTER TABLE ticket ADD COLUMN duplicates INT UNSIGNED NOT NULL DEFAULT 0"),
+    ('ticket', 'column', 'last_duplicate_at', "ALTER TABLE ticket ADD COLUMN last_duplicate_at DATETIME NULL"),
+    ('ticket', 'index', 'idx_ticket_category_time', "ALTER TABLE ticket ADD INDEX idx_ticket_category_time (category_id, timestamp)"),
+    ('ticket', 'index', 'idx_ticket_user_time', "ALTER TABLE ticket ADD INDEX idx_ticket_user_time (user_id, timestamp)"),
+    ('ticket', 'index', 'idx_ticket_status_time', "ALTER TABLE ticket ADD INDEX idx_ticket_status_time (status, timestamp)"),
+    ('ticket', 'index', 'ft_ticket_message', "ALTER TABLE ticket ADD FULLTEXT INDEX ft_ticket_message (message)"),
+]
+
+MIGRATIONS = [
+    Migration(1, "Initial schema", INITIAL_TABLES + INITIAL_UPGRADES),
+    # Broadcast recipients are read as status = 'member' AND user_id > ?
+    # ORDER BY user_id, which no other index returns in order
+    Migration(2, "Index users by status and user_id", [
+        ('users', 'index', 'idx_users_status_user', "ALTER TABLE users ADD INDEX idx_users_status_user (status, user_id)"),
+    ]),
+    # Retention: old tickets move to a compressed archive table; the policy
+    # scans need closed_at and timestamp on their own
+    Migration(3, "Ticket archive", [
+        """
+        CREATE TABLE IF NOT EXISTS ticket_archive (
+            id INT UNSIGNED NOT NULL PRIMARY KEY,  -- the id it had in ticket
+            category_id INT UNSIGNED NOT NULL,
+            user_id BIGINT UNSIGNED NOT NULL,
+            message TEXT NOT NULL,
+            timestamp DATETIME NULL,
+            status VARCHAR(16) NOT NULL,
+            closed_at DATETIME NULL,
+            closed_by BIGINT UNSIGNED NULL,
+            duplicates INT UNSIGNED NOT NULL DEFAULT 0,
+            last_duplicate_at DATETIME NULL,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            KEY idx_ticket_archive_category_time (category_id, timestamp),
+            KEY idx_ticket_archive_user_time (user_id, timestamp),
+            KEY idx_ticket_archive_status_time (status, timestamp)
+        ) ROW_FORMAT=COMPRESSED;
+        """,
+        ('ticket', 'index', 'idx_ticket_status_closed', "ALTER TABLE ticket ADD INDEX idx_ticket_status_closed (status, closed_at)"),
+        ('ticket', 'index', 'idx_ticket_time', "ALTER TABLE ticket ADD INDEX idx_ticket_time (timestamp)"),
+    ]),
+    # Near-duplicates folded into a ticket keep their text and sender here, so
+    # moderators can read every copy and not just the count; ticket_id is the
+    # ticket's id in ticket or, once archived, in ticket_archive
+    Migration(4, "Ticket duplicate copies", [
+        """
+        CREATE TABLE IF NOT EXISTS ticket_duplicate (
+            id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            ticket_id INT UNSIGNED NOT NULL,
+            user_id BIGINT UNSIGNED NOT NULL,
+            message TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            KEY idx_ticket_duplicate_ticket (ticket_id, id)
+        );
+        """,
+    ]),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def read_version(cursor):
+    # 0 for a database that predates versioning or is empty
+    try:
+        cursor.execute(VERSION_SQL)
+    except Exception as e:
+        # The driver's error, before Database.call wraps it
+        if getattr(e, 'errno', None) == ER_NO_SUCH_TABLE:
+            return 0
+        raise
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def pending_statements(cursor, migration):
+    # The statements of `migration` that still have work to do
+    statements = []
+    created = {match.group(1) for step in migration.steps if isinstance(step, str) for match in _CREATE_PATTERN.finditer(step)}
+    for step in migration.steps:
+        if isinstance(step, str):
+            statements.append(step)
+            continue
+        table, kind, name, statement = step
+        if table in created:
+            cursor.execute(TABLE_EXISTS_SQL, (table,))
+            if cursor.fetchone()[0] == 0:
+                # Created by this migration, with the column or index already in it
+                continue
+        cursor.execute(COLUMN_EXISTS_SQL if kind == 'column' else INDEX_EXISTS_SQL, (table, name))
+        if cursor.fetchone()[0] == 0:
+            statements.append(statement)
+    return statements
+
+
+def _apply(cursor, migrations, dry_run, since):
+    # Runs on one connection, holding the migration lock
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+    if cursor.fetchone()[0] != 1:
+        raise DatabaseError(f"Timed out waiting for lock {LOCK_NAME}")
+    try:
+        # Another process may have migrated while this one waited for the lock
+        version = read_version(cursor) if since is None else since
+        applied = []
+        for migration in migrations:
+            if migration.version <= version:
+                continue
+            statements = pending_statements(cursor, migration)
+            applied.append((migration, statements))
+            if dry_run:
+                continue
+            started = time.perf_counter()
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(RECORD_VERSION_SQL, (migration.version,))
+            logger.info(
+                "Applied migration %d (%s): %d statements in %.2fs",
+                migration.version, migration.description, len(statements), time.perf_counter() - started,
+            )
+        return version, applied
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        cursor.fetchall()
+
+
+def migrate(database, migrations=MIGRATIONS, dry_run=False, since=None):
+    # Synchronous; runs at startup before the event loop. Returns the version
+    # found and [(migration, statements)] for what was (or, with dry_run,
+    # would be) applied. `since` overrides the recorded version, e.g. to
+    # re-check every step.
+    latest = migrations[-1].version
+    if since is None and not dry_run:
+        version = database.call(read_version)
+        if version >= latest:
+            return version, []
+    return database.call(_apply, migrations, dry_run, since)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations.")
+    parser.add_argument('--dry-run', action='store_true', help="list the statements that would run and change nothing")
+    options = parser.parse_args()
+
+    from dotenv import load_dotenv
+    from database import Database
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    database = Database.from_env()
+    try:
+        version, applied = migrate(database, dry_run=options.dry_run)
+    finally:
+        database.close()
+    if not applied:
+        print(f"Schema is at version {version}, nothing to do.")
+    for migration, statements in applied:
+        print(f"-- {migration.version}: {migration.description}" + (" (would apply)" if options.dry_run else ""))
+        for statement in statements:
+            print(" ".join(statement.split()) + ";")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import csv
+import io
+import json
+import re
+from datetime import datetime
+
+CHUNK_SIZE = 1000
+
+# Each action is an IN-list UPDATE of existing rows plus, where unknown users
+# should get a row, a multi-row INSERT IGNORE. A chunk runs as one transaction.
+ACTIONS = {
+    'ban': (
+        "UPDATE users SET status = 'ban' WHERE status <> 'ban' AND user_id IN ({placeholders})",
+        "INSERT IGNORE INTO users (user_id, status) VALUES (%s, 'ban')",
+    ),
+    'unban': (
+        "UPDATE users SET status = 'pending', cooldown_until = NULL WHERE status = 'ban' AND user_id IN ({placeholders})",
+        None,
+    ),
+    # Banned users have to be unbanned first. An approval counts as a verified
+    # membership, so the reconciler leaves approved users alone for a while.
+    'approve': (
+        "UPDATE users SET status = 'member', cooldown_until = NULL, verified_at = NOW() "
+        "WHERE status = 'pending' AND user_id IN ({placeholders})",
+        "INSERT IGNORE INTO users (user_id, status, verified_at) VALUES (%s, 'member', NOW())",
+    ),
+}
+
+EXPORTS = {
+    'users': (
+        ('user_id', 'status', 'cooldown_until', 'verified_at', 'created_at'),
+        "SELECT user_id, status, cooldown_until, verified_at, created_at FROM users ORDER BY user_id",
+    ),
+    'tickets': (
+        ('id', 'category_id', 'user_id', 'status', 'timestamp', 'closed_at', 'closed_by', 'duplicates', 'message'),
+        "SELECT id, category_id, user_id, status, timestamp, closed_at, closed_by, duplicates, message FROM ticket ORDER BY id",
+    ),
+    'archive': (
+        ('id', 'category_id', 'user_id', 'status', 'timestamp', 'closed_at', 'closed_by', 'duplicates', 'archived_at', 'message'),
+        "SELECT id, category_id, user_id, status, timestamp, closed_at, closed_by, duplicates, archived_at, message "
+        "FROM ticket_archive ORDER BY id",
+    ),
+}
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+_ID_PATTERN = re.compile(r'[1-9]\d*')
+
+
+def parse_user_ids(text, csv_rows=False):
+    # Returns (unique IDs in order, entries that are not IDs). Free text may
+    # separate IDs with spaces, commas, semicolons or new lines. In CSV mode the
+    # first integer cell of each row is the ID, so extra columns (names,
+    # notes) are ignored and a header row is skipped.
+    user_ids = {}
+    invalid = []
+    if csv_rows:
+        for number, row in enumerate(csv.reader(io.StringIO(text))):
+            cells = [cell.strip() for cell in row if cell.strip()]
+            user_id = next((int(cell) for cell in cells if _ID_PATTERN.fullmatch(cell)), None)
+            if user_id is not None:
+                user_ids.setdefault(user_id, None)
+            elif cells and number > 0:
+                invalid.append(','.join(cells))
+    else:
+        for token in re.split(r'[\s,;]+', text):
+            if _ID_PATTERN.fullmatch(token):
+                user_ids.setdefault(int(token), None)
+            elif token:
+                invalid.append(token)
+    return list(user_ids), invalid
+
+
+def chunks(items, size=CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _apply_chunk(cursor, action, chunk):
+    update_sql, insert_sql = ACTIONS[action]
+    cursor.execute(update_sql.format(placeholders=', '.join(['%s'] * len(chunk))), chunk)
+    changed = cursor.rowcount
+    if insert_sql is not None:
+        # Rewritten by the connector into one multi-row INSERT
+        cursor.executemany(insert_sql, [(user_id,) for user_id in chunk])
+        changed += cursor.rowcount
+    return changed
+
+
+async def apply_bulk(database, action, user_ids, progress=None, chunk_size=CHUNK_SIZE):
+    # Applies `action` to every user, one transaction per chunk, and awaits
+    # progress(done, total, changed) after each. Returns the number of users
+    # whose row changed or was created; a failed chunk raises DatabaseError
+    # with the earlier chunks already committed.
+    changed = 0
+    done = 0
+    for chunk in chunks(user_ids, chunk_size):
+        changed += await database.run(_apply_chunk, action, chunk)
+        done += len(chunk)
+        if progress is not None:
+            await progress(done, len(user_ids), changed)
+    return changed
+
+
+def _cell(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ')
+    return value
+
+
+async def export_rows(database, name, output_format, out, batch_size=2000):
+    # Writes a table to the text file `out` from a server-side cursor, one
+    # batch at a time, so memory use does not depend on the table size.
+    # Returns the number of rows written.
+    columns, sql = EXPORTS[name]
+    writer = None
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+    count = 0
+    async for batch in database.stream(sql, batch_size=batch_size):
+        if writer is not None:
+            writer.writerows([[_cell(value) for value in row] for row in batch])
+        else:
+            out.write(''.join(
+                json.dumps(dict(zip(columns, row)), default=str, ensure_ascii=False) + '\n' for row in batch
+            ))
+        count += len(batch)
+    return count
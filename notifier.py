@@ -0,0 +1,119 @@
+import asyncio
+import logging
+
+from telegram.constants import MessageLimit
+from telegram.error import NetworkError, RetryAfter, TelegramError, TimedOut
+
+logger = logging.getLogger(__name__)
+
+DIGEST_SEPARATOR = "\n\n"
+
+
+def build_digests(texts, limit=MessageLimit.MAX_TEXT_LENGTH):
+    # Packs texts into as few messages as possible without splitting a text
+    # unless it is longer than a whole message on its own.
+    digests = []
+    current = ""
+    for text in texts:
+        while len(text) > limit:
+            if current:
+                digests.append(current)
+                current = ""
+            digests.append(text[:limit])
+            text = text[limit:]
+        if not current:
+            current = text
+        elif len(current) + len(DIGEST_SEPARATOR) + len(text) <= limit:
+            current += DIGEST_SEPARATOR + text
+        else:
+            digests.append(current)
+            current = text
+    if current:
+        digests.append(current)
+    return digests
+
+
+class ModNotifier:
+    # Outbound queue of moderator notifications, one buffer per forum topic.
+    # Handlers enqueue and return immediately; a flusher per topic waits for
+    # the flush window, then posts everything collected as digest messages.
+
+    def __init__(self, chat_id, flush_window=2.0, max_retries=5, backoff=1.0):
+        self.chat_id = chat_id
+        self.flush_window = flush_window
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.sent = 0
+        self.dropped = 0
+        self.unconfirmed = 0  # Timed out: may or may not have been posted
+        self._bot = None
+        self._buffers = {}  # topic message id -> [text, ...]
+        self._flushers = {}  # topic message id -> asyncio.Task
+        self._closing = asyncio.Event()
+
+    def start(self, bot):
+        self._bot = bot
+
+    @property
+    def pending(self):
+        return sum(len(buffer) for buffer in self._buffers.values())
+
+    def notify(self, topic_message_id, text):
+        self._buffers.setdefault(topic_message_id, []).append(text)
+        flusher = self._flushers.get(topic_message_id)
+        if flusher is None or flusher.done():
+            self._flushers[topic_message_id] = asyncio.get_running_loop().create_task(
+                self._flush_topic(topic_message_id, self.flush_window)
+            )
+
+    async def _flush_topic(self, topic_message_id, delay):
+        # Collect a burst for up to `delay` seconds; shutdown cuts the wait short
+        try:
+            await asyncio.wait_for(self._closing.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        while self._buffers.get(topic_message_id):
+            texts = self._buffers.pop(topic_message_id)
+            for digest in build_digests(texts):
+                await self._send(topic_message_id, digest)
+
+    async def _send(self, topic_message_id, text):
+        attempt = 0
+        while True:
+            try:
+                await self._bot.send_message(chat_id=self.chat_id, text=text, reply_to_message_id=topic_message_id)
+                self.sent += 1
+                return
+            except TimedOut as e:
+                # The request may have reached Telegram and been posted; sending
+                # the digest again could post it twice, so it is not retried
+                logger.warning("Notification for topic %s timed out and may not have been posted: %s", topic_message_id, e)
+                self.unconfirmed += 1
+                return
+            except (RetryAfter, NetworkError) as e:
+                # RetryAfter reaching here has already been retried by the
+                # outbound scheduler; it counts against max_retries too so a
+                # flood-controlled topic can't hold its flusher forever
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error("Dropping notification for topic %s after %d attempts: %s", topic_message_id, attempt, e)
+                    self.dropped += 1
+                    return
+                if isinstance(e, RetryAfter):
+                    # Wait exactly as long as Telegram asks
+                    delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                else:
+                    delay = self.backoff * 2 ** (attempt - 1)
+                await asyncio.sleep(delay)
+            except TelegramError as e:
+                logger.error("Failed to post notification to topic %s: %s", topic_message_id, e)
+                self.dropped += 1
+                return
+
+    async def stop(self):
+        # Flush whatever is still buffered without waiting for the window
+        self._closing.set()
+        await asyncio.gather(*self._flushers.values(), return_exceptions=True)
+        self._flushers.clear()
+        for topic_message_id in list(self._buffers):
+            await self._flush_topic(topic_message_id, 0)
@@ -0,0 +1,328 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Priority classes, most urgent first. Calls are classified by where they go:
+# callback answers and anything sent to a private chat are replies to a user
+# waiting on the bot; everything sent to a group (moderator notifications,
+# pins, the ticket group) is moderation. Bulk traffic (broadcasts) has to say
+# so with rate_limit_args={'priority': BULK}.
+INTERACTIVE = 0
+MODERATION = 1
+BULK = 2
+PRIORITY_NAMES = ('interactive', 'moderation', 'bulk')
+
+# Superseded by a later call for the same message; only the latest is sent
+COALESCED_ENDPOINTS = ('editMessageText',)
+
+
+class Outbound:
+    # One call waiting for its turn
+
+    __slots__ = ('priority', 'seq', 'chat_id', 'key', 'turn', 'done', 'superseded_by', 'queued', 'queued_at')
+
+    def __init__(self, priority, seq, chat_id, key):
+        loop = asyncio.get_running_loop()
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.key = key
+        self.turn = loop.create_future()
+        self.done = loop.create_future()
+        # Superseded callers fail with the call that replaced theirs; nobody
+        # may be waiting, so the exception is marked as seen
+        self.done.add_done_callback(lambda future: future.cancelled() or future.exception())
+        self.superseded_by = None
+        self.queued = False
+        self.queued_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class OutboundScheduler(BaseRateLimiter):
+    # Every Bot API call of the application goes through here (reads such as
+    # getChatMember excepted). A call waits in a priority queue until both the
+    # global budget and its chat's budget have a token; within a class calls
+    # go out in order, skipping chats that are over their budget.
+    #
+    # RetryAfter pauses all sending for as long as Telegram asks, then the call
+    # is queued again ahead of the rest of its class, up to max_retries times.
+    # An edit_message_text still waiting when a newer one for the same message
+    # arrives is dropped: the newer text takes its place in the queue and both
+    # callers get its result. The same happens to an edit that hit RetryAfter
+    # if a newer one was queued while it was in flight.
+    #
+    # Each chat has its own queue. Only the heads of chats that may have a
+    # token sit in the ready heap; a chat over its budget waits in the
+    # throttled heap until its bucket refills, so a grant costs O(log chats)
+    # however much is queued behind busy chats.
+
+    def __init__(self, global_rate=30.0, private_rate=1.0, group_rate=20 / 60, burst=3, max_retries=3, metrics=None):
+        self.global_bucket = TokenBucket(burst, global_rate)
+        self.private_bucket = TokenBucket(burst, private_rate)
+        self.group_bucket = TokenBucket(burst, group_rate)
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.sent = 0
+        self.retried = 0
+        self.coalesced = 0
+        self.paused_until = 0.0
+        self._global_state = self.global_bucket.new_state(time.monotonic())
+        self._chat_states = {}  # chat id -> bucket state
+        self._chats = {}  # chat id -> heap of its queued Outbound
+        self._ready = []  # chat heads, possibly stale
+        self._throttled = []  # (time its bucket has a token, head), possibly stale
+        self._edits = {}  # coalescing key -> queued Outbound
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+
+    async def initialize(self):
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        # Whatever is still queued goes out unthrottled rather than hanging its caller
+        items = sorted(item for queue in self._chats.values() for item in queue if item.queued)
+        self._chats.clear()
+        self._ready.clear()
+        self._throttled.clear()
+        for item in items:
+            self._grant(item)
+
+    def queued(self):
+        counts = dict.fromkeys(PRIORITY_NAMES, 0)
+        for queue in self._chats.values():
+            for item in queue:
+                if item.queued:
+                    counts[PRIORITY_NAMES[item.priority]] += 1
+        return counts
+
+    def stats(self):
+        return {'sent': self.sent, 'retried': self.retried, 'coalesced': self.coalesced}
+
+    @staticmethod
+    def classify(endpoint, data, rate_limit_args):
+        if isinstance(rate_limit_args, dict) and 'priority' in rate_limit_args:
+            return rate_limit_args['priority']
+        if endpoint == 'answerCallbackQuery':
+            return INTERACTIVE
+        chat_id = data.get('chat_id')
+        if isinstance(chat_id, int) and chat_id > 0:
+            return INTERACTIVE
+        return MODERATION
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        # Positive ids are private chats; groups, channels and @usernames share the group limit
+        return self.private_bucket if isinstance(chat_id, int) and chat_id > 0 else self.group_bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint.startswith('get') or self._dispatcher is None:
+            # Reads are not limited; neither is anything sent outside initialize/shutdown
+            return await callback(*args, **kwargs)
+
+        priority = self.classify(endpoint, data, rate_limit_args)
+        chat_id = data.get('chat_id')
+        key = None
+        if endpoint in COALESCED_ENDPOINTS:
+            key = (endpoint, chat_id, data.get('message_id'), data.get('inline_message_id'))
+        item = Outbound(priority, next(self._seq), chat_id, key)
+        attempt = 0
+        while True:
+            self._enqueue(item)
+            try:
+                await item.turn
+            except asyncio.CancelledError:
+                self._remove(item)
+                item.done.cancel()
+                raise
+            if item.superseded_by is not None:
+                return await self._follow(item)
+            waited = time.monotonic() - item.queued_at
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                self.retried += 1
+                self._count('outbound_retry_after_total', priority)
+                attempt += 1
+                if attempt > self.max_retries:
+                    item.done.set_exception(e)
+                    raise
+                logger.info("Flood control on %s, retrying in %.1fs (attempt %d)", endpoint, retry_after, attempt)
+                newer = self._edits.get(item.key) if item.key is not None else None
+                if newer is not None:
+                    # Sending this text now would overwrite the newer one
+                    item.superseded_by = newer
+                    self.coalesced += 1
+                    self._count('outbound_coalesced_total', priority)
+                    return await self._follow(item)
+                # Keeps its place at the head of its class
+                item.turn = asyncio.get_running_loop().create_future()
+                item.queued_at = time.monotonic()
+                continue
+            except asyncio.CancelledError:
+                item.done.cancel()
+                raise
+            except Exception as e:
+                item.done.set_exception(e)
+                raise
+            self.sent += 1
+            self._count('outbound_requests_total', priority)
+            if self.metrics is not None:
+                self.metrics.observe('outbound_wait_seconds', waited, priority=PRIORITY_NAMES[priority])
+            item.done.set_result(result)
+            return result
+
+    async def _follow(self, item):
+        # The caller of a superseded edit gets the result of the edit that replaced it
+        try:
+            result = await asyncio.shield(item.superseded_by.done)
+        except Exception as e:
+            item.done.set_exception(e)
+            raise
+        item.done.set_result(result)
+        return result
+
+    def _enqueue(self, item):
+        older = self._edits.get(item.key) if item.key is not None else None
+        if older is not None:
+            # The newer edit takes over the older one's place
+            item.priority = min(item.priority, older.priority)
+            item.seq = min(item.seq, older.seq)
+            self._remove(older)
+            older.superseded_by = item
+            older.turn.set_result(None)
+            self.coalesced += 1
+            self._count('outbound_coalesced_total', older.priority)
+        item.queued = True
+        queue = self._chats.setdefault(item.chat_id, [])
+        heapq.heappush(queue, item)
+        if queue[0] is item:
+            heapq.heappush(self._ready, item)
+        if item.key is not None:
+            self._edits[item.key] = item
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _remove(self, item):
+        # Lazily: the dispatcher drops it when it reaches the head of its chat
+        item.queued = False
+        if item.key is not None and self._edits.get(item.key) is item:
+            del self._edits[item.key]
+
+    def _grant(self, item):
+        self._remove(item)
+        if not item.turn.done():
+            item.turn.set_result(True)
+
+    def _chat_delay(self, chat_id, now):
+        bucket = self._chat_bucket(chat_id)
+        if bucket is None:
+            return 0.0
+        state = self._chat_states.get(chat_id)
+        return 0.0 if state is None else bucket.delay(state, now)
+
+    def _take_tokens(self, chat_id, now):
+        self.global_bucket.hit(self._global_state, now)
+        bucket = self._chat_bucket(chat_id)
+        if bucket is None:
+            return
+        state = self._chat_states.get(chat_id)
+        if state is None:
+            if len(self._chat_states) >= 10000:
+                self._prune(now)
+            state = self._chat_states[chat_id] = bucket.new_state(now)
+        bucket.hit(state, now)
+
+    def _prune(self, now):
+        for chat_id, state in list(self._chat_states.items()):
+            if self._chat_bucket(chat_id).is_idle(state, now):
+                del self._chat_states[chat_id]
+
+    def _head(self, chat_id):
+        # First call of the chat still queued; drops the ones removed before it
+        queue = self._chats.get(chat_id)
+        while queue and not queue[0].queued:
+            heapq.heappop(queue)
+        if not queue:
+            self._chats.pop(chat_id, None)
+            return None
+        return queue[0]
+
+    def _next(self, now):
+        # First queued call whose chat has a token, and how long until the
+        # earliest of the others will
+        while self._throttled and self._throttled[0][0] <= now:
+            _, item = heapq.heappop(self._throttled)
+            head = self._head(item.chat_id)
+            if head is not None:
+                heapq.heappush(self._ready, head)
+        while self._ready:
+            item = heapq.heappop(self._ready)
+            head = self._head(item.chat_id)
+            if head is not item:
+                # Stale: the chat's head was granted or removed since
+                if head is not None:
+                    heapq.heappush(self._ready, head)
+                continue
+            delay = self._chat_delay(item.chat_id, now)
+            if delay > 0:
+                heapq.heappush(self._throttled, (now + delay, item))
+                continue
+            heapq.heappop(self._chats[item.chat_id])
+            head = self._head(item.chat_id)
+            if head is not None:
+                heapq.heappush(self._ready, head)
+            return item, None
+        return None, self._throttled[0][0] - now if self._throttled else None
+
+    async def _sleep(self, timeout):
+        # Until `timeout` passes or a call is queued
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            delay = self.global_bucket.delay(self._global_state, now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            item, wait = self._next(now)
+            if item is None:
+                await self._sleep(wait)
+                continue
+            self._take_tokens(item.chat_id, now)
+            self._grant(item)
+            # Lets the caller send before the next grant
+            await asyncio.sleep(0)
+
+    def _count(self, name, priority):
+        if self.metrics is not None:
+            self.metrics.inc(name, priority=PRIORITY_NAMES[priority])
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+from database import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+USER_READ_SQL = "SELECT data FROM user_state WHERE user_id = %s"
+CONVERSATIONS_READ_SQL = "SELECT name, conversation_key, state FROM conversation_state WHERE owner_id = %s"
+USER_UPSERT_SQL = (
+    "INSERT INTO user_state (user_id, data) VALUES (%s, %s) "
+    "ON DUPLICATE KEY UPDATE data = VALUES(data)"
+)
+USER_DELETE_SQL = "DELETE FROM user_state WHERE user_id = %s"
+CONVERSATION_UPSERT_SQL = (
+    "INSERT INTO conversation_state (name, conversation_key, owner_id, state) VALUES (%s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE state = VALUES(state)"
+)
+CONVERSATION_DELETE_SQL = "DELETE FROM conversation_state WHERE name = %s AND conversation_key = %s"
+
+
+class LazyPersistence(BasePersistence):
+    # Persists context.user_data and conversation states in the database.
+    #
+    # Nothing is loaded at startup: PerUserUpdateProcessor calls load() before
+    # a user's first update, so startup time does not grow with the number of
+    # users. Application.update_persistence reports changes every
+    # update_interval seconds; they are collected in memory and written in one
+    # transaction per round instead of one write per update.
+
+    def __init__(self, database, update_interval=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.database = database
+        self.loaded = 0
+        self.written = 0
+        self._application = None
+        self._conversation_handlers = {}  # name -> ConversationHandler
+        self._loaded_owners = set()
+        # Owners whose stored state could not be read: their in-memory state
+        # is blank or partial, so it must not overwrite the stored one
+        self._unloaded_owners = set()
+        self._seeding_supported = True
+        self._dirty_users = {}  # user_id -> JSON text, None to delete
+        self._dirty_conversations = {}  # (name, key JSON) -> (owner id, state), state None to delete
+        self._writer = None
+
+    def attach(self, application):
+        # Called once all handlers are added
+        self._application = application
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and handler.persistent:
+                    self._conversation_handlers[handler.name] = handler
+
+    @property
+    def pending_writes(self):
+        return len(self._dirty_users) + len(self._dirty_conversations)
+
+    # Startup loads: deliberately empty, see load()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def load(self, owner_id):
+        # Brings in the user data and conversation states of one user (or chat,
+        # for updates without a user). Runs under the per-user lock, before any
+        # handler sees the update.
+        if owner_id is None or owner_id in self._loaded_owners:
+            return
+        try:
+            user_row, conversations = await self.database.run(_read_state, owner_id)
+        except DatabaseError as e:
+            # The user starts from a blank state this time; retried on the next
+            # update, and nothing of theirs is written until it succeeds
+            logger.error("Failed to load persisted state of %s: %s", owner_id, e)
+            self._unloaded_owners.add(owner_id)
+            return
+        self._loaded_owners.add(owner_id)
+        self._unloaded_owners.discard(owner_id)
+        self.loaded += 1
+
+        if user_row is not None:
+            user_data = self._application.user_data[owner_id]
+            for key, value in json.loads(user_row[0]).items():
+                user_data.setdefault(key, value)
+        for name, conversation_key, state in conversations:
+            handler = self._conversation_handlers.get(name)
+            if handler is None:
+                continue
+            key = tuple(json.loads(conversation_key))
+            self._seed_conversation(handler, key, state)
+
+    def _seed_conversation(self, handler, key, state):
+        # ConversationHandler has no public way to seed a single key. The
+        # state is added through its tracking dict (python-telegram-bot 21.x)
+        # without marking it as changed, so it is not written straight back.
+        # Other versions lose restored states instead of failing updates.
+        conversations = getattr(handler, '_conversations', None)
+        if not hasattr(conversations, 'update_no_track'):
+            if self._seeding_supported:
+                self._seeding_supported = False
+                logger.warning("This python-telegram-bot version cannot seed conversation states; they are not restored")
+            return
+        if key not in conversations:
+            conversations.update_no_track({key: state})
+
+    # Change reports from Application.update_persistence
+
+    async def update_user_data(self, user_id, data):
+        if user_id in self._unloaded_owners:
+            return
+        try:
+            self._dirty_users[user_id] = json.dumps(data, separators=(',', ':'))
+        except (TypeError, ValueError) as e:
+            logger.error("user_data of %s is not JSON serializable, not persisted: %s", user_id, e)
+            return
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._dirty_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        handler = self._conversation_handlers.get(name)
+        owner_id = key[int(handler.per_chat)] if handler is not None and handler.per_user else key[0]
+        if owner_id in self._unloaded_owners:
+            return
+        self._dirty_conversations[(name, json.dumps(list(key)))] = (owner_id, new_state)
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _schedule_write(self):
+        # update_persistence reports every change of a round as separate
+        # coroutines gathered together; the write is started once and runs
+        # after all of them have been collected.
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_soon())
+
+    async def _write_soon(self):
+        await asyncio.sleep(0)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        if not users and not conversations:
+            return
+        try:
+            await self.database.run(_write_state, users, conversations)
+        except DatabaseError as e:
+            logger.error("Failed to write persisted state, retrying next round: %s", e)
+            # Newer changes reported in the meantime win
+            for user_id, data in users.items():
+                self._dirty_users.setdefault(user_id, data)
+            for key, value in conversations.items():
+                self._dirty_conversations.setdefault(key, value)
+            return
+        self.written += len(users) + len(conversations)
+
+    async def flush(self):
+        # Called by Application.stop() after the final update_persistence
+        if self._writer is not None:
+            await asyncio.gather(self._writer, return_exceptions=True)
+        await self._write_pending()
+
+
+def _read_state(cursor, owner_id):
+    cursor.execute(USER_READ_SQL, (owner_id,))
+    user_row = cursor.fetchone()
+    cursor.execute(CONVERSATIONS_READ_SQL, (owner_id,))
+    return user_row, cursor.fetchall()
+
+
+def _write_state(cursor, users, conversations):
+    upserts = [(user_id, data) for user_id, data in users.items() if data is not None]
+    deletes = [(user_id,) for user_id, data in users.items() if data is None]
+    if upserts:
+        cursor.executemany(USER_UPSERT_SQL, upserts)
+    if deletes:
+        cursor.executemany(USER_DELETE_SQL, deletes)
+
+    # Ended conversations are deleted rather than stored as END
+    upserts = []
+    deletes = []
+    for (name, conversation_key), (owner_id, state) in conversations.items():
+        if state is None or state == ConversationHandler.END:
+            deletes.append((name, conversation_key))
+        else:
+            upserts.append((name, conversation_key, owner_id, state))
+    if upserts:
+        cursor.executemany(CONVERSATION_UPSERT_SQL, upserts)
+    if deletes:
+        cursor.executemany(CONVERSATION_DELETE_SQL, deletes)
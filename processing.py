@@ -0,0 +1,112 @@
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor, ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+# The base class semaphore is acquired before do_process_update is called. It
+# is left effectively unbounded and the real limit is applied after the
+# per-user lock, so a single user queueing many updates cannot hold slots that
+# other users' updates need.
+UNBOUNDED = 2 ** 31 - 1
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Processes updates concurrently, at most `limit` at a time, while updates
+    # from the same user run strictly in arrival order so ConversationHandler
+    # state transitions stay consistent.
+
+    def __init__(self, limit, drain_timeout=30.0, loader=None):
+        super().__init__(UNBOUNDED)
+        if limit < 1:
+            raise ValueError("limit must be a positive integer")
+        self.limit = limit
+        self.drain_timeout = drain_timeout
+        # Optional coroutine function awaited with the ordering key before each
+        # update of that key, e.g. to load persisted state on first contact
+        self.loader = loader
+        self._slots = asyncio.BoundedSemaphore(limit)
+        self._locks = {}  # ordering key -> [asyncio.Lock, number of updates holding or waiting]
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def waiting_users(self):
+        return len(self._locks)
+
+    @staticmethod
+    def ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                return update.effective_user.id
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        self._in_flight += 1
+        self._idle.clear()
+        key = self.ordering_key(update)
+        entry = None
+        try:
+            if key is None:
+                async with self._slots:
+                    await coroutine
+                return
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            # asyncio.Lock wakes waiters first-in first-out, and nothing above
+            # awaits before the acquire, so same-user updates keep their order.
+            async with entry[0]:
+                if self.loader is not None:
+                    await self.loader(key)
+                async with self._slots:
+                    await coroutine
+        finally:
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0 and self._locks.get(key) is entry:
+                    del self._locks[key]
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.set()
+
+    async def drain(self, timeout=None):
+        # Waits for in-flight updates to finish; returns False on timeout
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning("%d updates still in flight after %.1fs drain", self._in_flight, timeout)
+            return False
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        # Application.stop() already waits for queued updates; this also covers
+        # updates fed in directly through process_update().
+        await self.drain(self.drain_timeout)
+
+
+def iter_handlers(application):
+    # Every handler of the application, including the entry points, states and
+    # fallbacks of conversations, for wrapping their callbacks
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                yield from handler.entry_points
+                for state_handlers in handler.states.values():
+                    yield from state_handlers
+                yield from handler.fallbacks
+            else:
+                yield handler
@@ -0,0 +1,215 @@
+import time
+import logging
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ALLOW = 'allow'
+DENY = 'deny'
+BAN = 'ban'
+
+LOAD_SQL = "SELECT user_id, action, a, b, c FROM rate_limit_state WHERE updated_at >= %s"
+LOAD_SHARD_SQL = LOAD_SQL + " AND MOD(user_id, %s) = %s"
+UPSERT_SQL = (
+    "INSERT INTO rate_limit_state (user_id, action, a, b, c, updated_at) VALUES (%s, %s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE a = VALUES(a), b = VALUES(b), c = VALUES(c), updated_at = VALUES(updated_at)"
+)
+DELETE_SQL = "DELETE FROM rate_limit_state WHERE user_id = %s AND action = %s"
+
+
+# Policies keep their per-user state in a fixed array of three doubles so every
+# tracked (action, user) pair costs the same few bytes, whatever the policy.
+# Timestamps are wall-clock seconds so checkpointed state survives a restart.
+
+class TokenBucket:
+    # state: [tokens, updated_at, unused]
+
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate  # tokens per second
+
+    @property
+    def horizon(self):
+        return self.capacity / self.refill_rate
+
+    def new_state(self, now):
+        return array('d', (self.capacity, now, 0.0))
+
+    def _refill(self, state, now):
+        return min(self.capacity, state[0] + (now - state[1]) * self.refill_rate)
+
+    def hit(self, state, now):
+        tokens = self._refill(state, now)
+        state[1] = now
+        if tokens >= 1:
+            state[0] = tokens - 1
+            return True
+        state[0] = tokens
+        return False
+
+    def delay(self, state, now):
+        # Seconds until hit() would succeed
+        return max(0.0, (1 - self._refill(state, now)) / self.refill_rate)
+
+    def is_idle(self, state, now):
+        return self._refill(state, now) >= self.capacity
+
+
+class SlidingWindow:
+    # Sliding-window counter: the previous window's count is weighted by how
+    # much of it still overlaps the sliding window.
+    # state: [window_start, current_count, previous_count]
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+
+    @property
+    def horizon(self):
+        return 2 * self.window
+
+    def new_state(self, now):
+        return array('d', (now, 0.0, 0.0))
+
+    def _roll(self, state, now):
+        elapsed = now - state[0]
+        if elapsed >= 2 * self.window:
+            state[0], state[1], state[2] = now, 0.0, 0.0
+        elif elapsed >= self.window:
+            state[0], state[1], state[2] = state[0] + self.window, 0.0, state[1]
+
+    def hit(self, state, now):
+        self._roll(state, now)
+        overlap = 1 - (now - state[0]) / self.window
+        estimate = state[2] * overlap + state[1]
+        if estimate + 1 > self.limit:
+            return False
+        state[1] += 1
+        return True
+
+    def is_idle(self, state, now):
+        return now - state[0] >= 2 * self.window
+
+
+class Rule:
+    def __init__(self, policy, on_exceed=DENY):
+        self.policy = policy
+        self.on_exceed = on_exceed
+
+
+class RateLimiter:
+    def __init__(self, rules, max_entries=100000):
+        self.rules = rules
+        self.max_entries = max_entries
+        self._states = OrderedDict()  # (action, user_id) -> array, least recently used first
+        self._dirty = set()
+        self._evicted = set()  # idle or reset: deleted from the database
+        # Dropped for capacity while changed since the last checkpoint; written
+        # by the next one so the stored state stays current
+        self._unsaved = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def hit(self, action, user_id, now=None):
+        rule = self.rules.get(action)
+        if rule is None:
+            return ALLOW
+        now = time.time() if now is None else now
+        key = (action, user_id)
+        state = self._states.get(key)
+        if state is None:
+            state = self._unsaved.pop(key, None) or rule.policy.new_state(now)
+            self._states[key] = state
+            self._evicted.discard(key)
+            if len(self._states) > self.max_entries:
+                self._evict_oldest()
+        else:
+            self._states.move_to_end(key)
+        self._dirty.add(key)
+        if rule.policy.hit(state, now):
+            return ALLOW
+        return rule.on_exceed
+
+    def reset(self, action, user_id):
+        key = (action, user_id)
+        self._unsaved.pop(key, None)
+        if self._states.pop(key, None) is not None:
+            self._dirty.discard(key)
+            self._evicted.add(key)
+
+    def _evict_oldest(self):
+        # Only the in-memory copy goes; the stored state is still valid
+        key, state = self._states.popitem(last=False)
+        if key in self._dirty:
+            self._dirty.discard(key)
+            self._unsaved[key] = state
+
+    def evict_idle(self, now=None):
+        # Every entry is checked: idle horizons differ between rules, and a
+        # bucket's idleness depends on its tokens, not only on when it was
+        # last hit, so LRU order says nothing about which entries are idle.
+        now = time.time() if now is None else now
+        evicted = 0
+        for key, state in list(self._states.items()):
+            rule = self.rules.get(key[0])
+            if rule is not None and not rule.policy.is_idle(state, now):
+                continue
+            del self._states[key]
+            self._dirty.discard(key)
+            self._evicted.add(key)
+            evicted += 1
+        return evicted
+
+    def load(self, database, shard=None):
+        # Synchronous restore used at startup; only rows young enough to still
+        # matter under the longest configured policy are read back. With
+        # shard=(index, count), only users routed to that worker are loaded.
+        horizon = max(rule.policy.horizon for rule in self.rules.values())
+        since = datetime.fromtimestamp(time.time() - horizon)
+
+        def read(cursor):
+            if shard is None:
+                cursor.execute(LOAD_SQL, (since,))
+            else:
+                index, count = shard
+                cursor.execute(LOAD_SHARD_SQL, (since, count, index))
+            return cursor.fetchall()
+
+        for user_id, action, a, b, c in database.call(read):
+            if action in self.rules:
+                self._states[(action, user_id)] = array('d', (a, b, c))
+        logger.info("Restored %d rate limit entries", len(self._states))
+
+    async def checkpoint(self, database):
+        self.evict_idle()
+        if not self._dirty and not self._evicted and not self._unsaved:
+            return 0
+        now = datetime.fromtimestamp(time.time())
+        rows = [(key[1], key[0], *self._states[key], now) for key in self._dirty]
+        rows += [(key[1], key[0], *state, now) for key, state in self._unsaved.items()]
+        unsaved = self._unsaved
+        deleted = [(key[1], key[0]) for key in self._evicted]
+        self._dirty = set()
+        self._evicted = set()
+        self._unsaved = {}
+
+        def write(cursor):
+            if rows:
+                cursor.executemany(UPSERT_SQL, rows)
+            if deleted:
+                cursor.executemany(DELETE_SQL, deleted)
+
+        try:
+            await database.run(write)
+        except Exception:
+            # Keep the entries dirty so the next checkpoint retries them
+            self._dirty.update((row[1], row[0]) for row in rows if (row[1], row[0]) in self._states)
+            for key, state in unsaved.items():
+                if key not in self._states and key not in self._evicted:
+                    self._unsaved.setdefault(key, state)
+            self._evicted.update((row[1], row[0]) for row in deleted)
+            raise
+        return len(rows) + len(deleted)
@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+
+from telegram.error import RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+PENDING_DUE_SQL = (
+    "SELECT user_id, cooldown_until FROM users "
+    "WHERE status = 'pending' AND cooldown_until > %s AND cooldown_until <= %s "
+    "AND (verified_at IS NULL OR verified_at < cooldown_until){shard} ORDER BY cooldown_until LIMIT %s"
+)
+MEMBERS_DUE_SQL = (
+    "SELECT user_id, verified_at FROM users "
+    "WHERE status = 'member' AND (verified_at IS NULL OR verified_at <= %s){shard} ORDER BY verified_at LIMIT %s"
+)
+SHARD_FILTER = " AND MOD(user_id, {count}) = {index}"
+ROWS_SQL = "SELECT user_id, status, cooldown_until, verified_at FROM users WHERE user_id IN ({placeholders})"
+# Only applied when the status is still the one the check started from, so a
+# ban or approval that landed in the meantime is never overwritten
+UPDATE_SQL = "UPDATE users SET status = %s, verified_at = %s WHERE user_id = %s AND status = %s"
+
+
+class Reconciler:
+    # Re-verifies whitelist membership ahead of time so /start can trust the
+    # stored status. Two kinds of users come due:
+    #   - pending users, when cooldown_until passes
+    #   - members, when verified_at is older than `freshness` seconds
+    # Upcoming due times are kept in a heap, loaded `horizon` seconds ahead
+    # from the database and extended by handlers as they set new cooldowns.
+    # Each run checks at most `batch` due users, paced at `rate` Bot API calls
+    # per second, and writes the results in one executemany.
+
+    def __init__(self, database, freshness=6 * 3600, horizon=3600, batch=100, rate=5.0,
+                 max_loaded=10000, retry_delay=300, shard=None, overlay=None):
+        self.database = database
+        self.freshness = freshness
+        self.horizon = horizon
+        self.batch = batch
+        self.rate = rate
+        self.max_loaded = max_loaded
+        self.retry_delay = retry_delay
+        # (index, count): only users routed to this worker
+        self.shard = shard
+        # overlay(user_id, row) -> row with queued, uncommitted changes applied
+        self.overlay = overlay
+        self.checked = 0
+        self.promoted = 0
+        self.demoted = 0
+        self.failed = 0
+        self._heap = []  # (due timestamp, user_id)
+        self._due = {}  # user_id -> due timestamp of its live heap entry
+        self._loaded_until = None
+        self._paused_until = 0.0
+
+    def __len__(self):
+        return len(self._due)
+
+    def schedule(self, user_id, due):
+        # `due` is a datetime or a timestamp. Anything past the loaded window
+        # is picked up by a later load instead of growing the heap.
+        due = due.timestamp() if isinstance(due, datetime) else due
+        if self._loaded_until is None or due > self._loaded_until:
+            return
+        self._due[user_id] = due
+        heapq.heappush(self._heap, (due, user_id))
+
+    def _sql(self, template):
+        shard = ""
+        if self.shard is not None:
+            index, count = self.shard
+            shard = SHARD_FILTER.format(count=int(count), index=int(index))
+        return template.format(shard=shard)
+
+    async def load(self, now=None):
+        # Extends the loaded window to now + horizon. The first load also
+        # takes pending users whose cooldown ended up to `freshness` ago and
+        # were never re-checked, e.g. across a restart.
+        now = time.time() if now is None else now
+        until = now + self.horizon
+        since = self._loaded_until if self._loaded_until is not None else now - self.freshness
+        if len(self._due) >= self.max_loaded:
+            return 0
+        limit = self.max_loaded - len(self._due)
+
+        def read(cursor):
+            cursor.execute(self._sql(PENDING_DUE_SQL), (datetime.fromtimestamp(since), datetime.fromtimestamp(until), limit))
+            pending = cursor.fetchall()
+            cursor.execute(self._sql(MEMBERS_DUE_SQL), (datetime.fromtimestamp(until - self.freshness), limit))
+            return pending, cursor.fetchall()
+
+        pending, members = await self.database.run(read)
+        # A truncated read resumes after the last pending row next time
+        self._loaded_until = pending[-1][1].timestamp() if len(pending) >= limit else until
+        added = 0
+        for user_id, cooldown_until in pending:
+            if user_id not in self._due:
+                self.schedule(user_id, cooldown_until)
+                added += 1
+        for user_id, verified_at in members:
+            if user_id not in self._due:
+                self.schedule(user_id, verified_at.timestamp() + self.freshness if verified_at else now)
+                added += 1
+        return added
+
+    def _pop_due(self, now):
+        users = []
+        while self._heap and self._heap[0][0] <= now and len(users) < self.batch:
+            due, user_id = heapq.heappop(self._heap)
+            # Entries superseded by a later schedule() are skipped
+            if self._due.get(user_id) == due:
+                del self._due[user_id]
+                users.append(user_id)
+        return users
+
+    async def run(self, check, now=None):
+        # check(user_id) -> 'member' | 'not_member'; raises TelegramError when
+        # membership could not be determined
+        now = time.time() if now is None else now
+        if now < self._paused_until:
+            return 0
+        if self._loaded_until is None or self._loaded_until - now < self.horizon / 2:
+            await self.load(now)
+        users = self._pop_due(now)
+        if not users:
+            return 0
+
+        def read(cursor):
+            placeholders = ', '.join(['%s'] * len(users))
+            cursor.execute(ROWS_SQL.format(placeholders=placeholders), users)
+            return cursor.fetchall()
+
+        rows = {row[0]: row[1:] for row in await self.database.run(read)}
+        updates = []
+        interval = 1.0 / self.rate
+        next_call = time.monotonic()
+        for position, user_id in enumerate(users):
+            row = rows.get(user_id)
+            if row is None:
+                continue
+            status, cooldown_until, verified_at = row
+            if self.overlay is not None and self.overlay(user_id, row) != row:
+                # A handler's change is still queued; look again once it is committed
+                self.schedule(user_id, now + 60)
+                continue
+            if status == 'pending' and cooldown_until is not None and cooldown_until.timestamp() > now:
+                # The cooldown was extended since it was scheduled
+                self.schedule(user_id, cooldown_until)
+                continue
+            if status not in ('pending', 'member'):
+                continue
+
+            delay = next_call - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_call = max(next_call + interval, time.monotonic())
+            try:
+                membership = await check(user_id)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self._paused_until = time.time() + retry_after
+                for remaining in users[position:]:
+                    self.schedule(remaining, self._paused_until)
+                logger.warning("Membership reconciliation paused for %ss", retry_after)
+                break
+            except TelegramError as e:
+                self.failed += 1
+                logger.warning("Could not verify membership of %s: %s", user_id, e)
+                self.schedule(user_id, now + self.retry_delay)
+                continue
+            self.checked += 1
+            new_status = 'member' if membership == 'member' else 'pending'
+            if new_status != status:
+                if new_status == 'member':
+                    self.promoted += 1
+                else:
+                    self.demoted += 1
+            updates.append((new_status, datetime.fromtimestamp(time.time()), user_id, status))
+
+        if updates:
+            await self.database.execute_many(UPDATE_SQL, updates)
+            for new_status, verified_at, user_id, status in updates:
+                if new_status == 'member':
+                    self.schedule(user_id, verified_at.timestamp() + self.freshness)
+        return len(updates)
+
+    def stats(self):
+        return {
+            'scheduled': len(self._due),
+            'checked': self.checked,
+            'promoted': self.promoted,
+            'demoted': self.demoted,
+            'failed': self.failed,
+        }
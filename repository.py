@@ -0,0 +1,307 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+from database import Database, DatabaseError
+from tickets import PAGE_SIZE, page_query
+
+logger = logging.getLogger(__name__)
+
+# Storage behind typed methods, so callers do not depend on one SQL dialect.
+# MySQLRepository runs on the shared Database pool; SQLiteRepository is an
+# embedded single-file store. Both are held to the same behaviour by
+# tests/test_repository.py and measured by bench/repository.py.
+#
+# Only user lookups and the /tickets inbox go through a repository. Everything
+# else (the write-behind queue, catalog, rate limits, archiving, search,
+# broadcasts, shared events) still issues MySQL statements through Database,
+# so the bot cannot run on SQLite: with STORAGE_BACKEND=sqlite it refuses to
+# start. A method belongs here once the bot calls it, not before.
+#
+#   STORAGE_BACKEND  'mysql' (default) or 'sqlite'
+#   SQLITE_PATH      database file for 'sqlite'
+
+User = namedtuple('User', 'user_id status cooldown_until verified_at')
+Ticket = namedtuple('Ticket', 'id category_id user_id message timestamp status duplicates')
+
+
+class Repository:
+    # The methods are shared; subclasses run cursor functions with _read (no
+    # writes) or _write, and translate placeholders in _sql.
+
+    USER_SQL = "SELECT user_id, status, cooldown_until, verified_at FROM users WHERE user_id = %s"
+    CLOSE_TICKET_SQL = (
+        "UPDATE ticket SET status = 'closed', closed_at = %s, closed_by = %s WHERE id = %s AND status = 'open'"
+    )
+
+    async def _read(self, fn, *args):
+        raise NotImplementedError
+
+    async def _write(self, fn, *args):
+        raise NotImplementedError
+
+    def _sql(self, sql):
+        return sql
+
+    async def get_user(self, user_id):
+        def read(cursor):
+            cursor.execute(self._sql(self.USER_SQL), (user_id,))
+            row = cursor.fetchone()
+            return User(*row) if row else None
+        return await self._read(read)
+
+    async def page_tickets(self, filters, after=None, page_size=PAGE_SIZE):
+        # A page of the /tickets inbox, with its filters and keyset cursor
+        sql, params = page_query(filters, after, page_size)
+
+        def read(cursor):
+            cursor.execute(self._sql(sql), params)
+            return cursor.fetchall()
+        rows = [Ticket(*row) for row in await self._read(read)]
+        return rows[:page_size], len(rows) > page_size
+
+    async def close_ticket(self, ticket_id, admin_id):
+        # Primary-key update; False if it was already closed or does not exist
+        def write(cursor):
+            cursor.execute(self._sql(self.CLOSE_TICKET_SQL), (datetime.now(), admin_id, ticket_id))
+            return cursor.rowcount > 0
+        return await self._write(write)
+
+    def close(self):
+        pass
+
+
+class MySQLRepository(Repository):
+    # On the shared Database pool; the schema comes from migrations.py
+
+    def __init__(self, database):
+        self.database = database
+
+    async def _read(self, fn, *args):
+        return await self.database.run(fn, *args)
+
+    async def _write(self, fn, *args):
+        return await self.database.run(fn, *args)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    cooldown_until DATETIME,
+    verified_at DATETIME,
+    created_at DATETIME DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_users_status_cooldown ON users (status, cooldown_until);
+CREATE INDEX IF NOT EXISTS idx_users_status_verified ON users (status, verified_at);
+CREATE TABLE IF NOT EXISTS ticket_category (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    category_name TEXT NOT NULL UNIQUE,
+    description TEXT
+);
+CREATE TABLE IF NOT EXISTS ticket (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    category_id INTEGER NOT NULL REFERENCES ticket_category (id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+    message TEXT NOT NULL,
+    timestamp DATETIME DEFAULT (datetime('now', 'localtime')),
+    status TEXT NOT NULL DEFAULT 'open',
+    closed_at DATETIME,
+    closed_by INTEGER,
+    duplicates INTEGER NOT NULL DEFAULT 0,
+    last_duplicate_at DATETIME
+);
+CREATE INDEX IF NOT EXISTS idx_ticket_category_time ON ticket (category_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_ticket_user_time ON ticket (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_ticket_status_time ON ticket (status, timestamp);
+CREATE TABLE IF NOT EXISTS ticket_archive (
+    id INTEGER PRIMARY KEY,
+    category_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    timestamp DATETIME,
+    status TEXT NOT NULL,
+    closed_at DATETIME,
+    closed_by INTEGER,
+    duplicates INTEGER NOT NULL DEFAULT 0,
+    last_duplicate_at DATETIME,
+    archived_at DATETIME DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_ticket_archive_time ON ticket_archive (timestamp);
+"""
+
+# DATETIME columns round-trip as datetime objects, like the MySQL driver returns them
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(sep=' '))
+sqlite3.register_converter('DATETIME', lambda value: datetime.fromisoformat(value.decode()))
+
+
+class SQLiteRepository(Repository):
+    # Embedded store tuned for many concurrent readers and one writer:
+    #   - WAL journal, so reads never wait for the writer and vice versa
+    #   - every write runs on one dedicated writer thread and connection, and
+    #     writes queued while a transaction runs are committed together with
+    #     the next one (one fsync per group, each write in its own savepoint)
+    #   - reads run on a small pool, one read-only connection per thread
+    #   - statements are constants, so each connection's statement cache
+    #     keeps them prepared
+
+    def __init__(self, path, readers=4, max_group=256, statement_cache=256):
+        self.path = path
+        self.max_group = max_group
+        self.statement_cache = statement_cache
+        self.pending = 0
+        self.groups = 0  # write transactions committed
+        self.writes = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        writer = self._connect()
+        writer.executescript(SQLITE_SCHEMA)
+        writer.commit()
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_forever, args=(writer,), name='sqlite-writer', daemon=True)
+        self._writer.start()
+        self._local = threading.local()
+        self._reader_connections = []
+        self._reader_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='sqlite-reader')
+
+    def _connect(self, read_only=False):
+        # Autocommit mode: transactions are begun explicitly by the writer
+        connection = sqlite3.connect(
+            self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False,
+            isolation_level=None, cached_statements=self.statement_cache,
+        )
+        connection.execute("PRAGMA journal_mode = WAL")
+        # Durable at checkpoints; a power loss can only lose the last commits
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute("PRAGMA busy_timeout = 5000")
+        if read_only:
+            connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    def _sql(self, sql):
+        # Shared statements are written with MySQL's placeholders
+        return sql.replace('%s', '?')
+
+    def _reader(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect(read_only=True)
+            with self._reader_lock:
+                self._reader_connections.append(connection)
+        return connection
+
+    def _run_read(self, fn, *args):
+        cursor = self._reader().cursor()
+        try:
+            # One snapshot for all statements of fn
+            cursor.execute("BEGIN")
+            try:
+                return fn(cursor, *args)
+            finally:
+                cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            raise DatabaseError(str(e)) from e
+        finally:
+            cursor.close()
+
+    async def _read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self._readers, self._run_read, fn, *args)
+        finally:
+            self.pending -= 1
+
+    def call_write(self, fn, *args):
+        # Blocking form, for callers outside the event loop
+        future = Future()
+        self._writes.put((fn, args, future))
+        return future.result()
+
+    async def _write(self, fn, *args):
+        future = Future()
+        self._writes.put((fn, args, future))
+        self.pending += 1
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            self.pending -= 1
+
+    def _write_forever(self, connection):
+        cursor = connection.cursor()
+        while True:
+            job = self._writes.get()
+            if job is None:
+                break
+            jobs = [job]
+            # Group commit: whatever queued up meanwhile shares the transaction
+            while len(jobs) < self.max_group:
+                try:
+                    job = self._writes.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._writes.put(None)
+                    break
+                jobs.append(job)
+            self._commit_group(connection, cursor, jobs)
+        cursor.close()
+        connection.close()
+
+    def _commit_group(self, connection, cursor, jobs):
+        results = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for fn, args, future in jobs:
+                # A failing write is rolled back alone; the others still commit
+                cursor.execute("SAVEPOINT job")
+                try:
+                    results.append((future, fn(cursor, *args), None))
+                    cursor.execute("RELEASE job")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                    error = DatabaseError(str(e)) if isinstance(e, sqlite3.Error) else e
+                    results.append((future, None, error))
+            cursor.execute("COMMIT")
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.rollback()
+            error = DatabaseError(f"Write transaction failed: {e}")
+            for _, _, future in jobs:
+                future.set_exception(error)
+            return
+        self.groups += 1
+        self.writes += len(jobs)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        # Queued writes are committed first
+        self._writes.put(None)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+        with self._reader_lock:
+            for connection in self._reader_connections:
+                connection.close()
+            self._reader_connections.clear()
+
+
+def from_env(database=None):
+    # The repository chosen by STORAGE_BACKEND
+    backend = os.environ.get('STORAGE_BACKEND', 'mysql')
+    if backend == 'sqlite':
+        return SQLiteRepository(os.environ.get('SQLITE_PATH', 'data/bot.sqlite3'))
+    if backend == 'mysql':
+        return MySQLRepository(database if database is not None else Database.from_env())
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}")
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+TICKET_COLUMNS = "id, category_id, user_id, message, timestamp, status, closed_at, closed_by, duplicates, last_duplicate_at"
+
+# Only closed tickets are archived: they are due when they were closed
+# `closed_days` ago, or created `max_age_days` ago (which also catches tickets
+# closed before closed_at was recorded). An open ticket stays in the hot table
+# however old it is, or it would drop out of the admins' inbox unanswered.
+# Each policy is its own range scan (idx_ticket_status_closed,
+# idx_ticket_status_time), oldest first.
+# Rows another worker is archiving (e.g. an admin's /archive run) are skipped.
+DUE_CLOSED_SQL = (
+    "SELECT id FROM ticket WHERE status = 'closed' AND closed_at < %s ORDER BY closed_at LIMIT %s FOR UPDATE SKIP LOCKED"
+)
+DUE_OLD_SQL = (
+    "SELECT id FROM ticket WHERE status = 'closed' AND timestamp < %s ORDER BY timestamp LIMIT %s FOR UPDATE SKIP LOCKED"
+)
+OLDEST_SQL = (
+    "SELECT (SELECT MIN(closed_at) FROM ticket WHERE status = 'closed'), "
+    "(SELECT MIN(timestamp) FROM ticket WHERE status = 'closed')"
+)
+ARCHIVE_SQL = (
+    f"INSERT IGNORE INTO ticket_archive ({TICKET_COLUMNS}) "
+    f"SELECT {TICKET_COLUMNS} FROM ticket WHERE id IN ({{placeholders}})"
+)
+DELETE_TICKETS_SQL = "DELETE FROM ticket WHERE id IN ({placeholders})"
+
+# Pending users whose cooldown ran out long ago and who have no tickets in the
+# hot table; deleting them is the same as never having pressed the button.
+# Banned users are kept: the row is what keeps them banned.
+DUE_USERS_SQL = (
+    "SELECT user_id FROM users WHERE status = 'pending' AND created_at < %s "
+    "AND (cooldown_until IS NULL OR cooldown_until < %s) "
+    "AND NOT EXISTS (SELECT 1 FROM ticket WHERE ticket.user_id = users.user_id) "
+    "ORDER BY user_id LIMIT %s"
+)
+DELETE_USERS_SQL = (
+    "DELETE FROM users WHERE user_id IN ({placeholders}) AND status = 'pending' "
+    "AND (cooldown_until IS NULL OR cooldown_until < %s) "
+    "AND NOT EXISTS (SELECT 1 FROM ticket t WHERE t.user_id = users.user_id)"
+)
+# Estimates from the storage engine; exact counts would scan the tables
+TABLE_SIZES_SQL = (
+    "SELECT table_name, table_rows, data_length + index_length FROM information_schema.tables "
+    "WHERE table_schema = DATABASE() AND table_name IN ('ticket', 'ticket_archive', 'users') ORDER BY table_name"
+)
+
+
+class Archiver:
+    # Keeps the hot tables small. Each run moves due tickets to ticket_archive
+    # and deletes stale pending users in batches of `batch` rows, one
+    # transaction per batch, pausing `pause` seconds between batches so
+    # handlers keep their share of the database. A run stops after
+    # `max_batches` batches; whatever is left is the lag reported until the
+    # next run catches up. Listeners are given the ids of each committed batch
+    # of archived tickets.
+
+    def __init__(self, database, closed_days=30, max_age_days=180, pending_user_days=90,
+                 batch=1000, pause=0.5, max_batches=100, metrics=None):
+        self.database = database
+        self.closed_days = closed_days
+        self.max_age_days = max_age_days
+        self.pending_user_days = pending_user_days
+        self.batch = batch
+        self.pause = pause
+        self.max_batches = max_batches
+        self.metrics = metrics
+        self.tickets_archived = 0
+        self.users_deleted = 0
+        self.last_run = None  # {'finished_at', 'seconds', 'tickets', 'users', 'rows_per_second'}
+        self.lag_seconds = 0.0
+        self.listeners = []
+        self._running = asyncio.Lock()
+
+    def cutoffs(self, now=None):
+        now = datetime.now() if now is None else now
+        return (
+            now - timedelta(days=self.closed_days),
+            now - timedelta(days=self.max_age_days),
+            now - timedelta(days=self.pending_user_days),
+        )
+
+    def _archive_batch(self, cursor, due_sql, before):
+        cursor.execute(due_sql, (before, self.batch))
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            placeholders = ', '.join(['%s'] * len(ids))
+            cursor.execute(ARCHIVE_SQL.format(placeholders=placeholders), ids)
+            cursor.execute(DELETE_TICKETS_SQL.format(placeholders=placeholders), ids)
+        return ids
+
+    def _delete_users_batch(self, cursor, created_before):
+        cursor.execute(DUE_USERS_SQL, (created_before, created_before, self.batch))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        if not user_ids:
+            return 0
+        placeholders = ', '.join(['%s'] * len(user_ids))
+        # The conditions are checked again: a user may have pressed the button
+        # or opened a ticket since
+        cursor.execute(DELETE_USERS_SQL.format(placeholders=placeholders), (*user_ids, created_before))
+        return cursor.rowcount
+
+    async def run(self, now=None):
+        # One pass over both policies; returns (tickets archived, users deleted)
+        if self._running.locked():
+            return 0, 0
+        async with self._running:
+            closed_before, created_before, pending_before = self.cutoffs(now)
+            started = time.monotonic()
+            tickets = users = 0
+            batches = 0
+            for due_sql, before in ((DUE_CLOSED_SQL, closed_before), (DUE_OLD_SQL, created_before)):
+                while batches < self.max_batches:
+                    ids = await self.database.run(self._archive_batch, due_sql, before)
+                    count = len(ids)
+                    tickets += count
+                    if ids:
+                        await self._archived(ids)
+                    batches += 1
+                    self._count('archive_rows_total', count, table='ticket')
+                    if count < self.batch:
+                        break
+                    await asyncio.sleep(self.pause)
+            while batches < self.max_batches:
+                count = await self.database.run(self._delete_users_batch, pending_before)
+                users += count
+                batches += 1
+                self._count('archive_rows_total', count, table='users')
+                if count < self.batch:
+                    break
+                await asyncio.sleep(self.pause)
+            seconds = time.monotonic() - started
+            self.tickets_archived += tickets
+            self.users_deleted += users
+            self.last_run = {
+                'finished_at': datetime.now().isoformat(sep=' ', timespec='seconds'),
+                'seconds': round(seconds, 3),
+                'tickets': tickets,
+                'users': users,
+                'rows_per_second': round((tickets + users) / seconds, 1) if seconds > 0 else 0.0,
+            }
+            await self.measure_lag(now)
+            if self.metrics is not None:
+                self.metrics.observe('archive_run_seconds', seconds)
+            if tickets or users:
+                logger.info("Archived %d tickets and deleted %d stale pending users in %.1fs", tickets, users, seconds)
+            return tickets, users
+
+    async def measure_lag(self, now=None):
+        # How long the oldest due ticket has been due; 0 when archival is caught up
+        closed_before, created_before, _ = self.cutoffs(now)
+        row = await self.database.fetch_one(OLDEST_SQL)
+        oldest_closed, oldest_created = row if row else (None, None)
+        lag = 0.0
+        if oldest_closed is not None:
+            lag = max(lag, (closed_before - oldest_closed).total_seconds())
+        if oldest_created is not None:
+            lag = max(lag, (created_before - oldest_created).total_seconds())
+        self.lag_seconds = lag
+        return lag
+
+    async def table_sizes(self):
+        # [(table, approximate rows, bytes on disk)]
+        return await self.database.fetch_all(TABLE_SIZES_SQL)
+
+    async def _archived(self, ticket_ids):
+        for listener in self.listeners:
+            try:
+                await listener(ticket_ids)
+            except Exception as e:
+                logger.error("Archive listener failed: %s", e)
+
+    def _count(self, name, amount, **labels):
+        if self.metrics is not None and amount:
+            self.metrics.inc(name, amount, **labels)
+
+    def stats(self):
+        stats = {
+            'tickets_archived': self.tickets_archived,
+            'users_deleted': self.users_deleted,
+            'lag_seconds': round(self.lag_seconds, 1),
+        }
+        if self.last_run is not None:
+            stats['last_run_rows_per_second'] = self.last_run['rows_per_second']
+        return stats
@@ -0,0 +1,198 @@
+import asyncio
+import html
+import logging
+import math
+import re
+from collections import Counter
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from tickets import similar
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 5
+# Ranked ids kept per search; pages are cut from these
+MAX_RESULTS = 100
+SNIPPET_LENGTH = 200
+
+FULLTEXT_SQL = (
+    "SELECT id, MATCH(message) AGAINST (%s IN NATURAL LANGUAGE MODE) AS score FROM ticket "
+    "WHERE MATCH(message) AGAINST (%s IN NATURAL LANGUAGE MODE) ORDER BY score DESC, id DESC LIMIT %s"
+)
+ROWS_SQL = "SELECT id, category_id, user_id, message, timestamp, status, duplicates FROM ticket WHERE id IN ({placeholders})"
+CATCH_UP_SQL = "SELECT id, message FROM ticket WHERE id > %s ORDER BY id LIMIT %s"
+
+# Letters and digits, as InnoDB's full-text parser splits them
+_TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+MIN_TOKEN_LENGTH = 3
+
+
+def tokenize(text):
+    return [token for token in _TOKEN_PATTERN.findall(text.lower()) if len(token) >= MIN_TOKEN_LENGTH]
+
+
+class FulltextSearch:
+    # Ranked search through the FULLTEXT index on ticket.message. InnoDB adds
+    # new rows to the index as they commit, so there is nothing to maintain here.
+
+    def __init__(self, database):
+        self.database = database
+
+    async def start(self):
+        pass
+
+    async def search(self, query, limit=MAX_RESULTS):
+        rows = await self.database.fetch_all(FULLTEXT_SQL, (query, query, limit))
+        return [(ticket_id, score) for ticket_id, score in rows]
+
+
+class InvertedIndex:
+    # In-process fallback for backends without FULLTEXT: token -> {ticket id:
+    # term frequency}, ranked with BM25. Tickets are added incrementally by id;
+    # before every search the index reads the tickets committed since the last
+    # one, from any worker. Ids are handed out at insert but become visible at
+    # commit, so the read starts `overlap` ids back to pick up rows whose
+    # transaction finished after a higher id was already indexed.
+    #
+    # Archived tickets are removed by id. Their postings are left in place and
+    # skipped by searches until removed tickets make up a quarter of the index,
+    # when one sweep drops them all.
+
+    def __init__(self, database, batch=5000, overlap=500, k1=1.2, b=0.75):
+        self.database = database
+        self.batch = batch
+        self.overlap = overlap
+        self.k1 = k1
+        self.b = b
+        self.last_id = 0
+        self._postings = {}  # token -> {ticket_id: tf}
+        self._lengths = {}  # ticket_id -> number of tokens
+        self._total_length = 0
+        self._removed = 0  # tickets removed since the last sweep of the postings
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, ticket_id, text):
+        if ticket_id in self._lengths:
+            return False
+        tokens = tokenize(text)
+        for token, count in Counter(tokens).items():
+            self._postings.setdefault(token, {})[ticket_id] = count
+        self._lengths[ticket_id] = len(tokens)
+        self._total_length += len(tokens)
+        self.last_id = max(self.last_id, ticket_id)
+        return True
+
+    def remove(self, ticket_id):
+        length = self._lengths.pop(ticket_id, None)
+        if length is None:
+            return False
+        self._total_length -= length
+        self._removed += 1
+        if self._removed * 4 > len(self._lengths):
+            self._sweep()
+        return True
+
+    def _sweep(self):
+        for token, postings in list(self._postings.items()):
+            for ticket_id in [ticket_id for ticket_id in postings if ticket_id not in self._lengths]:
+                del postings[ticket_id]
+            if not postings:
+                del self._postings[token]
+        self._removed = 0
+
+    async def catch_up(self):
+        async with self._lock:
+            added = 0
+            after = max(0, self.last_id - self.overlap)
+            while True:
+                rows = await self.database.fetch_all(CATCH_UP_SQL, (after, self.batch))
+                for ticket_id, message in rows:
+                    added += self.add(ticket_id, message)
+                if len(rows) < self.batch:
+                    return added
+                after = rows[-1][0]
+
+    async def start(self):
+        # The initial load runs in the background; searches wait for it
+        added = await self.catch_up()
+        logger.info("Ticket search index loaded: %d tickets, %d terms", added, len(self._postings))
+
+    async def search(self, query, limit=MAX_RESULTS):
+        await self.catch_up()
+        if not self._lengths:
+            return []
+        average_length = self._total_length / len(self._lengths) or 1.0
+        scores = Counter()
+        for token in set(tokenize(query)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self._lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for ticket_id, tf in postings.items():
+                if ticket_id not in self._lengths:
+                    continue  # removed, not swept yet
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[ticket_id] / average_length)
+                scores[ticket_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+        return ranked[:limit]
+
+
+async def fetch_results(database, ticket_ids):
+    # Rows for one page, in rank order
+    if not ticket_ids:
+        return []
+    placeholders = ', '.join(['%s'] * len(ticket_ids))
+    rows = await database.fetch_all(ROWS_SQL.format(placeholders=placeholders), tuple(ticket_ids))
+    by_id = {row[0]: row for row in rows}
+    # Tickets archived or deleted since the search simply drop out
+    return [by_id[ticket_id] for ticket_id in ticket_ids if ticket_id in by_id]
+
+
+def snippet(message, terms, length=SNIPPET_LENGTH):
+    # Window of the message around the first matching term, HTML-escaped,
+    # with every matching word in bold
+    lowered = message.lower()
+    first = min((position for position in (lowered.find(term) for term in terms) if position >= 0), default=0)
+    start = max(0, min(first - length // 4, len(message) - length))
+    window = message[start:start + length]
+    parts = []
+    last = 0
+    for match in _TOKEN_PATTERN.finditer(window):
+        if match.group().lower() in terms:
+            parts.append(html.escape(window[last:match.start()]))
+            parts.append(f"<b>{html.escape(match.group())}</b>")
+            last = match.end()
+    parts.append(html.escape(window[last:]))
+    text = ''.join(parts)
+    if start > 0:
+        text = "…" + text
+    if start + length < len(message):
+        text += "…"
+    return text
+
+
+def render_results(query, rows, page_number, total, category_names, page_size=PAGE_SIZE):
+    # HTML text and navigation for one page of search results
+    if not rows:
+        return f"No tickets match <i>{html.escape(query)}</i>.", None
+
+    terms = set(tokenize(query))
+    pages = (total + page_size - 1) // page_size
+    lines = [f"Tickets matching <i>{html.escape(query)}</i>, page {page_number + 1} of {pages}:"]
+    for ticket_id, category_id, user_id, message, timestamp, status, duplicates in rows:
+        category = html.escape(category_names.get(category_id, f"category {category_id}"))
+        lines.append(
+            f"\n#{ticket_id} [{status}] {category} — user {user_id}, {timestamp:%Y-%m-%d %H:%M}{similar(ticket_id, duplicates)}\n"
+            f"{snippet(message, terms)}"
+        )
+
+    navigation = []
+    if page_number > 0:
+        navigation.append(InlineKeyboardButton("« Previous", callback_data='search_prev'))
+    if page_number + 1 < pages:
+        navigation.append(InlineKeyboardButton("Next »", callback_data='search_next'))
+    return "\n".join(lines), InlineKeyboardMarkup([navigation]) if navigation else None
@@ -0,0 +1,168 @@
+import asyncio
+import inspect
+import logging
+from datetime import datetime, timedelta
+
+from database import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+LATEST_SQL = "SELECT COALESCE(MAX(id), 0) FROM shared_event"
+PUBLISH_SQL = "INSERT INTO shared_event (kind, event_key, origin) VALUES (%s, %s, %s)"
+POLL_SQL = "SELECT id, kind, event_key, origin FROM shared_event WHERE id > %s ORDER BY id LIMIT %s"
+RECENT_IDS_SQL = "SELECT id FROM shared_event WHERE id > %s"
+PRUNE_SQL = "DELETE FROM shared_event WHERE created_at < %s LIMIT %s"
+PRUNE_BATCH = 10000
+
+
+# State that has to be global when the bot runs as several worker processes.
+# The data itself already lives in the database (users, catalog_version,
+# rate_limit_state, media_index); what workers must share is the news that it
+# changed, because each of them keeps a copy in memory. A change is published
+# as (kind, key) and every worker, the publishing one included, runs the
+# callbacks subscribed to that kind:
+#
+#   'catalog'          catalog version bumped, key is the new version
+#   'rate_limit_reset' key is "action:user_id", e.g. after /unban
+#   'media'            key is "file_unique_id:phash" of a new submission
+#   'ticket'           key is "ticket_id:simhash" of a newly committed ticket
+#   'ticket_archived'  key is the id of a ticket moved to ticket_archive
+
+
+class LocalStore:
+    # Stand-in for a single process: events go straight to this process's
+    # subscribers and nothing is stored.
+
+    def __init__(self):
+        self.published = 0
+        self.received = 0
+        self._subscribers = {}  # kind -> [callback(key)], plain or coroutine functions
+
+    def subscribe(self, kind, callback):
+        self._subscribers.setdefault(kind, []).append(callback)
+
+    async def publish(self, kind, key):
+        self.published += 1
+        await self._dispatch(kind, str(key))
+
+    async def publish_many(self, kind, keys):
+        for key in keys:
+            await LocalStore.publish(self, kind, key)
+
+    async def _dispatch(self, kind, key):
+        for callback in self._subscribers.get(kind, ()):
+            try:
+                result = callback(key)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                logger.error("Handling shared event %s %s failed: %s", kind, key, e)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def prune(self):
+        return 0
+
+
+class DatabaseStore(LocalStore):
+    # Events are appended to the shared_event table and every worker polls it
+    # every poll_interval seconds, one indexed range read per poll. A worker
+    # applies its own events immediately and skips them when they come back.
+    #
+    # Ids are handed out at insert but become visible at commit, so an event
+    # can appear below one that was already read. Each poll therefore starts
+    # `overlap` ids behind the highest id seen, and the ids seen in that
+    # window are remembered so nothing is delivered twice.
+
+    def __init__(self, database, origin, poll_interval=1.0, retention=3600, batch=1000, overlap=1000):
+        super().__init__()
+        self.database = database
+        self.origin = origin
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.batch = batch
+        self.overlap = overlap
+        self.last_id = 0
+        self._seen = set()  # ids above last_id - overlap already delivered
+        self._poller = None
+
+    async def publish(self, kind, key):
+        key = str(key)
+        await super().publish(kind, key)
+        try:
+            await self.database.execute(PUBLISH_SQL, (kind, key, self.origin))
+        except DatabaseError as e:
+            # Applied here; the other workers catch up when they next reload
+            logger.error("Failed to publish shared event %s %s: %s", kind, key, e)
+
+    async def publish_many(self, kind, keys):
+        # One multi-row INSERT for all of them
+        keys = [str(key) for key in keys]
+        await super().publish_many(kind, keys)
+        try:
+            await self.database.execute_many(PUBLISH_SQL, [(kind, key, self.origin) for key in keys])
+        except DatabaseError as e:
+            logger.error("Failed to publish %d shared %s events: %s", len(keys), kind, e)
+
+    async def start(self):
+        # Only events from now on matter; older ones are already reflected in
+        # the data every worker loaded at startup
+        row = await self.database.fetch_one(LATEST_SQL)
+        self.last_id = row[0] if row else 0
+        rows = await self.database.fetch_all(RECENT_IDS_SQL, (max(0, self.last_id - self.overlap),))
+        self._seen = {event_id for event_id, in rows}
+        self._poller = asyncio.get_running_loop().create_task(self._poll_forever())
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+
+    async def _poll_forever(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+            except DatabaseError as e:
+                logger.warning("Polling shared events failed: %s", e)
+
+    async def poll(self):
+        def read(cursor, after):
+            cursor.execute(POLL_SQL, (after, self.batch))
+            return cursor.fetchall()
+
+        after = max(0, self.last_id - self.overlap)
+        delivered = 0
+        while True:
+            rows = await self.database.run(read, after)
+            for event_id, kind, key, origin in rows:
+                after = event_id
+                if event_id in self._seen:
+                    continue
+                self._seen.add(event_id)
+                self.last_id = max(self.last_id, event_id)
+                delivered += 1
+                if origin != self.origin:
+                    self.received += 1
+                    await self._dispatch(kind, key)
+            if len(rows) < self.batch:
+                break
+        floor = self.last_id - self.overlap
+        self._seen = {event_id for event_id in self._seen if event_id > floor}
+        return delivered
+
+    async def prune(self):
+        # Run by one worker only; rows older than any worker's poll position
+        # are never read again
+        cutoff = datetime.now() - timedelta(seconds=self.retention)
+        deleted = 0
+        while True:
+            count = await self.database.execute(PRUNE_SQL, (cutoff, PRUNE_BATCH))
+            deleted += count
+            if count < PRUNE_BATCH:
+                return deleted
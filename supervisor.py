@@ -0,0 +1,219 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Multi-process deployment. One supervisor process owns the ingress (polling
+# or the webhook) and routes every update to one of N worker processes by user
+# id, so a user's conversation, rate limits and pending writes always live in
+# the same worker. Workers run the full Application without an Updater and
+# take their updates from a multiprocessing queue.
+
+# Seconds between liveness checks of the workers
+WATCH_INTERVAL = 1.0
+
+
+def shard_of(key, workers):
+    # Python's % is never negative for a positive modulus, so group chat ids
+    # route as well as user ids
+    return key % workers
+
+
+def worker_path(path, index):
+    # 'logs/bot.log' -> 'logs/bot.2.log', one file per worker
+    root, extension = os.path.splitext(path)
+    return f"{root}.{index}{extension}"
+
+
+def routing_key(update):
+    # The same key PerUserUpdateProcessor orders by, except for membership
+    # changes: those are about new_chat_member.user, whose membership cache
+    # lives in that user's worker, not in the worker of whoever made the change.
+    chat_member = update.chat_member or update.my_chat_member
+    if chat_member is not None:
+        return chat_member.new_chat_member.user.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return update.update_id
+
+
+class Supervisor:
+    # `target` is a module-level function run in each worker process as
+    # target(updates, parent_pid); it must stop when it reads None from the
+    # queue. Workers are started with the spawn method and find their index
+    # in the WORKER_INDEX environment variable, which is set before the
+    # interpreter starts so module-level configuration can depend on it.
+
+    def __init__(self, target, workers, metrics=None, stop_timeout=60.0):
+        if workers < 1:
+            raise ValueError("workers must be a positive integer")
+        self.target = target
+        self.workers = workers
+        self.metrics = metrics
+        self.stop_timeout = stop_timeout
+        self.routed = [0] * workers
+        self.restarts = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = [None] * workers
+        self._queues = [None] * workers
+        self._stopping = False
+
+    def start_worker(self, index):
+        # A fresh queue each time: a worker killed while reading could leave
+        # the old queue's read lock held. Whatever can still be read from the
+        # old queue is moved over.
+        previous = self._queues[index]
+        updates = self._context.Queue()
+        if previous is not None:
+            moved = 0
+            while True:
+                try:
+                    updates.put(previous.get_nowait())
+                    moved += 1
+                except (queue.Empty, OSError, ValueError):
+                    break
+            if moved:
+                logger.info("Moved %d queued updates to the new worker %d", moved, index)
+        os.environ['WORKER_INDEX'] = str(index)
+        try:
+            process = self._context.Process(target=self.target, args=(updates, os.getpid()), name=f"worker-{index}")
+            process.start()
+        finally:
+            del os.environ['WORKER_INDEX']
+        self._queues[index] = updates
+        self._processes[index] = process
+        logger.info("Started worker %d (pid %s)", index, process.pid)
+
+    def start(self):
+        for index in range(self.workers):
+            self.start_worker(index)
+
+    def route(self, update):
+        index = shard_of(routing_key(update), self.workers)
+        # Updates cross the process boundary as plain Bot API dicts
+        self._queues[index].put(update.to_dict())
+        self.routed[index] += 1
+        if self.metrics is not None:
+            self.metrics.inc('updates_routed_total', worker=str(index))
+
+    async def watch(self):
+        # Restarts workers that exit while the supervisor is running. Updates
+        # a worker had taken but not finished are lost with it.
+        while not self._stopping:
+            await asyncio.sleep(WATCH_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if self._stopping:
+                    return
+                if process is not None and not process.is_alive():
+                    logger.error("Worker %d exited with code %s, restarting", index, process.exitcode)
+                    self.restarts += 1
+                    if self.metrics is not None:
+                        self.metrics.inc('worker_restarts_total', worker=str(index))
+                    self.start_worker(index)
+
+    def stop(self):
+        # Each worker finishes what it was sent, then shuts down on None
+        self._stopping = True
+        for updates in self._queues:
+            if updates is not None:
+                updates.put(None)
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(self.stop_timeout)
+            if process.is_alive():
+                logger.warning("Worker %d did not stop within %.0fs, terminating", index, self.stop_timeout)
+                process.terminate()
+                process.join()
+
+    def queued(self):
+        # {worker index: updates waiting}, where the platform can tell
+        try:
+            return {index: updates.qsize() for index, updates in enumerate(self._queues) if updates is not None}
+        except NotImplementedError:
+            return {}
+
+    async def serve(self, updater, start_ingress):
+        # Runs until SIGINT or SIGTERM. start_ingress(updater) starts polling
+        # or the webhook; updates land in updater.update_queue and are routed
+        # from there.
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        self.start()
+        watcher = loop.create_task(self.watch())
+        try:
+            async with updater:
+                await start_ingress(updater)
+                router = loop.create_task(self._route_forever(updater.update_queue))
+                await stop.wait()
+                logger.info("Stopping: no new updates are fetched")
+                await updater.stop()
+                router.cancel()
+                await asyncio.gather(router, return_exceptions=True)
+                # Updates fetched but not routed yet still go to their workers
+                while not updater.update_queue.empty():
+                    self.route(updater.update_queue.get_nowait())
+        finally:
+            self._stopping = True
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+            await loop.run_in_executor(None, self.stop)
+
+    async def _route_forever(self, update_queue):
+        while True:
+            update = await update_queue.get()
+            if isinstance(update, Update):
+                self.route(update)
+
+
+def read_updates(updates, parent_pid, loop, inbox):
+    # Runs in a thread of the worker: blocking reads from the supervisor's
+    # queue, handed to the event loop. Stops on None, or when the supervisor
+    # has gone away without sending it.
+    while True:
+        try:
+            data = updates.get(timeout=WATCH_INTERVAL)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                logger.warning("Supervisor is gone, stopping")
+                data = None
+            else:
+                continue
+        loop.call_soon_threadsafe(inbox.put_nowait, data)
+        if data is None:
+            return
+
+
+async def serve_worker(application, updates, parent_pid):
+    # Same lifecycle as run_polling, with the supervisor's queue in place of
+    # getUpdates. The queue is read from a thread so the loop never blocks on it.
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue()
+    async with application:
+        if application.post_init is not None:
+            await application.post_init(application)
+        await application.start()
+        reader = threading.Thread(target=read_updates, args=(updates, parent_pid, loop, inbox), daemon=True)
+        reader.start()
+        while True:
+            data = await inbox.get()
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.stop()
+        if application.post_stop is not None:
+            await application.post_stop(application)
+    if application.post_shutdown is not None:
+        await application.post_shutdown(application)
@@ -0,0 +1,123 @@
+import asyncio
+import time
+
+from telegram.error import BadRequest, Forbidden
+
+from broadcast import (
+    CHECKPOINT_SQL, FAILURE_SQL, FINISH_SQL, REMAINING_SQL, RUNNING_SQL, BroadcastJob, Broadcaster,
+)
+from database import DatabaseError
+
+
+class BroadcastDatabase:
+    # Members and broadcast rows in memory; checkpoint_failures makes that
+    # many checkpoints fail first
+    def __init__(self, members, running=(), checkpoint_failures=0):
+        self.members = sorted(members)
+        self.running = list(running)
+        self.checkpoint_failures = checkpoint_failures
+        self.checkpoints = []
+        self.failures = []
+        self.finished = []
+
+    async def run(self, fn, *args):
+        return 1
+
+    async def fetch_one(self, sql, params=()):
+        assert sql == REMAINING_SQL
+        return (sum(1 for user_id in self.members if user_id > params[0]),)
+
+    async def fetch_all(self, sql, params=()):
+        assert sql == RUNNING_SQL
+        return self.running
+
+    async def execute(self, sql, params=()):
+        if sql == CHECKPOINT_SQL:
+            if self.checkpoint_failures:
+                self.checkpoint_failures -= 1
+                raise DatabaseError("Lost connection")
+            self.checkpoints.append(params[0])
+        elif sql == FAILURE_SQL:
+            self.failures.append(params[1:])
+        elif sql == FINISH_SQL:
+            self.finished.append(params)
+        return 1
+
+    async def stream(self, sql, params=(), batch_size=1000):
+        recipients = [user_id for user_id in self.members if user_id > params[0]]
+        for start in range(0, len(recipients), batch_size):
+            yield [(user_id,) for user_id in recipients[start:start + batch_size]]
+
+
+class Message:
+    message_id = 1
+
+
+class BroadcastBot:
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.delivered = []
+        self.reports = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == 'admin':
+            self.reports.append(text)
+            return Message()
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        self.delivered.append(chat_id)
+        return Message()
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.reports.append(text)
+
+
+def broadcast(database, bot, job=None):
+    async def main():
+        broadcaster = Broadcaster(database, rate=10_000, concurrency=2, batch_size=3, retry_delay=0)
+        if job is None:
+            await broadcaster.resume_all(bot)
+        else:
+            broadcaster._launch(bot, job)
+        await asyncio.gather(*broadcaster._tasks.values())
+    asyncio.run(main())
+
+
+def test_failed_checkpoints_do_not_use_up_the_slots():
+    database = BroadcastDatabase(range(1, 11), checkpoint_failures=5)
+    bot = BroadcastBot()
+    broadcast(database, bot, BroadcastJob(1, 'admin', "hello"))
+    assert sorted(bot.delivered) == list(range(1, 11))
+    assert database.checkpoints == list(range(1, 11))
+    assert database.finished == [(10, 0, 1)]
+
+
+def test_resumes_after_the_checkpoint():
+    database = BroadcastDatabase(range(1, 11), running=[(7, 'admin', "hello", 6, 5, 1)])
+    bot = BroadcastBot()
+    broadcast(database, bot)
+    assert sorted(bot.delivered) == [7, 8, 9, 10]
+    assert database.finished == [(9, 1, 7)]
+    assert bot.reports[-1].startswith("Finished. Broadcast #7: 9 sent, 1 failed")
+
+
+def test_records_failures_by_reason():
+    errors = {2: Forbidden("Forbidden: bot was blocked by the user"), 3: Forbidden("Forbidden: user is deactivated"),
+              4: BadRequest("Chat not found")}
+    database = BroadcastDatabase(range(1, 6))
+    bot = BroadcastBot(errors)
+    broadcast(database, bot, BroadcastJob(1, 'admin', "hello"))
+    assert sorted(bot.delivered) == [1, 5]
+    assert sorted(database.failures) == [(2, 'blocked'), (3, 'deactivated'), (4, 'not_found')]
+    assert database.finished == [(2, 3, 1)]
+
+
+def test_progress_text():
+    job = BroadcastJob(3, 'admin', "hello", sent=10)
+    job.remaining = 1000
+    assert job.progress_text() == "Broadcast #3: 10 sent, 0 failed, 1000 remaining"
+    job.started_at = time.monotonic() - 10
+    job.sent += 95
+    job.failed += 5
+    # 100 in 10s: the 900 left take 90s
+    assert job.progress_text() == "Broadcast #3: 105 sent, 5 failed, 900 remaining, 10.0 msg/s, ETA 0h 1m 30s"
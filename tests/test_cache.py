@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from cache import TTLCache
+
+
+def test_concurrent_loads_share_one_call():
+    cache = TTLCache()
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_load('key', loader) for _ in range(10)))
+
+    assert asyncio.run(main()) == ['value'] * 10
+    assert calls == 1
+    assert cache.get('key') == 'value'
+
+
+def test_failed_load_reaches_every_waiter_and_is_not_cached():
+    cache = TTLCache()
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise RuntimeError("upstream down")
+
+    async def main():
+        return await asyncio.gather(*(cache.get_or_load('key', loader) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert calls == 1
+    assert cache.get('key') is None
+    assert len(cache) == 0
+
+
+def test_invalidate_during_load_keeps_stale_value_out():
+    cache = TTLCache()
+
+    async def main():
+        started = asyncio.Event()
+
+        async def loader():
+            started.set()
+            await asyncio.sleep(0.01)
+            return 'stale'
+
+        task = asyncio.create_task(cache.get_or_load('key', loader))
+        await started.wait()
+        cache.invalidate('key')
+        return await task
+
+    assert asyncio.run(main()) == 'stale'
+    assert cache.get('key') is None
+
+
+def test_ttl_and_size_bound(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('cache.time.monotonic', lambda: clock[0])
+    cache = TTLCache(maxsize=2, ttl=10)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    # 'b' was least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    clock[0] += 11
+    assert cache.get('a') is None
+
+
+def test_hit_and_miss_counts():
+    cache = TTLCache()
+
+    async def loader():
+        return 1
+
+    async def main():
+        await cache.get_or_load('key', loader)
+        await cache.get_or_load('key', loader)
+
+    asyncio.run(main())
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    assert stats['hit_rate'] == pytest.approx(0.5)
@@ -0,0 +1,105 @@
+import asyncio
+
+from catalog import BUMP_VERSION_SQL, CATEGORIES_SQL, GROUPS_SQL, VERSION_SQL, Catalog
+
+
+class CatalogDatabase:
+    def __init__(self, groups, categories, version=1):
+        self.groups = groups
+        self.categories = categories
+        self.version = version
+        self.reads = 0
+
+    def call(self, fn, *args):
+        return fn(Cursor(self), *args)
+
+    async def run(self, fn, *args):
+        return self.call(fn, *args)
+
+    async def fetch_one(self, sql, params=()):
+        assert sql == VERSION_SQL
+        return (self.version,)
+
+    async def execute(self, sql, params=()):
+        assert sql == BUMP_VERSION_SQL
+        self.version += 1
+        return 1
+
+
+class Cursor:
+    def __init__(self, database):
+        self.database = database
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        if sql == VERSION_SQL:
+            self.database.reads += 1
+            self._rows = [(self.database.version,)]
+        elif sql == GROUPS_SQL:
+            self._rows = list(self.database.groups)
+        elif sql == CATEGORIES_SQL:
+            self._rows = list(self.database.categories)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+
+def loaded(groups=((10, 'Maths'), (20, 'Physics'), (30, 'Biology')), categories=((1, 'Links', 'Broken links'),)):
+    database = CatalogDatabase(list(groups), list(categories))
+    catalog = Catalog(database)
+    catalog.load()
+    return catalog, database
+
+
+def test_selection_mask_has_a_bit_per_group():
+    catalog, _ = loaded()
+    assert catalog.selection_mask([]) == 0
+    assert catalog.selection_mask(['10', 30]) == 0b101
+    # Groups removed from the catalog since they were selected are ignored
+    assert catalog.selection_mask(['20', '99']) == 0b010
+
+
+def test_render_is_cached_per_mask():
+    catalog, _ = loaded()
+    built = []
+
+    def builder(mask):
+        def build():
+            built.append(mask)
+            return f"text for {mask}"
+        return build
+
+    assert catalog.render('group_text', builder(1), 1) == "text for 1"
+    assert catalog.render('group_text', builder(1), 1) == "text for 1"
+    assert catalog.render('group_text', builder(2), 2) == "text for 2"
+    assert catalog.render('group_markup', builder(1), 1) == "text for 1"
+    assert built == [1, 2, 1]
+    assert (catalog.stats()['hits'], catalog.stats()['misses']) == (1, 3)
+
+
+def test_reload_invalidates_rendered_menus():
+    # What /reloadcatalog does: bump the version, then reload
+    catalog, database = loaded()
+    catalog.render('category_text', lambda: "old")
+    database.categories = [(1, 'Links', 'Broken links'), (2, 'Exams', 'Exam dates')]
+    database.groups = [(20, 'Physics'), (30, 'Biology')]
+    asyncio.run(catalog.bump_version())
+    assert catalog.version == 2
+    assert catalog.render('category_text', lambda: "new") == "new"
+    assert len(catalog.categories) == 2
+    # Bits follow the new group list; the removed group no longer counts
+    assert catalog.selection_mask(['10', '20']) == 0b01
+
+
+def test_refresh_only_reloads_on_a_new_version():
+    catalog, database = loaded()
+    assert not asyncio.run(catalog.refresh_if_changed())
+    assert database.reads == 1
+    # Another worker bumped the version
+    database.version = 5
+    database.groups = [(40, 'Chemistry')]
+    assert asyncio.run(catalog.refresh_if_changed())
+    assert (catalog.version, catalog.groups) == (5, [(40, 'Chemistry')])
@@ -0,0 +1,232 @@
+import asyncio
+import time
+
+import mysql.connector
+import pytest
+
+import database as database_module
+from database import Database, DatabaseError, is_transient
+
+
+class FakeCursor:
+    def __init__(self, connection, buffered=True):
+        self.connection = connection
+        self.buffered = buffered
+        self.rowcount = -1
+        self.closed = False
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        self.connection.statements.append((sql, params))
+        if self.connection.error is not None:
+            raise self.connection.error
+        self._rows = list(self.connection.rows)
+        self.rowcount = len(self._rows)
+
+    def executemany(self, sql, seq_of_params):
+        for params in seq_of_params:
+            self.execute(sql, params)
+        self.rowcount = len(seq_of_params)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection:
+    def __init__(self, rows=(), error=None):
+        self.rows = rows
+        self.error = error
+        self.statements = []
+        self.cursors = []
+        self.commits = self.rollbacks = 0
+        self.closed = False
+
+    def ping(self, **kwargs):
+        pass
+
+    def cursor(self, buffered=True):
+        cursor = FakeCursor(self, buffered)
+        self.cursors.append(cursor)
+        return cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        # Returns a pooled connection to its pool
+        self.closed = True
+
+
+class FakePool:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def get_connection(self):
+        self.connection.closed = False
+        return self.connection
+
+
+def pooled(rows=(), error=None):
+    connection = FakeConnection(rows, error)
+    database = Database(pool_size=2)
+    database._pool = FakePool(connection)
+    return database, connection
+
+
+def driver_error(errno):
+    return mysql.connector.Error("server said no", errno=errno)
+
+
+def test_call_commits_and_returns_the_connection():
+    database, connection = pooled(rows=[(1,)])
+
+    def read(cursor):
+        cursor.execute("SELECT 1")
+        return cursor.fetchone()
+
+    assert database.call(read) == (1,)
+    assert (connection.commits, connection.rollbacks, connection.closed) == (1, 0, True)
+    assert connection.cursors[0].closed
+
+
+def test_driver_error_rolls_back_and_returns_the_connection():
+    database, connection = pooled(error=driver_error(1062))
+
+    def write(cursor):
+        cursor.execute("INSERT INTO users (user_id) VALUES (%s)", (1,))
+
+    with pytest.raises(DatabaseError) as raised:
+        database.call(write)
+    assert not is_transient(raised.value)
+    assert (connection.commits, connection.rollbacks, connection.closed) == (0, 1, True)
+
+
+def test_any_error_returns_the_connection():
+    database, connection = pooled()
+
+    def broken(cursor):
+        raise KeyError('status')
+
+    with pytest.raises(KeyError):
+        database.call(broken)
+    assert (connection.commits, connection.rollbacks, connection.closed) == (0, 1, True)
+    assert connection.cursors[0].closed
+
+
+def test_unreachable_pool_raises_database_error():
+    class DownPool:
+        def get_connection(self):
+            raise mysql.connector.errors.PoolError("Failed getting connection; pool exhausted")
+
+    database = Database(pool_size=1)
+    database._pool = DownPool()
+    with pytest.raises(DatabaseError):
+        database.call(lambda cursor: None)
+
+
+def test_async_helpers():
+    database, connection = pooled(rows=[(1, 'member'), (2, 'pending')])
+
+    async def main():
+        return (
+            await database.fetch_one("SELECT user_id, status FROM users WHERE user_id = %s", (1,)),
+            await database.fetch_all("SELECT user_id, status FROM users"),
+            await database.execute("UPDATE users SET status = %s", ('member',)),
+            await database.execute_many("UPDATE users SET status = %s WHERE user_id = %s", [('ban', 1), ('ban', 2), ('ban', 3)]),
+            database.pending,
+        )
+
+    try:
+        one, rows, updated, updated_many, pending = asyncio.run(main())
+    finally:
+        database.close()
+    assert one == (1, 'member')
+    assert rows == [(1, 'member'), (2, 'pending')]
+    assert (updated, updated_many, pending) == (2, 3, 0)
+    assert connection.statements[0] == ("SELECT user_id, status FROM users WHERE user_id = %s", (1,))
+    assert connection.commits == 4 and connection.closed
+
+
+def test_transient_errors():
+    # No server error behind it: a lost connection
+    assert is_transient(DatabaseError("Lost connection"))
+    for errno in (1205, 1213, 2006, 2013):
+        error = DatabaseError()
+        error.__cause__ = driver_error(errno)
+        assert is_transient(error)
+    for errno in (1062, 1146, 1366):
+        error = DatabaseError()
+        error.__cause__ = driver_error(errno)
+        assert not is_transient(error)
+
+
+def stream(monkeypatch, connection, batch_size=2, stop_after=None):
+    monkeypatch.setattr(database_module.mysql.connector, 'connect', lambda **kwargs: connection)
+    database = Database(pool_size=1)
+
+    async def main():
+        batches = []
+        async for rows in database.stream("SELECT user_id FROM users", batch_size=batch_size):
+            batches.append(rows)
+            if len(batches) == stop_after:
+                break
+        return batches
+
+    try:
+        return asyncio.run(main())
+    finally:
+        database.close()
+
+
+def closed_soon(connection):
+    # The producer thread closes the connection after handing over its last batch
+    for _ in range(100):
+        if connection.closed:
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_stream_yields_batches_from_an_unbuffered_cursor(monkeypatch):
+    connection = FakeConnection(rows=[(1,), (2,), (3,), (4,), (5,)])
+    assert stream(monkeypatch, connection) == [[(1,), (2,)], [(3,), (4,)], [(5,)]]
+    # Its own connection, closed at the end; the query on an unbuffered cursor
+    assert closed_soon(connection)
+    assert connection.cursors[-1].buffered is False
+    assert connection.statements[-1] == ("SELECT user_id FROM users", ())
+
+
+def test_stream_stopped_early_closes_its_connection(monkeypatch):
+    connection = FakeConnection(rows=[(user_id,) for user_id in range(100)])
+    assert stream(monkeypatch, connection, batch_size=10, stop_after=1) == [[(user_id,) for user_id in range(10)]]
+    assert closed_soon(connection)
+
+
+def test_stream_raises_driver_errors(monkeypatch):
+    def refuse(**kwargs):
+        raise mysql.connector.errors.InterfaceError("Can't connect", errno=2003)
+
+    monkeypatch.setattr(database_module.mysql.connector, 'connect', refuse)
+    database = Database(pool_size=1)
+
+    async def main():
+        async for _ in database.stream("SELECT user_id FROM users"):
+            pass
+
+    with pytest.raises(DatabaseError):
+        asyncio.run(main())
+    database.close()
@@ -0,0 +1,76 @@
+import random
+
+from dedup import TicketDeduplicator, simhash
+
+COMPLAINT = (
+    "Hello admins, the link to the study group in the pinned message has expired and "
+    "nobody can join any more. Could someone please post a new invite link? Thanks!"
+)
+
+
+def distance(a, b):
+    return (simhash(a) ^ simhash(b)).bit_count()
+
+
+def test_simhash_is_stable_and_normalised():
+    assert simhash(COMPLAINT) == simhash(COMPLAINT)
+    assert simhash("Hello,   WORLD!!") == simhash("hello world")
+
+
+def test_near_paste_is_close_and_unrelated_text_is_far():
+    edited = COMPLAINT.replace("Hello admins", "Hi mods").replace("Thanks!", "thx")
+    unrelated = "My payment went through twice last week, can I get a refund for the second one please?"
+    assert distance(COMPLAINT, edited) <= 10
+    assert distance(COMPLAINT, unrelated) > 10
+
+
+def test_finds_and_counts_near_duplicates():
+    dedup = TicketDeduplicator(database=None, max_distance=10, window=3600)
+    dedup.remember(simhash(COMPLAINT), 17, added_at=1000.0)
+    assert dedup.find(simhash(COMPLAINT.replace("Thanks!", "thank you")), now=1001.0) == (17, 1)
+    assert dedup.find(simhash(COMPLAINT), now=1002.0) == (17, 2)
+    assert dedup.matched == 2
+    assert dedup.find(simhash("Completely different question about exam dates"), now=1003.0) is None
+
+
+def test_entries_expire_and_can_be_forgotten():
+    dedup = TicketDeduplicator(database=None, max_distance=10, window=3600)
+    dedup.remember(simhash(COMPLAINT), 17, added_at=1000.0)
+    assert dedup.find(simhash(COMPLAINT), now=4600.0) is None
+    assert len(dedup) == 0
+
+    dedup.remember(simhash(COMPLAINT), 18, added_at=5000.0)
+    dedup.forget(18)
+    assert dedup.find(simhash(COMPLAINT), now=5001.0) is None
+
+
+def test_committed_ticket_is_remembered_once():
+    dedup = TicketDeduplicator(database=None)
+    dedup.remember(simhash(COMPLAINT), 17, added_at=1000.0)
+    dedup.remember(simhash(COMPLAINT), 17, added_at=1000.0)
+    assert len(dedup) == 1
+
+
+def test_disabled_by_zero_window():
+    assert not TicketDeduplicator(database=None, window=0).enabled
+
+
+def test_every_signature_within_the_distance_is_found():
+    generator = random.Random(7)
+    dedup = TicketDeduplicator(database=None, max_distance=10, window=3600)
+    for ticket_id in range(200):
+        signature = generator.getrandbits(64)
+        dedup.remember(signature, ticket_id, added_at=1000.0)
+        flipped = signature
+        for bit in generator.sample(range(64), 10):
+            flipped ^= 1 << bit
+        assert ticket_id in {dedup._entries[entry_id][2] for entry_id in dedup._candidates(flipped)}
+
+
+def test_lookups_compare_few_tickets():
+    generator = random.Random(7)
+    dedup = TicketDeduplicator(database=None, max_distance=10, window=3600)
+    for ticket_id in range(2000):
+        dedup.remember(generator.getrandbits(64), ticket_id, added_at=1000.0)
+    compared = sum(len(set(dedup._candidates(generator.getrandbits(64)))) for _ in range(100))
+    assert compared / 100 < 0.1 * len(dedup)
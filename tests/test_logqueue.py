@@ -0,0 +1,98 @@
+import gzip
+import json
+import logging
+import queue
+
+import pytest
+
+from logqueue import (
+    CompressingRotatingFileHandler, CorrelationFilter, DroppingQueueHandler, JsonFormatter, SamplingFilter,
+    log_context, setup_logging,
+)
+
+
+@pytest.fixture
+def root_logger():
+    # setup_logging replaces the root logger's handlers; put them back afterwards
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def record(msg, *args, level=logging.INFO, name='test'):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_full_queue_drops_and_counts():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=2))
+    for number in range(5):
+        handler.handle(record("update %d", number))
+    assert handler.dropped == 3
+    queued = [handler.queue.get_nowait() for _ in range(2)]
+    # Formatted when logged, not when written
+    assert [(item.msg, item.args) for item in queued] == [("update 0", None), ("update 1", None)]
+
+
+def test_sampling_keeps_a_burst_and_reports_the_rest():
+    sampler = SamplingFilter(rate=0.0001, burst=3)
+    passed = [sampler.filter(record("polling %s", number)) for number in range(10)]
+    assert passed == [True] * 3 + [False] * 7
+    assert sampler.suppressed == 7
+    # Other templates and warnings have budgets of their own
+    assert sampler.filter(record("something else"))
+    assert sampler.filter(record("polling %s", 11, level=logging.WARNING))
+
+
+def test_json_lines_carry_correlation_and_extra_fields():
+    formatter = JsonFormatter()
+    token = log_context.set({'update_id': 42, 'user_id': 7, 'handler': 'start'})
+    try:
+        item = record("sent %d", 3)
+        CorrelationFilter().filter(item)
+    finally:
+        log_context.reset(token)
+    item.chat_id = -100
+    line = json.loads(formatter.format(item))
+    assert line['msg'] == "sent 3"
+    assert (line['update_id'], line['user_id'], line['handler'], line['chat_id']) == (42, 7, 'start', -100)
+    assert line['level'] == 'INFO'
+
+
+def test_rotated_files_are_compressed(tmp_path):
+    handler = CompressingRotatingFileHandler(str(tmp_path / 'logs' / 'bot.log'), max_bytes=100, backup_count=2)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for number in range(10):
+        handler.emit(record("line %02d " + "x" * 40, number))
+    handler.close()
+    with gzip.open(tmp_path / 'logs' / 'bot.log.1.gz', 'rt') as rotated:
+        assert rotated.read().startswith("line ")
+    assert not (tmp_path / 'logs' / 'bot.log.3.gz').exists()
+
+
+def test_stop_writes_out_everything_queued(tmp_path, root_logger):
+    path = tmp_path / 'bot.log'
+    pipeline = setup_logging(str(path), console=False, sample_rate=0, interval=0)
+    logger = logging.getLogger('test.shutdown')
+    for number in range(500):
+        logger.info("ticket %d stored", number)
+    pipeline.stop()
+    lines = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [line['msg'] for line in lines] == [f"ticket {number} stored" for number in range(500)]
+    assert pipeline.dropped == 0 and pipeline.queued == 0
+
+
+def test_overflowing_pipeline_counts_what_it_dropped(tmp_path, root_logger):
+    path = tmp_path / 'bot.log'
+    pipeline = setup_logging(str(path), console=False, queue_size=5, sample_rate=0, interval=0)
+    # Hold the writer so nothing is taken off the queue meanwhile
+    listener, pipeline.listener = pipeline.listener, None
+    listener.stop()
+    logger = logging.getLogger('test.overflow')
+    for number in range(20):
+        logger.info("ticket %d stored", number)
+    assert (pipeline.queued, pipeline.dropped) == (5, 15)
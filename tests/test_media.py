@@ -0,0 +1,94 @@
+import asyncio
+import types
+
+import pytest
+from telegram.error import RetryAfter
+
+from media import MAX_RETRY_AFTER, MediaForwarder, MediaIndex, MediaItem, _retry, document_hash_source
+
+
+def document(mime_type):
+    return types.SimpleNamespace(mime_type=mime_type, thumbnail='thumbnail')
+
+
+def test_only_image_and_video_documents_are_hashed():
+    assert document_hash_source(document('image/png')) == 'thumbnail'
+    assert document_hash_source(document('video/mp4')) == 'thumbnail'
+    assert document_hash_source(document('application/pdf')) is None
+    assert document_hash_source(document(None)) is None
+
+
+def test_near_duplicate_hashes_match():
+    index = MediaIndex(database=None, max_distance=4)
+    index.remember('a', 0b1011 << 40)
+    assert index.find_duplicate('a') == 'exact'
+    assert index.find_duplicate('b', (0b1011 << 40) ^ 0b111) == 'similar'
+    assert index.find_duplicate('c', (0b1011 << 40) ^ 0b11111) is None
+
+
+def test_forget_releases_a_remembered_hash():
+    index = MediaIndex(database=None, max_distance=4)
+    index.remember('a', 0b1011 << 40)
+    index.remember('b', 1 << 63)
+    index.forget('a', 0b1011 << 40)
+    assert index.find_duplicate('a') is None
+    assert index.find_duplicate('c', (0b1011 << 40) ^ 0b111) is None
+    assert index.find_duplicate('c', (1 << 63) ^ 1) == 'similar'
+
+
+class FloodedBot:
+    def __init__(self, floods):
+        self.floods = floods
+        self.calls = 0
+        self.sent = []
+
+    async def send_photo(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.floods:
+            raise RetryAfter(0)
+        self.sent.append(kwargs['photo'])
+
+    async def send_media_group(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.floods:
+            raise RetryAfter(0)
+        self.sent.extend(media.media for media in kwargs['media'])
+
+    async def send_message(self, chat_id, text):
+        self.sent.append(text)
+
+
+def test_retry_after_is_capped():
+    bot = FloodedBot(floods=MAX_RETRY_AFTER)
+    asyncio.run(_retry(bot.send_photo, photo='p'))
+    assert bot.sent == ['p']
+
+    bot = FloodedBot(floods=MAX_RETRY_AFTER + 1)
+    with pytest.raises(RetryAfter):
+        asyncio.run(_retry(bot.send_photo, photo='p'))
+    assert bot.calls == MAX_RETRY_AFTER + 1
+
+
+def album(floods):
+    bot = FloodedBot(floods)
+    forwarder = MediaForwarder(chat_id=-1, album_wait=0)
+    outcomes = []
+
+    async def listener(items, submitted):
+        outcomes.append(([item.file_id for item in items], submitted))
+
+    forwarder.listeners.append(listener)
+
+    async def main():
+        for file_id in ('x', 'y'):
+            forwarder.add_to_album(bot, 'album', MediaItem('photo', file_id), "header", 5)
+        await forwarder.stop(bot)
+
+    asyncio.run(main())
+    return outcomes, bot.sent[-1]
+
+
+def test_album_listeners_learn_the_outcome():
+    assert album(floods=0) == ([(['x', 'y'], True)], "2 file(s) submitted.")
+    assert album(floods=MAX_RETRY_AFTER + 1) == (
+        [(['x', 'y'], False)], "Your files could not be submitted. Please try again later.")
@@ -0,0 +1,11 @@
+from metrics import Metrics
+
+
+def test_summary_lists_gauges():
+    metrics = Metrics()
+    metrics.gauge('queue', lambda: 3)
+    metrics.gauge('cache', lambda: {'hits': 0.5, 'mode': 'lru'}, label='stat')
+    summary = metrics.summary()
+    assert "queue: 3" in summary
+    assert "cache[hits]: 0.5" in summary
+    assert "cache[mode]: lru" in summary
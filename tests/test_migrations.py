@@ -0,0 +1,53 @@
+from migrations import COLUMN_EXISTS_SQL, INDEX_EXISTS_SQL, TABLE_EXISTS_SQL, Migration, pending_statements
+
+CREATE_NOTES = "CREATE TABLE IF NOT EXISTS notes (id INT PRIMARY KEY, body TEXT)"
+ADD_AUTHOR = ('notes', 'column', 'author', "ALTER TABLE notes ADD COLUMN author BIGINT")
+ADD_USERS_INDEX = ('users', 'index', 'idx_users_created', "ALTER TABLE users ADD INDEX idx_users_created (created_at)")
+
+
+class SchemaCursor:
+    # Answers the information_schema lookups from a set of existing objects
+    def __init__(self, tables=(), columns=(), indexes=()):
+        self.tables = set(tables)
+        self.columns = set(columns)
+        self.indexes = set(indexes)
+        self.queries = []
+        self._result = None
+
+    def execute(self, sql, params=()):
+        self.queries.append((sql, params))
+        if sql == TABLE_EXISTS_SQL:
+            found = params[0] in self.tables
+        elif sql == COLUMN_EXISTS_SQL:
+            found = params in self.columns
+        elif sql == INDEX_EXISTS_SQL:
+            found = params in self.indexes
+        else:
+            raise AssertionError(f"unexpected statement {sql}")
+        self._result = (int(found),)
+
+    def fetchone(self):
+        return self._result
+
+
+def test_plain_statements_always_run():
+    migration = Migration(1, "notes", [CREATE_NOTES])
+    assert pending_statements(SchemaCursor(), migration) == [CREATE_NOTES]
+
+
+def test_conditional_step_skipped_when_already_applied():
+    migration = Migration(2, "index", [ADD_USERS_INDEX])
+    cursor = SchemaCursor(tables={'users'}, indexes={('users', 'idx_users_created')})
+    assert pending_statements(cursor, migration) == []
+    assert pending_statements(SchemaCursor(tables={'users'}), migration) == [ADD_USERS_INDEX[3]]
+
+
+def test_steps_for_a_table_created_by_the_same_migration():
+    migration = Migration(1, "notes", [CREATE_NOTES, ADD_AUTHOR])
+    # A new table is created with the column already in it
+    assert pending_statements(SchemaCursor(), migration) == [CREATE_NOTES]
+    # An older copy of the table gets the column added
+    cursor = SchemaCursor(tables={'notes'})
+    assert pending_statements(cursor, migration) == [CREATE_NOTES, ADD_AUTHOR[3]]
+    cursor = SchemaCursor(tables={'notes'}, columns={('notes', 'author')})
+    assert pending_statements(cursor, migration) == [CREATE_NOTES]
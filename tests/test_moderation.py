@@ -0,0 +1,99 @@
+import asyncio
+import sqlite3
+
+from moderation import apply_bulk, parse_user_ids
+from repository import SQLITE_SCHEMA
+
+
+class ModerationDatabase:
+    # Runs the bulk actions' MySQL statements on an in-memory SQLite copy of
+    # the schema, translating only the dialect
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+        self.connection.executescript(SQLITE_SCHEMA)
+        self.transactions = 0
+
+    async def run(self, fn, *args):
+        try:
+            result = fn(Cursor(self.connection.cursor()), *args)
+        except Exception:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+        self.transactions += 1
+        return result
+
+    def statuses(self):
+        return dict(self.connection.execute("SELECT user_id, status FROM users"))
+
+
+class Cursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    @staticmethod
+    def _sql(sql):
+        return sql.replace('%s', '?').replace('INSERT IGNORE', 'INSERT OR IGNORE').replace('NOW()', 'CURRENT_TIMESTAMP')
+
+    def execute(self, sql, params=()):
+        self.cursor.execute(self._sql(sql), params)
+
+    def executemany(self, sql, seq_params):
+        self.cursor.executemany(self._sql(sql), seq_params)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+def users(database, statuses):
+    database.connection.executemany("INSERT INTO users (user_id, status) VALUES (?, ?)", statuses.items())
+
+
+def bulk(database, action, user_ids, chunk_size=2):
+    reports = []
+
+    async def progress(done, total, changed):
+        reports.append((done, total, changed))
+
+    changed = asyncio.run(apply_bulk(database, action, user_ids, progress, chunk_size=chunk_size))
+    return changed, reports
+
+
+def test_parse_free_text():
+    assert parse_user_ids("12, 34;56\n78 12 abc -5 0") == ([12, 34, 56, 78], ['abc', '-5', '0'])
+    assert parse_user_ids("  ") == ([], [])
+
+
+def test_parse_csv():
+    text = "user_id,name\n12,alice\nbob,34,note\n,\nnobody\n12,again\n"
+    assert parse_user_ids(text, csv_rows=True) == ([12, 34], ['nobody'])
+
+
+def test_ban_updates_and_creates_rows():
+    database = ModerationDatabase()
+    users(database, {1: 'member', 2: 'ban', 3: 'pending'})
+    changed, reports = bulk(database, 'ban', [1, 2, 3, 4, 5])
+    # 2 was banned already; 4 and 5 get rows of their own
+    assert changed == 4
+    assert database.statuses() == {1: 'ban', 2: 'ban', 3: 'ban', 4: 'ban', 5: 'ban'}
+    assert database.transactions == 3
+    assert reports == [(2, 5, 1), (4, 5, 3), (5, 5, 4)]
+
+
+def test_unban_only_touches_banned_users():
+    database = ModerationDatabase()
+    users(database, {1: 'ban', 2: 'member'})
+    changed, _ = bulk(database, 'unban', [1, 2, 3])
+    assert changed == 1
+    assert database.statuses() == {1: 'pending', 2: 'member'}
+
+
+def test_approve_skips_banned_users():
+    database = ModerationDatabase()
+    users(database, {1: 'pending', 2: 'ban', 3: 'member'})
+    changed, _ = bulk(database, 'approve', [1, 2, 3, 4], chunk_size=10)
+    assert changed == 2
+    assert database.statuses() == {1: 'member', 2: 'ban', 3: 'member', 4: 'member'}
+    verified = dict(database.connection.execute("SELECT user_id, verified_at IS NOT NULL FROM users"))
+    assert verified == {1: 1, 2: 0, 3: 0, 4: 1}
@@ -0,0 +1,67 @@
+import asyncio
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+from notifier import DIGEST_SEPARATOR, ModNotifier, build_digests
+
+
+def test_packs_texts_into_few_messages():
+    assert build_digests(["a", "b", "c"], limit=100) == [DIGEST_SEPARATOR.join(["a", "b", "c"])]
+
+
+def test_starts_a_new_message_when_full():
+    texts = ["x" * 40, "y" * 40, "z" * 40]
+    digests = build_digests(texts, limit=90)
+    assert digests == [texts[0] + DIGEST_SEPARATOR + texts[1], texts[2]]
+    assert all(len(digest) <= 90 for digest in digests)
+
+
+def test_splits_only_texts_longer_than_a_message():
+    digests = build_digests(["short", "L" * 25], limit=10)
+    assert digests == ["short", "L" * 10, "L" * 10, "L" * 5]
+
+
+def test_nothing_to_send():
+    assert build_digests([]) == []
+
+
+def test_retry_after_counts_against_max_retries():
+    class FloodedBot:
+        calls = 0
+
+        async def send_message(self, **kwargs):
+            self.calls += 1
+            raise RetryAfter(0)
+
+    bot = FloodedBot()
+    notifier = ModNotifier(chat_id=-1, max_retries=2)
+    notifier.start(bot)
+    asyncio.run(notifier._send(7, "text"))
+    assert (bot.calls, notifier.sent, notifier.dropped) == (3, 0, 1)
+
+
+class FailingBot:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def send_message(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+def test_timed_out_send_is_not_repeated():
+    bot = FailingBot([TimedOut()])
+    notifier = ModNotifier(chat_id=-1, max_retries=2, backoff=0)
+    notifier.start(bot)
+    asyncio.run(notifier._send(7, "text"))
+    assert (bot.calls, notifier.sent, notifier.dropped, notifier.unconfirmed) == (1, 0, 0, 1)
+
+
+def test_connection_error_is_retried():
+    bot = FailingBot([NetworkError("Connection reset")])
+    notifier = ModNotifier(chat_id=-1, max_retries=2, backoff=0)
+    notifier.start(bot)
+    asyncio.run(notifier._send(7, "text"))
+    assert (bot.calls, notifier.sent, notifier.unconfirmed) == (2, 1, 0)
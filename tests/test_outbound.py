@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from telegram.error import RetryAfter
+
+from outbound import MODERATION, Outbound, OutboundScheduler
+
+
+def test_busy_chat_does_not_hold_up_others():
+    async def main():
+        scheduler = OutboundScheduler(private_rate=1.0, burst=1)
+        first = Outbound(MODERATION, 0, 1, None)
+        second = Outbound(MODERATION, 1, 1, None)
+        other = Outbound(MODERATION, 2, 2, None)
+        for item in (first, second, other):
+            scheduler._enqueue(item)
+        now = time.monotonic()
+        granted = []
+        for _ in range(3):
+            item, wait = scheduler._next(now)
+            if item is None:
+                break
+            scheduler._take_tokens(item.chat_id, now)
+            granted.append(item)
+        assert granted == [first, other]
+        assert 0 < wait <= 1.0
+        assert scheduler._next(now + 1.0)[0] is second
+        assert scheduler._next(now + 1.0) == (None, None)
+
+    asyncio.run(main())
+
+
+def test_removed_head_does_not_stall_its_chat():
+    async def main():
+        scheduler = OutboundScheduler()
+        first, second = Outbound(MODERATION, 0, 1, None), Outbound(MODERATION, 1, 1, None)
+        scheduler._enqueue(first)
+        scheduler._enqueue(second)
+        scheduler._remove(first)
+        assert scheduler._next(time.monotonic())[0] is second
+
+    asyncio.run(main())
+
+
+def test_retried_edit_yields_to_a_newer_one():
+    sent = []
+
+    async def main():
+        scheduler = OutboundScheduler()
+        await scheduler.initialize()
+        newer = None
+
+        def edit(text):
+            async def callback():
+                nonlocal newer
+                if text == 'old' and newer is None:
+                    # A newer edit for the same message arrives while this one is in flight
+                    newer = asyncio.create_task(send('new'))
+                    await asyncio.sleep(0)
+                    raise RetryAfter(0)
+                sent.append(text)
+                return text
+            return callback
+
+        async def send(text):
+            return await scheduler.process_request(
+                edit(text), (), {}, 'editMessageText', {'chat_id': -1, 'message_id': 5}, None
+            )
+
+        try:
+            results = [await send('old'), await newer]
+        finally:
+            await scheduler.shutdown()
+        return results
+
+    assert asyncio.run(main()) == ['new', 'new']
+    assert sent == ['new']
@@ -0,0 +1,65 @@
+import asyncio
+import json
+import types
+from collections import defaultdict
+
+from database import DatabaseError
+from persistence import LazyPersistence
+
+
+class StateDatabase:
+    # user_state rows in memory; reads fail while `down` is set
+    def __init__(self, users):
+        self.users = users
+        self.down = False
+        self.writes = []
+
+    async def run(self, fn, *args):
+        if fn.__name__ == '_read_state':
+            if self.down:
+                raise DatabaseError("server has gone away")
+            owner_id, = args
+            data = self.users.get(owner_id)
+            return ((data,) if data is not None else None), []
+        users, conversations = args
+        self.writes.append(users)
+        self.users.update(users)
+
+
+def persistence_for(database):
+    persistence = LazyPersistence(database)
+    persistence.attach(types.SimpleNamespace(handlers={}, user_data=defaultdict(dict)))
+    return persistence
+
+
+def test_state_is_not_overwritten_after_a_failed_load():
+    database = StateDatabase({7: json.dumps({'groups': [1, 2]})})
+    persistence = persistence_for(database)
+
+    async def main():
+        database.down = True
+        await persistence.load(7)
+        # The handler ran on blank user_data
+        await persistence.update_user_data(7, {'step': 1})
+        await persistence.flush()
+        assert database.writes == []
+
+        database.down = False
+        await persistence.load(7)
+        user_data = persistence._application.user_data[7]
+        user_data['step'] = 2
+        await persistence.update_user_data(7, user_data)
+        await persistence.flush()
+
+    asyncio.run(main())
+    assert json.loads(database.users[7]) == {'groups': [1, 2], 'step': 2}
+
+
+def test_loaded_state_is_merged_under_newer_values():
+    database = StateDatabase({7: json.dumps({'groups': [1], 'step': 1})})
+    persistence = persistence_for(database)
+    persistence._application.user_data[7]['step'] = 5
+
+    asyncio.run(persistence.load(7))
+    assert persistence._application.user_data[7] == {'groups': [1], 'step': 5}
+    assert persistence.loaded == 1
@@ -0,0 +1,118 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+from processing import PerUserUpdateProcessor
+
+
+def update(update_id, user_id):
+    chat = Chat(user_id, Chat.PRIVATE)
+    message = Message(update_id, datetime.now(), chat, from_user=User(user_id, "user", False))
+    return Update(update_id, message=message)
+
+
+class Recorder:
+    # Coroutines that log when they start and finish, taking `delay` seconds
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.peak = 0
+
+    async def handle(self, name, delay):
+        self.events.append(('start', name))
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(delay)
+        self.running -= 1
+        self.events.append(('end', name))
+
+    def order(self, kind):
+        return [name for event, name in self.events if event == kind]
+
+
+def test_same_user_updates_run_in_arrival_order():
+    recorder = Recorder()
+
+    async def main():
+        processor = PerUserUpdateProcessor(limit=8)
+        # The first update is the slowest; the later ones must still wait for it
+        await asyncio.gather(*(
+            processor.process_update(update(number, 1), recorder.handle(number, delay))
+            for number, delay in enumerate((0.05, 0.01, 0.0, 0.02))
+        ))
+        return processor
+
+    processor = asyncio.run(main())
+    assert recorder.events == [event for number in range(4) for event in (('start', number), ('end', number))]
+    assert processor.waiting_users == 0 and processor.in_flight == 0
+
+
+def test_other_users_are_not_held_up():
+    recorder = Recorder()
+
+    async def main():
+        processor = PerUserUpdateProcessor(limit=8)
+        await asyncio.gather(
+            processor.process_update(update(1, 1), recorder.handle('slow', 0.05)),
+            processor.process_update(update(2, 1), recorder.handle('after slow', 0.0)),
+            processor.process_update(update(3, 2), recorder.handle('other user', 0.0)),
+        )
+
+    asyncio.run(main())
+    assert recorder.order('end') == ['other user', 'slow', 'after slow']
+
+
+def test_concurrency_is_limited_across_users():
+    recorder = Recorder()
+
+    async def main():
+        processor = PerUserUpdateProcessor(limit=2)
+        await asyncio.gather(*(
+            processor.process_update(update(user_id, user_id), recorder.handle(user_id, 0.01))
+            for user_id in range(1, 7)
+        ))
+
+    asyncio.run(main())
+    assert recorder.peak == 2
+
+
+def test_loader_runs_before_each_update_of_its_user():
+    recorder = Recorder()
+
+    async def load(key):
+        recorder.events.append(('load', key))
+
+    async def main():
+        processor = PerUserUpdateProcessor(limit=4, loader=load)
+        await asyncio.gather(
+            processor.process_update(update(1, 7), recorder.handle('first', 0.01)),
+            processor.process_update(update(2, 7), recorder.handle('second', 0.0)),
+        )
+
+    asyncio.run(main())
+    assert recorder.events == [
+        ('load', 7), ('start', 'first'), ('end', 'first'), ('load', 7), ('start', 'second'), ('end', 'second'),
+    ]
+
+
+def test_drain_waits_for_in_flight_updates():
+    recorder = Recorder()
+
+    async def main():
+        processor = PerUserUpdateProcessor(limit=2)
+        task = asyncio.create_task(processor.process_update(update(1, 1), recorder.handle('slow', 0.05)))
+        await asyncio.sleep(0)
+        assert processor.in_flight == 1
+        assert not await processor.drain(timeout=0.01)
+        assert await processor.drain(timeout=1)
+        await task
+
+    asyncio.run(main())
+    assert recorder.order('end') == ['slow']
+
+
+def test_rejects_a_zero_limit():
+    with pytest.raises(ValueError):
+        PerUserUpdateProcessor(limit=0)
@@ -0,0 +1,91 @@
+import asyncio
+import time
+
+from ratelimit import DELETE_SQL, UPSERT_SQL, RateLimiter, Rule, SlidingWindow, TokenBucket
+
+
+class StateDatabase:
+    # Records what a checkpoint writes
+    def __init__(self):
+        self.upserted = []
+        self.deleted = []
+
+    async def run(self, function):
+        function(self)
+
+    def executemany(self, statement, rows):
+        if statement == UPSERT_SQL:
+            self.upserted.extend((row[1], row[0]) for row in rows)
+        elif statement == DELETE_SQL:
+            self.deleted.extend((row[1], row[0]) for row in rows)
+
+
+def test_token_bucket_burst_then_refill():
+    bucket = TokenBucket(capacity=3, refill_rate=1.0)
+    state = bucket.new_state(0.0)
+    assert [bucket.hit(state, 0.0) for _ in range(4)] == [True, True, True, False]
+    assert bucket.delay(state, 0.0) == 1.0
+    assert bucket.hit(state, 0.5) is False
+    assert bucket.hit(state, 1.0) is True
+
+
+def test_token_bucket_idle_once_full():
+    bucket = TokenBucket(capacity=2, refill_rate=0.5)
+    state = bucket.new_state(0.0)
+    bucket.hit(state, 0.0)
+    assert not bucket.is_idle(state, 1.0)
+    assert bucket.is_idle(state, 2.0)
+    assert bucket.horizon == 4.0
+
+
+def test_sliding_window_limit():
+    window = SlidingWindow(limit=3, window=10)
+    state = window.new_state(0.0)
+    assert [window.hit(state, 1.0) for _ in range(4)] == [True, True, True, False]
+
+
+def test_sliding_window_weights_previous_window():
+    window = SlidingWindow(limit=4, window=10)
+    state = window.new_state(0.0)
+    for _ in range(4):
+        assert window.hit(state, 0.0)
+    # Halfway into the next window the previous four count as two
+    assert window.hit(state, 15.0)
+    assert window.hit(state, 15.0)
+    assert not window.hit(state, 15.0)
+
+
+def test_sliding_window_resets_after_two_windows():
+    window = SlidingWindow(limit=1, window=10)
+    state = window.new_state(0.0)
+    assert window.hit(state, 0.0)
+    assert not window.hit(state, 5.0)
+    assert not window.is_idle(state, 19.0)
+    assert window.is_idle(state, 20.0)
+    assert window.hit(state, 20.0)
+
+
+def test_capacity_eviction_saves_instead_of_deleting():
+    limiter = RateLimiter({'join': Rule(TokenBucket(capacity=1, refill_rate=0.001))}, max_entries=2)
+    now = time.time()
+    for user_id in (1, 2, 3):
+        limiter.hit('join', user_id, now)
+    assert len(limiter) == 2
+    # Back before the checkpoint, the dropped entry still has its state
+    assert limiter.hit('join', 1, now) == 'deny'
+    database = StateDatabase()
+    asyncio.run(limiter.checkpoint(database))
+    assert sorted(database.upserted) == [('join', 1), ('join', 2), ('join', 3)]
+    assert database.deleted == []
+
+
+def test_evict_idle_scans_past_long_lived_entries():
+    rules = {
+        'report': Rule(SlidingWindow(limit=5, window=3600)),
+        'join': Rule(SlidingWindow(limit=5, window=10)),
+    }
+    limiter = RateLimiter(rules)
+    limiter.hit('report', 1, 0.0)
+    limiter.hit('join', 2, 0.0)
+    assert limiter.evict_idle(now=60.0) == 1
+    assert len(limiter) == 1
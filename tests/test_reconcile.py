@@ -0,0 +1,176 @@
+import asyncio
+import time
+from datetime import datetime
+
+from telegram.error import NetworkError, RetryAfter
+
+from reconcile import MEMBERS_DUE_SQL, PENDING_DUE_SQL, UPDATE_SQL, Reconciler
+
+FRESHNESS = 6 * 3600
+
+
+class ReconcileDatabase:
+    # users: user_id -> (status, cooldown_until, verified_at) as datetimes
+    def __init__(self, users):
+        self.users = users
+        self.queries = []
+        self.updates = []
+
+    async def run(self, fn, *args):
+        return fn(Cursor(self), *args)
+
+    async def execute_many(self, sql, seq_of_params):
+        assert sql == UPDATE_SQL
+        for new_status, verified_at, user_id, status in seq_of_params:
+            if self.users[user_id][0] == status:
+                self.users[user_id] = (new_status, self.users[user_id][1], verified_at)
+            self.updates.append((user_id, new_status, status))
+        return len(seq_of_params)
+
+
+class Cursor:
+    def __init__(self, database):
+        self.database = database
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        users = self.database.users
+        self.database.queries.append(sql)
+        if sql.startswith("SELECT user_id, cooldown_until"):
+            since, until, limit = params
+            rows = sorted(
+                (cooldown_until, user_id) for user_id, (status, cooldown_until, verified_at) in users.items()
+                if status == 'pending' and cooldown_until is not None and since < cooldown_until <= until
+                and (verified_at is None or verified_at < cooldown_until)
+            )
+            self._rows = [(user_id, cooldown_until) for cooldown_until, user_id in rows[:limit]]
+        elif sql.startswith("SELECT user_id, verified_at"):
+            before, limit = params
+            rows = sorted(
+                (verified_at or datetime.min, user_id) for user_id, (status, _, verified_at) in users.items()
+                if status == 'member' and (verified_at is None or verified_at <= before)
+            )
+            self._rows = [(user_id, users[user_id][2]) for _, user_id in rows[:limit]]
+        else:
+            self._rows = [(user_id, *users[user_id]) for user_id in params if user_id in users]
+
+    def fetchall(self):
+        return self._rows
+
+
+def current_time():
+    # Whole seconds, so timestamps survive the round trip through datetime
+    return float(int(time.time()))
+
+
+def at(timestamp):
+    return datetime.fromtimestamp(timestamp)
+
+
+def reconciler(users, **kwargs):
+    database = ReconcileDatabase(users)
+    return Reconciler(database, freshness=FRESHNESS, horizon=3600, rate=1000, retry_delay=300, **kwargs), database
+
+
+def checker(answers):
+    # answers: user_id -> 'member' | 'not_member' | an exception to raise
+    calls = []
+
+    async def check(user_id):
+        calls.append(user_id)
+        answer = answers[user_id]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    return check, calls
+
+
+def test_load_schedules_cooldowns_and_stale_members():
+    now = current_time()
+    reconcile, _ = reconciler({
+        1: ('pending', at(now + 600), None),  # cooldown ends within the horizon
+        2: ('pending', at(now + 7200), None),  # beyond it
+        3: ('pending', at(now - 60), at(now - 30)),  # already checked after its cooldown
+        4: ('member', None, at(now - FRESHNESS + 1200)),
+        5: ('member', None, at(now)),
+        6: ('ban', at(now + 600), None),
+    })
+    assert asyncio.run(reconcile.load(now)) == 2
+    assert reconcile._due == {1: now + 600, 4: now + 1200}
+    # Cooldowns set by handlers join the heap when they fall inside the window
+    reconcile.schedule(7, at(now + 60))
+    reconcile.schedule(8, now + 7200)
+    assert set(reconcile._due) == {1, 4, 7}
+
+
+def test_run_reconciles_members_and_non_members():
+    now = current_time()
+    reconcile, database = reconciler({
+        1: ('pending', at(now - 10), None),
+        2: ('member', None, at(now - FRESHNESS - 10)),
+        3: ('pending', at(now - 20), None),
+    })
+    check, calls = checker({1: 'member', 2: 'not_member', 3: 'not_member'})
+    assert asyncio.run(reconcile.run(check, now)) == 3
+    assert sorted(calls) == [1, 2, 3]
+    assert sorted(database.updates) == [(1, 'member', 'pending'), (2, 'pending', 'member'), (3, 'pending', 'pending')]
+    assert (reconcile.promoted, reconcile.demoted, reconcile.checked) == (1, 1, 3)
+    assert len(reconcile) == 0
+    # The new member is loaded again once its check is about to go stale
+    asyncio.run(reconcile.load(now + FRESHNESS - 1800))
+    assert list(reconcile._due) == [1]
+
+
+def test_failed_check_is_retried_later():
+    now = current_time()
+    reconcile, database = reconciler({1: ('pending', at(now - 10), None)})
+    check, calls = checker({1: NetworkError("Bad gateway")})
+    assert asyncio.run(reconcile.run(check, now)) == 0
+    assert reconcile.failed == 1 and database.updates == []
+    assert reconcile._due == {1: now + 300}
+
+    check, calls = checker({1: 'member'})
+    assert asyncio.run(reconcile.run(check, now + 100)) == 0
+    assert asyncio.run(reconcile.run(check, now + 300)) == 1
+    assert database.updates == [(1, 'member', 'pending')]
+
+
+def test_flood_control_pauses_the_run():
+    now = current_time()
+    reconcile, database = reconciler({
+        1: ('pending', at(now - 30), None),
+        2: ('pending', at(now - 20), None),
+        3: ('pending', at(now - 10), None),
+    })
+    check, calls = checker({1: 'member', 2: RetryAfter(120), 3: 'member'})
+    assert asyncio.run(reconcile.run(check, now)) == 1
+    assert calls == [1, 2]
+    # Nothing runs during the pause; the rest is due when it ends
+    assert asyncio.run(reconcile.run(check, now + 60)) == 0
+    assert set(reconcile._due) == {2, 3}
+    assert all(due >= now + 120 for due in reconcile._due.values())
+
+
+def test_queued_changes_and_extended_cooldowns_are_rescheduled():
+    now = current_time()
+    reconcile, database = reconciler(
+        {1: ('pending', at(now - 10), None), 2: ('pending', at(now - 10), None)},
+        overlay=lambda user_id, row: ('member', *row[1:]) if user_id == 1 else row,
+    )
+    asyncio.run(reconcile.load(now))
+    # User 2 pressed the button again since it was loaded
+    database.users[2] = ('pending', at(now + 900), None)
+    check, calls = checker({})
+    assert asyncio.run(reconcile.run(check, now)) == 0
+    assert calls == []
+    assert reconcile._due == {1: now + 60, 2: now + 900}
+
+
+def test_sharded_queries():
+    reconcile, database = reconciler({}, shard=(1, 4))
+    asyncio.run(reconcile.load(current_time()))
+    assert database.queries == [
+        PENDING_DUE_SQL.format(shard=" AND MOD(user_id, 4) = 1"),
+        MEMBERS_DUE_SQL.format(shard=" AND MOD(user_id, 4) = 1"),
+    ]
@@ -0,0 +1,141 @@
+# Conformance tests for the storage backends in repository.py. Every test runs
+# against each backend; the MySQL one only with TEST_MYSQL=1 and the usual
+# DB_* settings pointing at a scratch database with a current schema. Rows of
+# the test users (ids from USER_BASE up) are deleted afterwards.
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from database import Database, DatabaseError
+from repository import MySQLRepository, SQLiteRepository
+
+USER_BASE = 8_000_000_000_000
+TEST_CATEGORY = 'Repository tests'
+CLEANUP_SQL = [
+    "DELETE FROM ticket WHERE user_id >= %s",
+    "DELETE FROM users WHERE user_id >= %s",
+]
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def cleanup(database):
+    def delete(cursor):
+        for statement in CLEANUP_SQL:
+            cursor.execute(statement, (USER_BASE,))
+        cursor.execute("DELETE FROM ticket_category WHERE category_name = %s", (TEST_CATEGORY,))
+    database.call(delete)
+
+
+@pytest.fixture(params=['sqlite', 'mysql'])
+def repository(request, tmp_path):
+    if request.param == 'sqlite':
+        repository = SQLiteRepository(str(tmp_path / 'test.sqlite3'))
+        yield repository
+        repository.close()
+        return
+    if os.environ.get('TEST_MYSQL') != '1':
+        pytest.skip("set TEST_MYSQL=1 and DB_* to run against MySQL")
+    database = Database.from_env()
+    cleanup(database)
+    yield MySQLRepository(database)
+    cleanup(database)
+    database.close()
+
+
+INSERT_USER_SQL = "INSERT INTO users (user_id, status, cooldown_until, verified_at) VALUES (%s, %s, %s, %s)"
+INSERT_CATEGORY_SQL = "INSERT INTO ticket_category (category_name, description) VALUES (%s, %s)"
+INSERT_TICKET_SQL = "INSERT INTO ticket (category_id, user_id, message) VALUES (%s, %s, %s)"
+
+
+def insert(repository, sql, params):
+    # Test rows go in with plain INSERTs, which both dialects accept
+    def write(cursor):
+        cursor.execute(repository._sql(sql), params)
+        return cursor.lastrowid
+    return run(repository._write(write))
+
+
+def category(repository):
+    def read(cursor):
+        cursor.execute(repository._sql("SELECT id FROM ticket_category WHERE category_name = %s"), (TEST_CATEGORY,))
+        return cursor.fetchone()
+    row = run(repository._read(read))
+    return row[0] if row else insert(repository, INSERT_CATEGORY_SQL, (TEST_CATEGORY, "Created by the tests"))
+
+
+def tickets(repository, user_id, count):
+    category_id = category(repository)
+    insert(repository, INSERT_USER_SQL, (user_id, 'member', None, None))
+    return [insert(repository, INSERT_TICKET_SQL, (category_id, user_id, f"ticket {i}")) for i in range(count)]
+
+
+def now():
+    # MySQL DATETIME has no fractional seconds
+    return datetime.now().replace(microsecond=0)
+
+
+def test_get_user(repository):
+    assert run(repository.get_user(USER_BASE + 1)) is None
+    cooldown, verified = now() + timedelta(hours=1), now()
+    insert(repository, INSERT_USER_SQL, (USER_BASE + 1, 'pending', cooldown, verified))
+    assert run(repository.get_user(USER_BASE + 1)) == (USER_BASE + 1, 'pending', cooldown, verified)
+
+
+def test_close_ticket(repository):
+    ticket_id, other_id = tickets(repository, USER_BASE + 1, 2)
+    assert run(repository.close_ticket(ticket_id, USER_BASE + 1)) is True
+    assert run(repository.close_ticket(ticket_id, USER_BASE + 1)) is False
+    assert run(repository.close_ticket(-1, USER_BASE + 1)) is False
+    page, _ = run(repository.page_tickets({'status': 'closed', 'user_id': USER_BASE + 1}))
+    assert [ticket.id for ticket in page] == [ticket_id]
+    assert page[0].status == 'closed'
+    page, _ = run(repository.page_tickets({'status': 'open', 'user_id': USER_BASE + 1}))
+    assert [ticket.id for ticket in page] == [other_id]
+
+
+def test_page_tickets_keyset(repository):
+    user_id = USER_BASE + 1
+    ticket_ids = tickets(repository, user_id, 5)
+    run(repository.close_ticket(ticket_ids[0], user_id))
+    filters = {'status': 'open', 'user_id': user_id}
+
+    seen = []
+    after = None
+    while True:
+        page, has_next = run(repository.page_tickets(filters, after, page_size=2))
+        seen.extend(ticket.id for ticket in page)
+        if not has_next:
+            break
+        after = (page[-1].timestamp.isoformat(), page[-1].id)
+    # Newest first, each open ticket exactly once
+    assert seen == sorted(ticket_ids[1:], reverse=True)
+    assert isinstance(run(repository.page_tickets(filters))[0][0].timestamp, datetime)
+    assert (page[-1].message, page[-1].duplicates) == ("ticket 1", 0)
+
+
+def test_failed_write_is_isolated(repository):
+    category_id = category(repository)
+    ticket_id, = tickets(repository, USER_BASE + 1, 1)
+    with pytest.raises(DatabaseError):
+        insert(repository, INSERT_TICKET_SQL, (category_id, USER_BASE + 999_999, "no such user"))
+    assert run(repository.close_ticket(ticket_id, USER_BASE + 1)) is True
+
+
+def test_sqlite_group_commit(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / 'test.sqlite3'))
+    try:
+        ticket_ids = tickets(repository, USER_BASE + 1, 200)
+        writes, groups = repository.writes, repository.groups
+
+        async def close_all():
+            return await asyncio.gather(*(repository.close_ticket(ticket_id, USER_BASE + 1) for ticket_id in ticket_ids))
+        assert all(run(close_all()))
+        assert repository.writes - writes == 200
+        assert repository.groups - groups < 200
+    finally:
+        repository.close()
@@ -0,0 +1,161 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+from repository import SQLITE_SCHEMA
+from retention import Archiver
+
+NOW = datetime(2024, 6, 1, 12, 0)
+
+
+class RetentionDatabase:
+    # Runs the archiver's MySQL statements on an in-memory SQLite copy of the
+    # schema, so the policies' WHERE clauses are the ones under test. Only the
+    # dialect is translated; SQLite has a single writer and no row locks.
+    def __init__(self):
+        self.connection = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def cursor(self):
+        return Cursor(self.connection.cursor())
+
+    async def run(self, fn, *args):
+        try:
+            result = fn(self.cursor(), *args)
+        except Exception:
+            self.connection.rollback()
+            raise
+        self.connection.commit()
+        return result
+
+    async def fetch_one(self, sql, params=()):
+        cursor = self.cursor()
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+        # MIN() drops the column type, so its DATETIME comes back as text
+        return tuple(datetime.fromisoformat(value) if isinstance(value, str) else value for value in row)
+
+    def rows(self, sql, params=()):
+        return self.connection.execute(sql, params).fetchall()
+
+
+class Cursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        sql = sql.replace('%s', '?').replace(' FOR UPDATE SKIP LOCKED', '').replace('INSERT IGNORE', 'INSERT OR IGNORE')
+        self.cursor.execute(sql, params)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+
+def user(database, user_id, status='pending', created_days=365, cooldown_until=None):
+    database.connection.execute(
+        "INSERT INTO users (user_id, status, created_at, cooldown_until) VALUES (?, ?, ?, ?)",
+        (user_id, status, NOW - timedelta(days=created_days), cooldown_until),
+    )
+
+
+def ticket(database, ticket_id, user_id, created_days, status='open', closed_days=None):
+    database.connection.execute(
+        "INSERT INTO ticket (id, category_id, user_id, message, timestamp, status, closed_at) "
+        "VALUES (?, 1, ?, 'help', ?, ?, ?)",
+        (ticket_id, user_id, NOW - timedelta(days=created_days), status,
+         None if closed_days is None else NOW - timedelta(days=closed_days)),
+    )
+
+
+def archive(database, **kwargs):
+    archiver = Archiver(database, closed_days=30, max_age_days=180, pending_user_days=90, pause=0, **kwargs)
+    archived = []
+
+    async def listener(ticket_ids):
+        archived.extend(ticket_ids)
+
+    archiver.listeners.append(listener)
+    return archiver, asyncio.run(archiver.run(NOW)), archived
+
+
+def test_archives_due_closed_tickets_only():
+    database = RetentionDatabase()
+    user(database, 1, status='member')
+    ticket(database, 1, 1, created_days=60, status='closed', closed_days=40)  # closed long enough ago
+    ticket(database, 2, 1, created_days=60, status='closed', closed_days=5)  # closed recently
+    ticket(database, 3, 1, created_days=400, status='closed')  # closed before closed_at was kept
+    ticket(database, 4, 1, created_days=400)  # old but still open
+    ticket(database, 5, 1, created_days=1)
+
+    archiver, counts, archived = archive(database)
+    assert counts == (2, 0)
+    assert sorted(archived) == [1, 3]
+    assert database.rows("SELECT id, status FROM ticket_archive ORDER BY id") == [(1, 'closed'), (3, 'closed')]
+    assert database.rows("SELECT id FROM ticket ORDER BY id") == [(2,), (4,), (5,)]
+    # The open ticket is not overdue for archiving, so it does not count as lag
+    assert archiver.lag_seconds == 0.0
+    assert archiver.stats()['tickets_archived'] == 2
+
+
+def test_archives_in_batches():
+    database = RetentionDatabase()
+    user(database, 1, status='member')
+    for ticket_id in range(1, 8):
+        ticket(database, ticket_id, 1, created_days=60, status='closed', closed_days=40 + ticket_id)
+
+    archiver, counts, archived = archive(database, batch=3)
+    assert counts == (7, 0)
+    # Oldest first
+    assert archived == [7, 6, 5, 4, 3, 2, 1]
+    assert database.rows("SELECT COUNT(*) FROM ticket") == [(0,)]
+
+    database = RetentionDatabase()
+    user(database, 1, status='member')
+    for ticket_id in range(1, 8):
+        ticket(database, ticket_id, 1, created_days=60, status='closed', closed_days=40 + ticket_id)
+    archiver, counts, _ = archive(database, batch=3, max_batches=2)
+    assert counts == (6, 0)
+    # The one left over is reported as lag: closed 41 days ago, due for 11
+    assert archiver.lag_seconds == timedelta(days=11).total_seconds()
+
+
+def test_purges_stale_pending_users():
+    database = RetentionDatabase()
+    user(database, 1)
+    user(database, 2, created_days=10)  # pressed the button recently
+    user(database, 3, cooldown_until=NOW + timedelta(days=1))  # still cooling down
+    user(database, 4, status='banned')
+    user(database, 5)
+    ticket(database, 1, 5, created_days=400)  # owns an open ticket
+    user(database, 6)
+    ticket(database, 2, 6, created_days=5, status='closed', closed_days=1)
+
+    _, counts, _ = archive(database)
+    assert counts == (0, 1)
+    assert database.rows("SELECT user_id FROM users ORDER BY user_id") == [(2,), (3,), (4,), (5,), (6,)]
+
+
+def test_user_who_opened_a_ticket_meanwhile_is_kept():
+    # Selected as stale, then a ticket arrives before the batch's DELETE
+    database = RetentionDatabase()
+    user(database, 1)
+    user(database, 2)
+    archiver = Archiver(database, pending_user_days=90)
+    cursor = database.cursor()
+    select = cursor.execute
+
+    def execute(sql, params=()):
+        select(sql, params)
+        if sql.startswith("SELECT user_id FROM users"):
+            ticket(database, 1, 2, created_days=0)
+
+    cursor.execute = execute
+    assert archiver._delete_users_batch(cursor, NOW - timedelta(days=90)) == 1
+    assert database.rows("SELECT user_id FROM users") == [(2,)]
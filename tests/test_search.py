@@ -0,0 +1,36 @@
+import asyncio
+
+from search import InvertedIndex
+
+
+class EmptyTicketTable:
+    async def fetch_all(self, statement, params):
+        return []
+
+
+def search(index, query):
+    return [ticket_id for ticket_id, _ in asyncio.run(index.search(query))]
+
+
+def test_ranks_matching_tickets():
+    index = InvertedIndex(EmptyTicketTable())
+    index.add(1, "payment failed again")
+    index.add(2, "cannot join the group")
+    index.add(3, "payment page broken, payment failed")
+    assert search(index, "payment") == [3, 1]
+    assert search(index, "nothing") == []
+
+
+def test_removed_tickets_drop_out():
+    index = InvertedIndex(EmptyTicketTable())
+    for ticket_id in range(1, 9):
+        index.add(ticket_id, f"payment failed {ticket_id}")
+    assert index.remove(3) is True
+    assert index.remove(3) is False
+    assert 3 not in search(index, "payment")
+    assert len(index) == 7
+    assert 3 in index._postings['payment']
+    # Over a quarter of the index removed: the postings are swept
+    index.remove(4)
+    assert not {3, 4} & set(index._postings['payment'])
+    assert search(index, "payment") == [8, 7, 6, 5, 2, 1]
@@ -0,0 +1,87 @@
+import asyncio
+
+from sharedstore import LATEST_SQL, POLL_SQL, RECENT_IDS_SQL, DatabaseStore
+
+
+class EventTable:
+    # shared_event rows visible to readers: {id: (kind, key, origin)}
+    def __init__(self):
+        self.rows = {}
+
+    def execute(self, sql, params=()):
+        if sql == POLL_SQL:
+            after, limit = params
+            ids = sorted(event_id for event_id in self.rows if event_id > after)[:limit]
+            self._result = [(event_id, *self.rows[event_id]) for event_id in ids]
+        elif sql == LATEST_SQL:
+            self._result = [(max(self.rows, default=0),)]
+        elif sql == RECENT_IDS_SQL:
+            self._result = [(event_id,) for event_id in self.rows if event_id > params[0]]
+        else:
+            raise AssertionError(f"unexpected statement {sql}")
+
+    def fetchall(self):
+        return self._result
+
+    async def run(self, fn, *args):
+        return fn(self, *args)
+
+    async def fetch_one(self, sql, params=()):
+        self.execute(sql, params)
+        return self._result[0]
+
+    async def fetch_all(self, sql, params=()):
+        self.execute(sql, params)
+        return self._result
+
+
+def store_with(table, overlap=1000, batch=1000):
+    store = DatabaseStore(table, origin=0, overlap=overlap, batch=batch)
+    received = []
+    store.subscribe('catalog', received.append)
+    return store, received
+
+
+def test_event_committed_late_is_still_delivered():
+    table = EventTable()
+    store, received = store_with(table)
+
+    async def main():
+        table.rows[11] = ('catalog', 'b', 1)
+        await store.poll()
+        # Event 10 was inserted first but committed after 11 had been read
+        table.rows[10] = ('catalog', 'a', 1)
+        await store.poll()
+        await store.poll()
+
+    asyncio.run(main())
+    assert received == ['b', 'a']
+
+
+def test_own_events_and_old_events_are_skipped():
+    table = EventTable()
+    table.rows[1] = ('catalog', 'before start', 1)
+    store, received = store_with(table)
+
+    async def main():
+        await store.start()
+        await store.stop()
+        table.rows[2] = ('catalog', 'mine', 0)
+        table.rows[3] = ('catalog', 'theirs', 1)
+        assert await store.poll() == 2
+
+    asyncio.run(main())
+    assert received == ['theirs']
+    assert store.received == 1
+
+
+def test_polls_past_a_full_batch():
+    table = EventTable()
+    store, received = store_with(table, overlap=5, batch=3)
+    for event_id in range(1, 11):
+        table.rows[event_id] = ('catalog', str(event_id), 1)
+
+    asyncio.run(store.poll())
+    assert received == [str(event_id) for event_id in range(1, 11)]
+    # Only the overlap window is remembered
+    assert store._seen == {6, 7, 8, 9, 10}
@@ -0,0 +1,69 @@
+from datetime import datetime
+
+import pytest
+
+from tickets import FilterError, page_cursor, page_query, parse_filters, render_copies
+
+
+def test_defaults_to_open_tickets():
+    assert parse_filters([]) == {'status': 'open'}
+
+
+def test_parses_every_filter():
+    filters = parse_filters(['category=3', 'user=42', 'from=2024-05-01', 'to=2024-05-31', 'status=all'])
+    assert filters == {
+        'status': 'all',
+        'category_id': 3,
+        'user_id': 42,
+        'since': '2024-05-01T00:00:00',
+        # Inclusive end date
+        'until': '2024-06-01T00:00:00',
+    }
+
+
+def test_archived_defaults_to_every_status():
+    assert parse_filters(['archived=yes']) == {'status': 'all', 'archived': True}
+    assert parse_filters(['archived=yes', 'status=open']) == {'status': 'open', 'archived': True}
+    assert parse_filters(['archived=no']) == {'status': 'open'}
+
+
+@pytest.mark.parametrize('args', [
+    ['category'], ['category=abc'], ['from=05/01/2024'], ['status=pending'], ['archived=maybe'], ['colour=red'],
+])
+def test_rejects_bad_filters(args):
+    with pytest.raises(FilterError):
+        parse_filters(args)
+
+
+def test_first_page_query():
+    sql, params = page_query({'status': 'open', 'category_id': 3}, page_size=5)
+    assert sql.startswith("SELECT id, category_id, user_id, message, timestamp, status, duplicates FROM ticket WHERE ")
+    assert "status = %s AND category_id = %s" in sql
+    assert sql.endswith("ORDER BY timestamp DESC, id DESC LIMIT %s")
+    # One row more than a page tells whether there is a next one
+    assert params == ('open', 3, 6)
+
+
+def test_next_page_starts_after_the_cursor():
+    timestamp = datetime(2024, 5, 1, 12, 30)
+    rows = [(7, 3, 42, "text", timestamp, 'open', 0)]
+    after = page_cursor(rows)
+    assert after == ('2024-05-01T12:30:00', 7)
+    sql, params = page_query({'status': 'all'}, after, page_size=5)
+    assert "(timestamp < %s OR (timestamp = %s AND id < %s))" in sql
+    assert "status = %s" not in sql
+    assert params == (timestamp, timestamp, 7, 6)
+
+
+def test_archived_query_reads_the_archive_table():
+    sql, _ = page_query({'status': 'all', 'archived': True})
+    assert " FROM ticket_archive " in sql
+
+
+def test_render_copies():
+    rows = [(42, "the link expired", datetime(2024, 5, 2, 9, 30)), (43, "x" * 400, datetime(2024, 5, 2, 9, 0))]
+    text = render_copies(17, rows, 5)
+    assert text.startswith("Ticket #17 was sent again 5 times; the latest 2:\n\nuser 42, 2024-05-02 09:30\nthe link expired")
+    assert text.endswith("x" * 300 + "…")
+    assert render_copies(17, rows, 2).startswith("Ticket #17 was sent again 2 times:\n")
+    assert render_copies(17, [], 0) == "No similar copies were recorded for ticket #17."
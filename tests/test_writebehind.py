@@ -0,0 +1,231 @@
+import asyncio
+import json
+from datetime import datetime
+
+import mysql.connector
+
+from database import DatabaseError
+from writebehind import (
+    CHECKPOINT_READ_SQL, CHECKPOINT_WRITE_SQL, TICKET_COPY_SQL, TICKET_DUPLICATES_SQL, TICKET_INSERT_SQL, AddMember,
+    InsertTicket, Mutation, SetUserCooldown, SetUserStatus, TicketDuplicate, WriteBehind, coalesce_users,
+    user_statements,
+)
+
+COOLDOWN = datetime(2024, 5, 1, 12, 30)
+
+
+class JournalDatabase:
+    # One transaction per call: statements are kept only when fn returns.
+    # Any value in `rejected` is refused for good, like a bad column value;
+    # `crashes` makes that many calls raise a non-database error first
+    def __init__(self, checkpoint=0, rejected=(), crashes=0):
+        self.checkpoint = checkpoint
+        self.rejected = set(rejected)
+        self.crashes = crashes
+        self.statements = []
+        self.next_ticket_id = 100
+
+    def call(self, fn, *args):
+        cursor = Cursor(self)
+        result = fn(cursor, *args)
+        self.statements.extend(cursor.statements)
+        self.checkpoint = cursor.checkpoint
+        self.next_ticket_id = cursor.next_ticket_id
+        return result
+
+    async def run(self, fn, *args):
+        if self.crashes:
+            self.crashes -= 1
+            raise OSError("No space left on device")
+        return self.call(fn, *args)
+
+
+class Cursor:
+    def __init__(self, database):
+        self.database = database
+        self.checkpoint = database.checkpoint
+        self.next_ticket_id = database.next_ticket_id
+        self.statements = []
+        self.lastrowid = None
+        self._row = None
+
+    def execute(self, sql, params=()):
+        if sql == CHECKPOINT_READ_SQL:
+            self._row = (self.checkpoint,) if self.checkpoint else None
+            return
+        self._check(params)
+        if sql == CHECKPOINT_WRITE_SQL:
+            self.checkpoint = params[1]
+            return
+        if sql == TICKET_INSERT_SQL:
+            self.lastrowid = self.next_ticket_id
+            self.next_ticket_id += 1
+        self.statements.append((sql, params))
+
+    def executemany(self, sql, seq_params):
+        for params in seq_params:
+            self._check(params)
+            self.statements.append((sql, params))
+
+    def fetchone(self):
+        return self._row
+
+    def _check(self, params):
+        for value in params:
+            if value in self.database.rejected:
+                error = mysql.connector.Error(f"Incorrect value: {value!r}", errno=1366)
+                raise DatabaseError(str(error)) from error
+
+
+def write_behind(database, tmp_path, **kwargs):
+    writes = WriteBehind(database, str(tmp_path / 'journal'), retry_delay=0, **kwargs)
+    writes.recover()
+    return writes
+
+
+def journal_lines(tmp_path, name='journal'):
+    return (tmp_path / name).read_text().splitlines()
+
+
+def test_coalesce_users():
+    rows = coalesce_users([
+        AddMember(1), SetUserCooldown(1, COOLDOWN), SetUserStatus(2, 'member'), InsertTicket(3, 1, "help"),
+        SetUserStatus(1, 'banned'),
+    ])
+    assert rows == {
+        1: {'create': True, 'values': {'status': 'banned', 'cooldown_until': COOLDOWN}},
+        2: {'create': False, 'values': {'status': 'member'}},
+    }
+
+
+def test_user_statements():
+    statements = user_statements({
+        1: {'create': True, 'values': {'status': 'banned', 'cooldown_until': COOLDOWN}},
+        2: {'create': False, 'values': {'status': 'member'}},
+        3: {'create': False, 'values': {'status': 'pending'}},
+        4: {'create': False, 'values': {}},
+    })
+    assert statements == [
+        ("INSERT INTO users (user_id, status, cooldown_until) VALUES (%s, %s, %s) "
+         "ON DUPLICATE KEY UPDATE status = VALUES(status), cooldown_until = VALUES(cooldown_until)",
+         [(1, 'banned', COOLDOWN)]),
+        ("UPDATE users SET status = %s WHERE user_id = %s", [('member', 2), ('pending', 3)]),
+    ]
+
+
+def test_recover_replays_past_the_checkpoint(tmp_path):
+    database = JournalDatabase()
+    writes = write_behind(database, tmp_path)
+    for user_id in (1, 2, 3):
+        writes.enqueue(SetUserCooldown(user_id, COOLDOWN))
+    writes._journal.close()
+    # A torn last line from a crash mid-write
+    with open(tmp_path / 'journal', 'a') as journal:
+        journal.write('{"kind":"set_sta')
+
+    database.checkpoint = 1
+    replayed = write_behind(database, tmp_path)
+    assert [(mutation.seq, mutation.user_id) for mutation in replayed._queue] == [(2, 2), (3, 3)]
+    assert replayed._queue[0].cooldown_until == COOLDOWN
+    assert [json.loads(line)['seq'] for line in journal_lines(tmp_path)] == [2, 3]
+    assert replayed.apply_pending(2, ('member', None, None), ('status', 'cooldown_until', 'verified_at')) == (
+        'member', COOLDOWN, None)
+    assert replayed.enqueue(AddMember(4)).seq == 4
+
+
+def test_crash_after_a_committed_batch(tmp_path):
+    database = JournalDatabase()
+    writes = write_behind(database, tmp_path)
+    writes.enqueue(AddMember(1))
+    asyncio.run(writes.flush_once())
+    assert journal_lines(tmp_path) == []
+    ticket = writes.enqueue(InsertTicket(7, 2, "help"))
+    writes.enqueue(TicketDuplicate.of(ticket, 3, "help!"))
+    writes._journal.close()
+
+    replayed = write_behind(database, tmp_path)
+    assert [mutation.seq for mutation in replayed._queue] == [2, 3]
+    asyncio.run(replayed.flush_once())
+    assert database.checkpoint == 3
+    assert (TICKET_INSERT_SQL, (7, 2, "help")) in database.statements
+    # The duplicate found its ticket again through the journal seq
+    assert database.statements[-2:] == [(TICKET_DUPLICATES_SQL, (1, 100)), (TICKET_COPY_SQL, (100, 3, "help!"))]
+    assert journal_lines(tmp_path) == []
+
+
+def test_duplicate_journaled_before_copies_were_kept(tmp_path):
+    mutation = Mutation.from_json('{"kind":"ticket_duplicate","seq":4,"ticket_id":17,"original_seq":null,"user_id":3}')
+    assert (mutation.ticket_id, mutation.user_id, mutation.message) == (17, 3, None)
+    database = JournalDatabase()
+    writes = write_behind(database, tmp_path)
+    writes.enqueue(mutation)
+    asyncio.run(writes.flush_once())
+    # Counted, with no text to keep
+    assert database.statements == [(TICKET_DUPLICATES_SQL, (1, 17))]
+
+
+def test_rejected_write_is_dead_lettered(tmp_path):
+    database = JournalDatabase(rejected={'bogus'})
+    writes = write_behind(database, tmp_path)
+    committed = []
+
+    async def listener(mutations):
+        committed.extend(mutation.user_id for mutation in mutations)
+
+    writes.listeners.append(listener)
+    for mutation in (AddMember(1), SetUserStatus(2, 'bogus'), AddMember(3)):
+        writes.enqueue(mutation)
+
+    async def main():
+        try:
+            await writes.flush_once()
+        except DatabaseError:
+            await writes.flush_singly()
+
+    asyncio.run(main())
+    assert committed == [1, 3]
+    assert (writes.committed, writes.dead_letters, len(writes)) == (2, 1, 0)
+    assert database.checkpoint == 3
+    [dead] = [json.loads(line) for line in journal_lines(tmp_path, 'journal.dead')]
+    assert (dead['kind'], dead['seq'], dead['user_id'], dead['status']) == ('set_status', 2, 2, 'bogus')
+    assert 'bogus' in dead['error']
+    assert writes.apply_pending(2, ('member',), ('status',)) == ('member',)
+
+
+def test_flusher_survives_unexpected_errors(tmp_path):
+    database = JournalDatabase(crashes=2)
+    writes = WriteBehind(database, str(tmp_path / 'journal'), max_latency=0, retry_delay=0)
+
+    async def main():
+        writes.recover()
+        writes.start()
+        writes.enqueue(AddMember(1))
+        for _ in range(100):
+            if writes.committed:
+                break
+            await asyncio.sleep(0)
+        await writes.close()
+
+    asyncio.run(main())
+    assert database.crashes == 0
+    assert writes.committed == 1
+    assert database.checkpoint == 1
+
+
+def test_settle_waits_for_the_users_queued_writes(tmp_path):
+    database = JournalDatabase()
+    writes = WriteBehind(database, str(tmp_path / 'journal'), max_latency=0, retry_delay=0)
+
+    async def main():
+        writes.recover()
+        assert await writes.settle([1])
+        writes.start()
+        writes.enqueue(SetUserStatus(1, 'member'))
+        writes.enqueue(InsertTicket(7, 2, "help"))
+        await writes.settle([1])
+        # Committed, so the overlay no longer hides what a direct write changes
+        assert ("UPDATE users SET status = %s WHERE user_id = %s", ('member', 1)) in database.statements
+        assert writes.apply_pending(1, ('ban',), ('status',)) == ('ban',)
+        await writes.close()
+
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+PAGE_SIZE = 5
+PREVIEW_LENGTH = 300
+COPIES_PAGE_SIZE = 10
+
+COPIES_SQL = (
+    "SELECT user_id, message, created_at FROM ticket_duplicate WHERE ticket_id = %s ORDER BY id DESC LIMIT %s"
+)
+COPIES_COUNT_SQL = "SELECT COUNT(*) FROM ticket_duplicate WHERE ticket_id = %s"
+
+
+class FilterError(ValueError):
+    pass
+
+
+def parse_filters(args):
+    # /tickets [category=<id>] [user=<id>] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [status=open|closed|all] [archived=yes|no]
+    filters = {'status': 'open'}
+    status_given = False
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if not value:
+            raise FilterError(f"Expected key=value, got '{arg}'")
+        try:
+            if key == 'category':
+                filters['category_id'] = int(value)
+            elif key == 'user':
+                filters['user_id'] = int(value)
+            elif key == 'from':
+                filters['since'] = datetime.strptime(value, '%Y-%m-%d').isoformat()
+            elif key == 'to':
+                # Inclusive end date
+                filters['until'] = (datetime.strptime(value, '%Y-%m-%d') + timedelta(days=1)).isoformat()
+            elif key == 'status':
+                if value not in ('open', 'closed', 'all'):
+                    raise FilterError("status must be open, closed or all")
+                filters['status'] = value
+                status_given = True
+            elif key == 'archived':
+                if value not in ('yes', 'no'):
+                    raise FilterError("archived must be yes or no")
+                if value == 'yes':
+                    filters['archived'] = True
+            else:
+                raise FilterError(f"Unknown filter '{key}'")
+        except ValueError as e:
+            if isinstance(e, FilterError):
+                raise
+            raise FilterError(f"Invalid value for {key}: {value}") from e
+    if filters.get('archived') and not status_given:
+        # Most archived tickets are closed ones
+        filters['status'] = 'all'
+    return filters
+
+
+def page_query(filters, after=None, page_size=PAGE_SIZE):
+    # Keyset pagination, newest first. `after` is the (timestamp, id) of the
+    # last row on the previous page, so every page is an index range scan that
+    # starts where the last one stopped, however deep the page.
+    conditions = []
+    params = []
+    if filters.get('status', 'open') != 'all':
+        conditions.append("status = %s")
+        params.append(filters.get('status', 'open'))
+    if 'category_id' in filters:
+        conditions.append("category_id = %s")
+        params.append(filters['category_id'])
+    if 'user_id' in filters:
+        conditions.append("user_id = %s")
+        params.append(filters['user_id'])
+    if 'since' in filters:
+        conditions.append("timestamp >= %s")
+        params.append(datetime.fromisoformat(filters['since']))
+    if 'until' in filters:
+        conditions.append("timestamp < %s")
+        params.append(datetime.fromisoformat(filters['until']))
+    if after is not None:
+        after_timestamp, after_id = datetime.fromisoformat(after[0]), after[1]
+        conditions.append("(timestamp < %s OR (timestamp = %s AND id < %s))")
+        params.extend([after_timestamp, after_timestamp, after_id])
+
+    # ticket_archive has the same columns and indexes
+    table = 'ticket_archive' if filters.get('archived') else 'ticket'
+    sql = f"SELECT id, category_id, user_id, message, timestamp, status, duplicates FROM {table}"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    # One extra row tells us whether there is a next page
+    sql += " ORDER BY timestamp DESC, id DESC LIMIT %s"
+    params.append(page_size + 1)
+    return sql, tuple(params)
+
+
+def page_cursor(rows):
+    ticket_id, _, _, _, timestamp, _, _ = rows[-1]
+    return (timestamp.isoformat(), ticket_id)
+
+
+def similar(ticket_id, duplicates):
+    # Near-duplicates folded into a ticket instead of becoming tickets themselves
+    return f" (+{duplicates} similar, /similar {ticket_id})" if duplicates else ""
+
+
+def render_copies(ticket_id, rows, total):
+    # The latest near-duplicates folded into a ticket, newest first; rows are
+    # (user_id, message, created_at) from COPIES_SQL
+    if not rows:
+        return f"No similar copies were recorded for ticket #{ticket_id}."
+    heading = f"Ticket #{ticket_id} was sent again {total} times"
+    lines = [heading + (f"; the latest {len(rows)}:" if total > len(rows) else ":")]
+    for user_id, message, created_at in rows:
+        preview = message if len(message) <= PREVIEW_LENGTH else message[:PREVIEW_LENGTH] + "…"
+        lines.append(f"\nuser {user_id}, {created_at:%Y-%m-%d %H:%M}\n{preview}")
+    return "\n".join(lines)
+
+
+def render_page(rows, page_number, has_next, category_names, archived=False):
+    if not rows:
+        return "No tickets match these filters.", None
+
+    lines = [f"{'Archived tickets' if archived else 'Tickets'}, page {page_number + 1}:"]
+    close_buttons = []
+    for ticket_id, category_id, user_id, message, timestamp, status, duplicates in rows:
+        preview = message if len(message) <= PREVIEW_LENGTH else message[:PREVIEW_LENGTH] + "…"
+        category = category_names.get(category_id, f"category {category_id}")
+        lines.append(f"\n#{ticket_id} [{status}] {category} — user {user_id}, {timestamp:%Y-%m-%d %H:%M}{similar(ticket_id, duplicates)}\n{preview}")
+        if status == 'open' and not archived:
+            close_buttons.append(InlineKeyboardButton(f"Close #{ticket_id}", callback_data=f"ticket_close_{ticket_id}"))
+
+    keyboard = [close_buttons[i:i + 2] for i in range(0, len(close_buttons), 2)]
+    navigation = []
+    if page_number > 0:
+        navigation.append(InlineKeyboardButton("« Newer", callback_data='tickets_prev'))
+    if has_next:
+        navigation.append(InlineKeyboardButton("Older »", callback_data='tickets_next'))
+    if navigation:
+        keyboard.append(navigation)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard) if keyboard else None
@@ -0,0 +1,485 @@
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime
+
+from database import DatabaseError, is_transient
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_READ_SQL = "SELECT last_seq FROM write_behind_state WHERE id = %s"
+CHECKPOINT_WRITE_SQL = (
+    "INSERT INTO write_behind_state (id, last_seq) VALUES (%s, %s) "
+    "ON DUPLICATE KEY UPDATE last_seq = VALUES(last_seq)"
+)
+TICKET_INSERT_SQL = "INSERT INTO ticket (category_id, user_id, message) VALUES (%s, %s, %s)"
+TICKET_DUPLICATES_SQL = "UPDATE ticket SET duplicates = duplicates + %s, last_duplicate_at = NOW() WHERE id = %s"
+TICKET_COPY_SQL = "INSERT INTO ticket_duplicate (ticket_id, user_id, message) VALUES (%s, %s, %s)"
+
+
+# Mutations. Each one is journaled as a JSON line before it is queued, and is
+# safe to replay: a crash between commit and journal truncation is covered by
+# the sequence number committed together with the batch.
+
+class Mutation:
+    kind = None
+    fields = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.fields, args):
+            setattr(self, name, value)
+        self.seq = None
+
+    def to_json(self):
+        data = {'kind': self.kind, 'seq': self.seq}
+        for name in self.fields:
+            value = getattr(self, name)
+            data[name] = {'$dt': value.isoformat()} if isinstance(value, datetime) else value
+        return json.dumps(data, separators=(',', ':'))
+
+    @staticmethod
+    def from_json(line):
+        data = json.loads(line)
+        cls = MUTATION_TYPES[data['kind']]
+        args = []
+        for name in cls.fields:
+            # Fields added since the line was journaled read as None
+            value = data.get(name)
+            args.append(datetime.fromisoformat(value['$dt']) if isinstance(value, dict) else value)
+        mutation = cls(*args)
+        mutation.seq = data['seq']
+        return mutation
+
+
+class AddMember(Mutation):
+    kind = 'add_member'
+    fields = ('user_id',)
+
+    def apply(self, row):
+        row['create'] = True
+        row['values']['status'] = 'member'
+
+
+class RequestJoin(Mutation):
+    kind = 'request_join'
+    fields = ('user_id', 'cooldown_until')
+
+    def apply(self, row):
+        row['create'] = True
+        row['values']['status'] = 'pending'
+        row['values']['cooldown_until'] = self.cooldown_until
+
+
+class SetUserStatus(Mutation):
+    kind = 'set_status'
+    fields = ('user_id', 'status')
+
+    def apply(self, row):
+        row['values']['status'] = self.status
+
+
+class SetUserCooldown(Mutation):
+    kind = 'set_cooldown'
+    fields = ('user_id', 'cooldown_until')
+
+    def apply(self, row):
+        row['values']['cooldown_until'] = self.cooldown_until
+
+
+class SetUserVerified(Mutation):
+    # Membership was confirmed against the whitelist group at verified_at
+    kind = 'set_verified'
+    fields = ('user_id', 'verified_at')
+
+    def apply(self, row):
+        row['values']['verified_at'] = self.verified_at
+
+
+class InsertTicket(Mutation):
+    kind = 'insert_ticket'
+    fields = ('category_id', 'user_id', 'message')
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.ticket_id = None  # Filled in by the batch that inserts it
+        self.committed = False
+
+
+class TicketDuplicate(Mutation):
+    # user_id sent `message`, a near-duplicate of a ticket. The ticket is named
+    # by its id once committed, otherwise by the journal seq of its
+    # InsertTicket, which is then resolved through `original` when the batch
+    # is committed.
+    kind = 'ticket_duplicate'
+    fields = ('ticket_id', 'original_seq', 'user_id', 'message')
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.original = None
+
+    @classmethod
+    def of(cls, original, user_id, message):
+        # `original` is a committed ticket id or a queued InsertTicket
+        if isinstance(original, int):
+            return cls(original, None, user_id, message)
+        if original.committed:
+            return cls(original.ticket_id, None, user_id, message)
+        mutation = cls(None, original.seq, user_id, message)
+        mutation.original = original
+        return mutation
+
+    def resolve(self):
+        # Only called inside the batch transaction, after its tickets got ids
+        if self.ticket_id is None and self.original is not None:
+            return self.original.ticket_id
+        return self.ticket_id
+
+
+MUTATION_TYPES = {
+    cls.kind: cls
+    for cls in (AddMember, RequestJoin, SetUserStatus, SetUserCooldown, SetUserVerified, InsertTicket, TicketDuplicate)
+}
+TICKET_MUTATIONS = (InsertTicket, TicketDuplicate)
+USER_COLUMNS = ('status', 'cooldown_until', 'verified_at')
+
+
+def coalesce_users(mutations):
+    # Folds every user mutation of a batch into one final row per user:
+    # {'create': bool, 'values': {column: value}}. Later mutations win.
+    rows = {}
+    for mutation in mutations:
+        if isinstance(mutation, TICKET_MUTATIONS):
+            continue
+        row = rows.setdefault(mutation.user_id, {'create': False, 'values': {}})
+        mutation.apply(row)
+    return rows
+
+
+def user_statements(rows):
+    # Groups coalesced rows by the columns they touch, so each group becomes a
+    # single executemany: multi-row upserts for rows that may need creating,
+    # batched UPDATEs for the rest (which must not create rows).
+    groups = {}
+    for user_id, row in rows.items():
+        columns = tuple(column for column in USER_COLUMNS if column in row['values'])
+        if not columns:
+            continue
+        params = [row['values'][column] for column in columns]
+        groups.setdefault((row['create'], columns), []).append((user_id, params))
+
+    statements = []
+    for (create, columns), entries in groups.items():
+        if create:
+            sql = (
+                f"INSERT INTO users (user_id, {', '.join(columns)}) VALUES (%s, {', '.join(['%s'] * len(columns))}) "
+                f"ON DUPLICATE KEY UPDATE {', '.join(f'{column} = VALUES({column})' for column in columns)}"
+            )
+            statements.append((sql, [(user_id, *params) for user_id, params in entries]))
+        else:
+            sql = f"UPDATE users SET {', '.join(f'{column} = %s' for column in columns)} WHERE user_id = %s"
+            statements.append((sql, [(*params, user_id) for user_id, params in entries]))
+    return statements
+
+
+class WriteBehind:
+    # Handlers enqueue mutations and carry on; a background flusher commits
+    # them in batches of up to max_batch, at most max_latency seconds after the
+    # first one was queued, in one transaction per batch.
+
+    def __init__(self, database, journal_path, max_batch=500, max_latency=0.2, retry_delay=1.0, checkpoint_id=1,
+                 dead_letter_path=None):
+        self.database = database
+        self.journal_path = journal_path
+        # Mutations the database rejects for good are moved here, one JSON
+        # line each with the error, so they stop blocking the writes behind them
+        self.dead_letter_path = dead_letter_path or journal_path + '.dead'
+        # Row of write_behind_state holding this journal's checkpoint; each
+        # worker process has a journal of its own
+        self.checkpoint_id = checkpoint_id
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.retry_delay = retry_delay
+        self.committed = 0
+        self.batches = 0
+        self.dead_letters = 0
+        # Coroutine functions awaited with each committed batch
+        self.listeners = []
+        self._queue = []
+        self._pending_users = {}  # user_id -> {'create': bool, 'values': {...}, 'seq': int}
+        self._seq = 0
+        self._journal = None
+        self._wakeup = None
+        self._flushed = None  # Condition notified whenever mutations leave the queue
+        self._flusher = None
+        self._closing = False
+
+    def __len__(self):
+        return len(self._queue)
+
+    def recover(self):
+        # Synchronous startup step: re-queues journaled mutations that never
+        # made it into a committed batch.
+        def read(cursor):
+            cursor.execute(CHECKPOINT_READ_SQL, (self.checkpoint_id,))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+
+        last_committed = self.database.call(read)
+        self._seq = last_committed
+        os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+        replayed = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf-8') as journal:
+                for line in journal:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        mutation = Mutation.from_json(line)
+                    except (ValueError, KeyError) as e:
+                        # A torn last line from a crash mid-write
+                        logger.warning("Skipping unreadable journal line: %s", e)
+                        continue
+                    self._seq = max(self._seq, mutation.seq)
+                    if mutation.seq > last_committed:
+                        replayed.append(mutation)
+        # Rewrite the journal with just the uncommitted entries; this also drops
+        # a torn last line that new entries would otherwise be appended to
+        temporary_path = self.journal_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as journal:
+            for mutation in replayed:
+                journal.write(mutation.to_json() + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        originals = {mutation.seq: mutation for mutation in replayed if isinstance(mutation, InsertTicket)}
+        for mutation in replayed:
+            if isinstance(mutation, TicketDuplicate) and mutation.ticket_id is None:
+                mutation.original = originals.get(mutation.original_seq)
+            self._queue.append(mutation)
+            self._track(mutation)
+        if replayed:
+            logger.info("Replaying %d journaled writes", len(replayed))
+
+    def start(self):
+        if self._journal is None:
+            os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Condition()
+        if self._queue:
+            self._wakeup.set()
+        self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    def enqueue(self, mutation):
+        self._seq += 1
+        mutation.seq = self._seq
+        # Journaled before the handler continues, so a crash cannot lose it
+        self._journal.write(mutation.to_json() + '\n')
+        self._journal.flush()
+        self._queue.append(mutation)
+        self._track(mutation)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return mutation
+
+    def _track(self, mutation):
+        if isinstance(mutation, TICKET_MUTATIONS):
+            return
+        pending = self._pending_users.setdefault(mutation.user_id, {'create': False, 'values': {}, 'seq': 0})
+        mutation.apply(pending)
+        pending['seq'] = mutation.seq
+
+    def apply_pending(self, user_id, row, columns=USER_COLUMNS):
+        # Read-your-writes: overlays queued, uncommitted changes for user_id on
+        # a row read from the database (None when the user has no row yet).
+        pending = self._pending_users.get(user_id)
+        if pending is None:
+            return row
+        if row is None:
+            if not pending['create']:
+                return None
+            return tuple(pending['values'].get(column) for column in columns)
+        return tuple(
+            pending['values'][column] if column in pending['values'] else value
+            for column, value in zip(columns, row)
+        )
+
+    async def settle(self, user_ids):
+        # Waits until the mutations queued so far for user_ids have left the
+        # queue, committed or dead-lettered. A write made around the queue
+        # (bulk moderation) then lands after them, rather than being
+        # overwritten when they commit and hidden by apply_pending until then.
+        user_ids = set(user_ids)
+        last_seq = self._seq
+
+        def settled():
+            for mutation in self._queue:
+                if mutation.seq > last_seq:
+                    return True
+                if not isinstance(mutation, TICKET_MUTATIONS) and mutation.user_id in user_ids:
+                    return False
+            return True
+
+        if self._flushed is None:
+            return settled()
+        async with self._flushed:
+            await self._flushed.wait_for(settled)
+        return True
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if not self._queue:
+                self._wakeup.clear()
+                if self._closing:
+                    return
+                continue
+            # Give a burst max_latency to build up unless the batch is already full
+            if len(self._queue) < self.max_batch and not self._closing:
+                await asyncio.sleep(self.max_latency)
+            try:
+                try:
+                    await self.flush_once()
+                except DatabaseError as e:
+                    if is_transient(e):
+                        raise
+                    # A mutation the database will never accept; retrying the
+                    # batch as it is would block every write behind it
+                    logger.warning("Write-behind batch rejected, committing it one write at a time: %s", e)
+                    await self.flush_singly()
+            except DatabaseError as e:
+                logger.error("Write-behind flush failed, retrying: %s", e)
+                await asyncio.sleep(self.retry_delay)
+            except Exception:
+                # Anything else (a full disk under the journal, a bug in a
+                # statement builder) must not end the flusher: the queue would
+                # grow unseen until shutdown
+                logger.exception("Write-behind flush crashed, retrying")
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush_once(self):
+        batch = self._queue[:self.max_batch]
+        if not batch:
+            return 0
+        # Make the journal durable on disk before the batch can be committed
+        os.fsync(self._journal.fileno())
+        await self._commit(batch)
+        await self._done(batch, batch)
+        return len(batch)
+
+    async def _commit(self, batch):
+        try:
+            await self.database.run(_commit_batch, batch, self.checkpoint_id)
+        except DatabaseError:
+            # Ids handed out inside the rolled-back transaction are not theirs
+            for mutation in batch:
+                if isinstance(mutation, InsertTicket) and not mutation.committed:
+                    mutation.ticket_id = None
+            raise
+
+    async def flush_singly(self):
+        # After a permanent error: the batch is committed one mutation per
+        # transaction, so only the mutation at fault is set aside. Its
+        # checkpoint is still advanced, or a restart would replay it.
+        # A transient error stops the pass; the rest is retried as usual.
+        batch = self._queue[:self.max_batch]
+        os.fsync(self._journal.fileno())
+        for mutation in batch:
+            try:
+                await self._commit([mutation])
+            except DatabaseError as e:
+                if is_transient(e):
+                    raise
+                self._dead_letter(mutation, e)
+                await self.database.run(_write_checkpoint, self.checkpoint_id, mutation.seq)
+                await self._done([mutation], [])
+                continue
+            await self._done([mutation], [mutation])
+
+    def _dead_letter(self, mutation, error):
+        logger.error("Write-behind dropped %s (seq %s) rejected by the database: %s", mutation.kind, mutation.seq, error)
+        record = json.loads(mutation.to_json())
+        record['error'] = str(error)
+        record['failed_at'] = datetime.now().isoformat(sep=' ', timespec='seconds')
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as dead_letters:
+            dead_letters.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.dead_letters += 1
+
+    async def _done(self, batch, committed):
+        # Bookkeeping once `batch`, the head of the queue, is out of it;
+        # `committed` is the part of it that reached the database
+        del self._queue[:len(batch)]
+        for mutation in committed:
+            if isinstance(mutation, InsertTicket):
+                mutation.committed = True
+        last_seq = batch[-1].seq
+        for user_id in {mutation.user_id for mutation in batch}:
+            pending = self._pending_users.get(user_id)
+            if pending is not None and pending['seq'] <= last_seq:
+                del self._pending_users[user_id]
+        self.committed += len(committed)
+        self.batches += 1
+        if not self._queue:
+            # Everything journaled so far is committed; start the journal afresh
+            self._journal.seek(0)
+            self._journal.truncate()
+        if self._flushed is not None:
+            async with self._flushed:
+                self._flushed.notify_all()
+        if not committed:
+            return
+        for listener in self.listeners:
+            try:
+                await listener(committed)
+            except Exception as e:
+                logger.error("Write-behind commit listener failed: %s", e)
+
+    async def close(self):
+        # Final drain at shutdown; anything left stays in the journal for next start
+        self._closing = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if self._flusher is not None:
+            try:
+                await asyncio.wait_for(self._flusher, timeout=30)
+            except asyncio.TimeoutError:
+                self._flusher.cancel()
+                logger.warning("%d writes left in the journal at shutdown", len(self._queue))
+        if self._journal is not None:
+            self._journal.close()
+
+
+def _commit_batch(cursor, batch, checkpoint_id):
+    for sql, params in user_statements(coalesce_users(batch)):
+        cursor.executemany(sql, params)
+    for ticket in batch:
+        if isinstance(ticket, InsertTicket):
+            # One row at a time: with interleaved auto-increment locking
+            # (innodb_autoinc_lock_mode=2) a multi-row INSERT is not guaranteed
+            # consecutive ids, so only each row's own lastrowid is reliable
+            cursor.execute(TICKET_INSERT_SQL, (ticket.category_id, ticket.user_id, ticket.message))
+            ticket.ticket_id = cursor.lastrowid
+    duplicates = {}
+    copies = []
+    for mutation in batch:
+        if isinstance(mutation, TicketDuplicate):
+            ticket_id = mutation.resolve()
+            if ticket_id is None:
+                # Its ticket was committed before a crash that lost the id
+                logger.warning("Dropping duplicate count for unresolved ticket (seq %s)", mutation.original_seq)
+                continue
+            duplicates[ticket_id] = duplicates.get(ticket_id, 0) + 1
+            if mutation.message is not None:
+                copies.append((ticket_id, mutation.user_id, mutation.message))
+    if duplicates:
+        cursor.executemany(TICKET_DUPLICATES_SQL, [(count, ticket_id) for ticket_id, count in duplicates.items()])
+    if copies:
+        cursor.executemany(TICKET_COPY_SQL, copies)
+    _write_checkpoint(cursor, checkpoint_id, batch[-1].seq)
+
+
+def _write_checkpoint(cursor, checkpoint_id, seq):
+    cursor.execute(CHECKPOINT_WRITE_SQL, (checkpoint_id, seq))